@@ -0,0 +1,89 @@
+from bisect import bisect_left
+from threading import Lock
+
+GRAM_SIZE = 3
+# Keeps trigrams from spanning the name and the ID
+SEPARATOR = '\x00'
+
+
+def trigrams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+class AccountIndex:
+    """
+    Accounts kept in name order with a trigram index over names and IDs,
+    so the directory and searches don't scan and sort every account.
+    """
+    def __init__(self, accounts=()):
+        self.accounts = dict()
+        # Lowercased name and ID that searches match against
+        self.texts = dict()
+        self.postings = dict()
+        self.lock = Lock()
+        self._ordered = None
+        for acc in accounts:
+            self._index(acc)
+        # (name, ident) pairs in the order the directory lists them,
+        # and the accounts in the same order
+        self.order = sorted((acc.name, acc.ident) for acc in self.accounts.values())
+        self.sorted_accounts = [self.accounts[ident] for _, ident in self.order]
+
+    def _index(self, acc):
+        text = f'{acc.name.lower()}{SEPARATOR}{acc.ident.lower()}'
+        self.accounts[acc.ident] = acc
+        self.texts[acc.ident] = text
+        for gram in trigrams(text):
+            self.postings.setdefault(gram, set()).add(acc.ident)
+
+    def add(self, acc):
+        with self.lock:
+            self._index(acc)
+            position = bisect_left(self.order, (acc.name, acc.ident))
+            self.order.insert(position, (acc.name, acc.ident))
+            self.sorted_accounts.insert(position, acc)
+            self._ordered = None
+
+    def remove(self, acc):
+        with self.lock:
+            if self.accounts.pop(acc.ident, None) is None:
+                return
+            position = bisect_left(self.order, (acc.name, acc.ident))
+            del self.order[position]
+            del self.sorted_accounts[position]
+            for gram in trigrams(self.texts.pop(acc.ident)):
+                idents = self.postings[gram]
+                idents.discard(acc.ident)
+                if not idents:
+                    del self.postings[gram]
+            self._ordered = None
+
+    def ordered(self):
+        """
+        Every account sorted by name.
+        """
+        with self.lock:
+            if self._ordered is None:
+                self._ordered = tuple(self.sorted_accounts)
+            return self._ordered
+
+    def search(self, query):
+        """
+        Accounts whose name or ID contains the query, ignoring case, in name order.
+        """
+        query = query.lower().replace(SEPARATOR, '')
+        if not query:
+            return self.ordered()
+        with self.lock:
+            texts = self.texts
+            if len(query) < GRAM_SIZE:
+                # Too short to index and matches most accounts anyway
+                return tuple(acc for acc in self.sorted_accounts if query in texts[acc.ident])
+            # Only accounts with the query's rarest trigram can match
+            candidates = min((self.postings.get(gram, ()) for gram in trigrams(query)), key=len)
+            matches = [ident for ident in candidates if query in texts[ident]]
+            if len(matches) * 8 > len(self.order):
+                # Walking the directory order is cheaper than sorting most of it
+                matches = set(matches)
+                return tuple(acc for acc in self.sorted_accounts if acc.ident in matches)
+            return tuple(sorted((self.accounts[ident] for ident in matches), key=lambda a: (a.name, a.ident)))
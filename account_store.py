@@ -1,56 +1,104 @@
-import hashlib
-import hmac
-import os
+import fcntl
+import logging
+import math
 import random
-import json
-from threading import Event, Lock
-
-from tlog import TransactionLog
-
-
-def hash_new_password(password: str):
+from contextlib import contextmanager
+from fractions import Fraction
+from threading import Lock, RLock, Thread
+
+from account_index import AccountIndex
+from balance_store import BalanceStore
+from broker import ACCOUNTS_LIST_TOPIC, PROPERTIES_TOPIC, UpdateBroker, account_topic
+from leaderboard import Leaderboard
+from passwords import PasswordHasher, verify_password
+from telemetry import Histogram, TimedLock
+from tlog import HISTORY_PAGE_SIZE, TLogError, TransactionLog
+
+logger = logging.getLogger(__name__)
+
+# Accounts share this many locks, so money moving between
+# unrelated accounts rarely waits on the same one.
+ACCOUNT_LOCK_STRIPES = 64
+# Largest amount or balance the database can store, an SQLite INTEGER is 64 bits
+MAX_CASH = 2**63 - 1
+# Operations that change many balances in one step, see AccountManager.bulk
+BULK_OPERATIONS = ('deposit', 'withdraw', 'percent')
+
+
+def check_amount(amount):
     """
-    Hash the provided password with a randomly-generated salt and return the
-    salt and hash to store in the database.
+    Raise ValueError unless amount is a whole number of dollars the database can store.
     """
-    salt = os.urandom(16)
-    pw_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
-    return salt, pw_hash
+    if type(amount) is not int or amount < 0:
+        raise ValueError('Amount must be a whole number, not negative.')
+    if amount > MAX_CASH:
+        raise ValueError(f'Amount must be no more than ${MAX_CASH}.')
 
 
-def verify_password(salt: bytes, pw_hash: bytes, password: str):
+def check_room(account, cash, amount):
     """
-    Given a previously-stored salt and hash, and a password provided by a user
-    trying to log in, check whether the password is correct.
+    Raise ValueError if paying amount into an account holding cash takes it past MAX_CASH.
     """
-    return hmac.compare_digest(
-        pw_hash,
-        hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
-    )
+    if cash + amount > MAX_CASH:
+        raise ValueError(f'{account.name} can hold no more than ${MAX_CASH}.')
 
 
 class Account:
     """
     Information and methods related to user accounts.
     This includes game information as well and information needed for logging in and priviledge managment.
+    The balance lives in the manager's BalanceStore, the account only knows its slot.
+    Everything shared with the other accounts is looked up on the manager.
     """
-    def __init__(self, ident, name, pw_salt, pw_hash, starting_cash: int, properties: set, banker, update_event, log_connection, prop_manager):
+    __slots__ = ('ident', 'name', 'pw_salt', 'pw_hash', 'properties', 'banker', 'manager', 'store', 'slot')
+
+    def __init__(self, ident, name, pw_salt, pw_hash, starting_cash: int, properties: set, banker, manager=None, store=None):
         self.ident = ident
         self.name = name.title()
         self.pw_salt = pw_salt
         self.pw_hash = pw_hash
-        self.cash = starting_cash
         self.properties = properties
         self.banker = banker
-        self.account_update_trigger = update_event
+        self.manager = manager
+        self.store = BalanceStore() if store is None else store
+        self.slot = self.store.add(starting_cash)
+
+    @property
+    def game_id(self):
+        return None if self.manager is None else self.manager.game_id
+
+    @property
+    def broker(self):
+        return self.manager.broker
+
+    @property
+    def tlog_connection(self):
+        return self.manager.tlog_connection
+
+    @property
+    def prop_manager(self):
+        return self.manager.prop_manager
+
+    @property
+    def write_lock(self):
         # Prevent race conditions by using a mutex on sections that write or change data.
-        self.write_lock = Lock()
-        self.tlog_connection = log_connection
-        self.prop_manager = prop_manager
+        # The lock is shared with other accounts on the same stripe.
+        return self.manager.lock_for(self.ident)
 
     def __str__(self):
         return f'{self.name}:\n\tID: {self.ident}\n\tBalance: ${self.cash}'
 
+    @property
+    def cash(self):
+        return self.store.balances[self.slot]
+
+    @cash.setter
+    def cash(self, cash):
+        change = cash - self.store.balances[self.slot]
+        self.store.balances[self.slot] = cash
+        if change and self.manager is not None:
+            self.manager.leaderboard.adjust(self.ident, change)
+
     def is_authenticated(self, try_pw):
         return verify_password(self.pw_salt, self.pw_hash, try_pw)
 
@@ -62,109 +110,336 @@ class Account:
         return False
 
     def get_id(self):
-        return self.ident
+        # Logins are per game, an account ID can exist in several games
+        if self.game_id is None:
+            return self.ident
+        return f'{self.game_id}:{self.ident}'
 
     def add_property(self, prop):
         """
         Add a property to the user and log it.
+        Raises ValueError if another account owns it, see AccountManager.buy_property to sell one from the bank.
         """
-
-        def serialize_props():
-            """
-            Turn property into JSON for saving into TLog
-            """
-            prop_names = list(map(lambda p: p.save_attributes(), self.properties))
-            return json.dumps(prop_names)
-
-        self.write_lock.acquire()
-        prop.owner = self.ident
-        self.properties.add(prop)
-        self.prop_manager.update_color_set_rent(prop.color)
-        self.write_lock.release()
-        self.tlog_connection.update_properties(self.ident, serialize_props())
+        with self.write_lock, self.manager.property_lock:
+            if prop.owner not in (None, self.ident):
+                raise ValueError(f'{prop.name} already belongs to {prop.owner}.')
+            with self.tlog_connection.group() as receipt:
+                self.manager.queue_property_owner(prop, self.ident)
+                self.tlog_connection.log_property_bought(self.ident, prop.name)
+            receipt.wait()
+            prop.owner = self.ident
+            self.properties.add(prop)
+            self.prop_manager.update_color_set_rent(prop.color)
+        self.broker.publish(account_topic(self.ident), account=self.ident, change='property', property=prop.name)
+        self.broker.publish(PROPERTIES_TOPIC, change='owner', property=prop.name, owner=self.ident)
 
     def withdraw(self, amount, log=True):
-        self.write_lock.acquire()
-        if amount > self.cash:
-            amount = self.cash
-            self.cash = 0
-        else:
+        """
+        Take up to amount from the account, emptying it rather than overdrawing it.
+        Returns the amount taken, raises ValueError for an amount the database can't store.
+        """
+        check_amount(amount)
+        with self.write_lock:
+            amount = min(amount, self.cash)
+            # The balance and its log entry are queued together so a snapshot can't split them.
+            # The balance only changes once they are saved, so a failed save leaves it as the database has it.
+            with self.tlog_connection.group() as receipt:
+                self.tlog_connection.adjust_account(self.ident, -amount)
+                if log:
+                    self.tlog_connection.log_account_withdraw(self.ident, amount)
+            receipt.wait()
             self.cash -= amount
-        self.write_lock.release()
-        self.tlog_connection.update_account(self.ident, self.cash)
-        self.account_update_trigger.set()
-        print(f'Event trigger from account {self.ident} withdraw')
-        if log:
-            self.tlog_connection.log_account_withdraw(self.ident, amount)
+        self.publish_balance('withdraw')
+        logger.debug('withdraw account=%s amount=%d', self.ident, amount)
         return amount
 
     def deposit(self, amount, log=True):
+        """
+        Pay amount into the account, nothing is paid unless it's positive.
+        Returns the amount paid, raises ValueError if the balance would go past MAX_CASH.
+        """
         if amount > 0:
-            self.write_lock.acquire()
-            self.cash += amount
-            self.write_lock.release()
-            self.tlog_connection.update_account(self.ident, self.cash)
-            self.account_update_trigger.set()
-            print(f'Event trigger from account {self.ident} deposit')
-            if log:
-                self.tlog_connection.log_account_deposit(self.ident, amount)
+            check_amount(amount)
+            with self.write_lock:
+                check_room(self, self.cash, amount)
+                with self.tlog_connection.group() as receipt:
+                    self.tlog_connection.adjust_account(self.ident, amount)
+                    if log:
+                        self.tlog_connection.log_account_deposit(self.ident, amount)
+                receipt.wait()
+                self.cash += amount
+            self.publish_balance('deposit')
+            logger.debug('deposit account=%s amount=%d', self.ident, amount)
         else:
             amount = 0
         return amount
 
+    def publish_balance(self, change):
+        """
+        Notify subscribers to this account and to the accounts list of a new balance.
+        """
+        self.broker.publish(account_topic(self.ident), account=self.ident, change=change, cash=self.cash)
+        self.broker.publish(ACCOUNTS_LIST_TOPIC, account=self.ident, change=change, cash=self.cash)
+
+    def adjust_cash(self, amount):
+        """
+        Change the balance in memory only.
+        The caller must hold write_lock and is responsible for recording
+        the change in the TLog.
+        """
+        self.cash += amount
+
     def get_transactions(self):
         return self.tlog_connection.log_get_by_id(self.ident)
 
+    def get_transaction_page(self, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Newest page of transactions older than the before cursor,
+        and the cursor for the page after it.
+        """
+        return self.tlog_connection.log_page_by_id(self.ident, before, limit)
+
 
 class AccountManager:
     """
     Manages all user accounts and interactions that happen between accounts.
     """
 
-    def __init__(self, prop_manager):
+    def __init__(self, prop_manager, hasher=None, lock_stripes=ACCOUNT_LOCK_STRIPES, db_filename='tlog.db', broker=None, game_id=None, shared=False):
         self.accounts_storage = dict()
+        # Name order and search index, kept in step with accounts_storage
+        self.index = AccountIndex()
+        # Balance of every account in accounts_storage, by account slot
+        self.balances = BalanceStore()
         self.prop_manager = prop_manager
-        self.server_update_signal = Event()
-        # Prevent race conditions by locking sections that write or change data.
-        self.write_lock = Lock()
-        self.tlog_connection = TransactionLog('tlog.db')
+        self.game_id = game_id
+        self.broker = UpdateBroker() if broker is None else broker
+        # A hasher passed in may be shared with other games, only close our own
+        self.owns_hasher = hasher is None
+        self.hasher = PasswordHasher() if hasher is None else hasher
+        # Prevent race conditions by locking sections that add, remove or reload accounts.
+        self.write_lock = TimedLock()
+        # Balances are guarded by striped locks, see lock_accounts
+        self.account_locks = [TimedLock() for _ in range(lock_stripes)]
+        # Guards who owns each property, taken after any account locks
+        self.property_lock = Lock()
+        # Net worth ranking, kept up to date by accounts and properties as they change
+        self.leaderboard = Leaderboard(self.broker)
+        self.prop_manager.on_worth_change = self.leaderboard.adjust
+        self.tlog_connection = TransactionLog(db_filename)
+        # When other processes use the same database it is the source of truth,
+        # and memory is a cache brought up to date by sync
+        self.shared = shared
+        self.shared_lock = RLock()
+        self.shared_depth = 0
+        self.seen_version = None
+        self.lock_file = open(f'{db_filename}.lock', 'a') if shared else None
         self.tlog_connection.log_server_started()
+        if shared:
+            self.seen_version = self.tlog_connection.data_version()
         self.load_saved()
-        # Ensure update signal starts cleared
-        self.recieved_update()
+        # Archiving can take a while on a long game, it isn't needed to serve it
+        self.archiver = Thread(target=self.archive_finished_sessions, daemon=True)
+        self.archiver.start()
 
     def load_saved(self):
+        """
+        Rebuild every account from the database.
+        The Accounts and Properties tables are kept current by every commit, so
+        nothing is replayed from the TLog. Snapshots are only kept for export.
+        """
+        # Properties not in the saved state belong to the bank
+        self.prop_manager.reset()
+        # A new store leaves out the slots of deleted accounts
+        store = BalanceStore()
+        loaded_accounts = self._load_accounts_table(store)
+        loaded_index = AccountIndex(loaded_accounts.values())
+        # Accounts are built before taking the lock so requests only wait for the swap
+        self.write_lock.acquire()
+        self.accounts_storage = loaded_accounts
+        self.balances = store
+        self.index = loaded_index
+        self.leaderboard.reset(loaded_accounts.values(), self.prop_manager)
+        self.write_lock.release()
+        self.broker.broadcast(change='reload')
+        logger.info('reloaded accounts=%d', len(loaded_accounts))
+        self.tlog_connection.log_accounts_reloaded()
+        return f'Loaded {len(self.accounts_storage)} account{"s" if len(self.accounts_storage) != 1 else ""} from database'
 
-        def property_init(p_raw):
-            prop = self.prop_manager.properties[p_raw['name']]
-            prop.load_attributes(p_raw)
-            return prop
+    def archive_finished_sessions(self):
+        """
+        Move the TLog rows of earlier sessions out of the live table into archive files.
+        A failed archive leaves the rows where they were.
+        Account history pages read on into the archives, so nothing disappears from them.
+        """
+        try:
+            # Other processes sharing the database could archive the same rows
+            with self.shared_write():
+                return self.tlog_connection.archive_finished_sessions()
+        except (OSError, TLogError):
+            logger.exception('archiving failed game=%s', self.game_id)
+            return 0
+
+    @contextmanager
+    def shared_write(self):
+        """
+        Make changes as the only writer among every process sharing the database.
+        Their changes are loaded first, and ours are committed before the next
+        process gets its turn. Requests that change a shared game run inside this.
+        Does nothing unless the database is shared.
+        """
+        if not self.shared:
+            yield
+            return
+        with self.shared_lock:
+            outermost = self.shared_depth == 0
+            if outermost:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.shared_depth += 1
+            try:
+                if outermost:
+                    self._sync_locked()
+                yield
+            finally:
+                self.shared_depth -= 1
+                if outermost:
+                    try:
+                        self.tlog_connection.flush()
+                        # No other process could commit while we held the file lock
+                        self.seen_version = self.tlog_connection.data_version()
+                    finally:
+                        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def sync(self):
+        """
+        Catch up with changes other processes committed to a shared database.
+        Returns whether anything was reloaded.
+        """
+        if not self.shared:
+            return False
+        # Waits for our own changes in progress, so they aren't overwritten before they commit
+        with self.shared_lock:
+            return self._sync_locked()
 
-        def deserialize_props(acc):
-            prop_raw = json.loads(acc[5])
-            props = set(map(property_init, prop_raw))
-            for p in props:
-                p.owner = acc[0]
-            return props
+    def _sync_locked(self):
+        version = self.tlog_connection.data_version()
+        if version == self.seen_version:
+            return False
+        self.seen_version = version
+        self._load_changes()
+        return True
 
-        account_tuples = self.tlog_connection.get_all_accounts()
+    def _load_changes(self):
+        """
+        Bring accounts and properties in line with the database and publish what changed.
+        """
+        rows = self.tlog_connection.read("SELECT id, name, salt, password_hash, cash, is_banker FROM Accounts")
+        saved_properties = {name: (owner, rent_index, mortgaged) for name, owner, rent_index, mortgaged in
+                            self.tlog_connection.read("SELECT name, owner, rent_index, mortgaged FROM Properties")}
+        changed, created = [], []
         self.write_lock.acquire()
-        self.accounts_storage = dict()
-        for acc in account_tuples:
-            self.accounts_storage[acc[0]] = Account(acc[0], acc[1], acc[2], acc[3], acc[4], deserialize_props(acc), acc[6], self.server_update_signal, self.tlog_connection, self.prop_manager)
+        stored = self.accounts_storage
+        for ident, name, salt, pw_hash, cash, is_banker in rows:
+            account = stored.get(ident)
+            if account is None:
+                account = Account(ident, name, salt, pw_hash, cash, set(), is_banker, self, self.balances)
+                stored[ident] = account
+                self.index.add(account)
+                created.append(account)
+                continue
+            account.pw_salt, account.pw_hash = salt, pw_hash
+            if account.cash != cash:
+                account.cash = cash
+                changed.append(account)
+        kept = {row[0] for row in rows}
+        deleted = [stored.pop(ident) for ident in list(stored) if ident not in kept]
+        for account in deleted:
+            self.index.remove(account)
+            self.leaderboard.remove(account.ident)
+        moved = []
+        for prop in self.prop_manager.all_properties:
+            # Properties without a saved row belong to the bank
+            owner, rent_index, mortgaged = saved_properties.get(prop.name, (None, 'Base', False))
+            if prop.owner != owner:
+                moved.append((prop, prop.owner))
+            prop.load_attributes({'owner': owner, 'rent_rate': rent_index, 'mortgaged': mortgaged})
+        # Saved buildings are kept, see _load_accounts_table
+        for color in self.prop_manager.complete_sets:
+            self.prop_manager.update_color_set_rent(color)
+        for prop, old_owner in moved:
+            for ident in (old_owner, prop.owner):
+                if ident in stored:
+                    stored[ident].properties = set(self.prop_manager.owned_by(ident))
+        for account in created:
+            self.leaderboard.add(account, self.prop_manager.worth_of(account.ident))
         self.write_lock.release()
-        self.server_update_signal.set()
-        print('Event trigger from load_saved')
-        self.tlog_connection.log_accounts_reloaded()
-        return f'Loaded {len(self.accounts_storage)} account{"s" if len(self.accounts_storage) != 1 else ""} from database'
+        for account in created:
+            self.broker.publish(ACCOUNTS_LIST_TOPIC, account=account.ident, change='new', cash=account.cash)
+        for account in changed:
+            account.publish_balance('sync')
+        for account in deleted:
+            self.broker.publish(account_topic(account.ident), account=account.ident, change='delete')
+            self.broker.publish(ACCOUNTS_LIST_TOPIC, account=account.ident, change='delete')
+        for prop, _ in moved:
+            self.broker.publish(PROPERTIES_TOPIC, change='owner', property=prop.name, owner=prop.owner)
+        logger.debug('synced created=%d changed=%d deleted=%d properties=%d', len(created), len(changed), len(deleted), len(moved))
+
+    @property
+    def lock_times(self):
+        """
+        Wait and hold time histograms of the manager lock and of every account lock together.
+        """
+        return {
+            'manager': (self.write_lock.wait, self.write_lock.hold),
+            'account': (Histogram.merged(lock.wait for lock in self.account_locks), Histogram.merged(lock.hold for lock in self.account_locks))
+        }
+
+    def lock_for(self, ident):
+        return self.account_locks[hash(ident) % len(self.account_locks)]
+
+    @contextmanager
+    def lock_accounts(self, idents):
+        """
+        Hold the locks of every given account.
+        Stripes are always taken in the same order so two callers can't deadlock.
+        """
+        stripes = sorted({hash(ident) % len(self.account_locks) for ident in idents})
+        for stripe in stripes:
+            self.account_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.account_locks[stripe].release()
+
+    def _load_accounts_table(self, store):
+        """
+        Build accounts from the Accounts and Properties tables, with their balances in store.
+        """
+        for name, owner, rent_index, mortgaged in self.tlog_connection.get_property_states():
+            self.prop_manager.properties[name].load_attributes({'owner': owner, 'rent_rate': rent_index, 'mortgaged': mortgaged})
+        # Sales save the rent index of their whole color set, but older databases only saved
+        # the property sold, so a complete set can be saved at Base. That and a broken set are
+        # all that is worked out here, saved houses and hotels are kept.
+        for color in self.prop_manager.complete_sets:
+            self.prop_manager.update_color_set_rent(color)
+        loaded_accounts = dict()
+        for ident, name, salt, pw_hash, cash, is_banker in self.tlog_connection.get_account_identities():
+            loaded_accounts[ident] = Account(ident, name, salt, pw_hash, cash, set(self.prop_manager.owned_by(ident)), is_banker, self, store)
+        return loaded_accounts
 
     def nuke_accounts(self):
         """
         Deletes all accounts.
         Used for starting a new game.
         """
-        self.accounts_storage = dict()
-        self.tlog_connection.nuke_tables()
+        with self.write_lock:
+            self.tlog_connection.nuke_tables().wait()
+            self.accounts_storage = dict()
+            self.balances = BalanceStore()
+            self.index = AccountIndex()
+            self.leaderboard.reset((), self.prop_manager)
+        self.broker.broadcast(change='nuke')
         return 'Deleted all account and transaction information.'
 
     def new(self, user_id, card_holder, password, starting_amount:int=1000) -> bool:
@@ -172,31 +447,70 @@ class AccountManager:
         Create a new account
 
         If no accounts exist, the first player to make a new account is the banker.
+        Raises ValueError for a starting amount the database can't store.
         """
-        pass_salt, pass_hash = hash_new_password(password)
-        self.write_lock.acquire()
-        if self.exists(user_id):
-            self.write_lock.release()
-            # f'ID "{user_id}" already associated with an account!'
-            return False
-        is_banker = len(self.accounts_storage) == 0
-        self.accounts_storage[user_id] = Account(user_id, card_holder, pass_salt, pass_hash, starting_amount, set(), is_banker,  self.server_update_signal, self.tlog_connection, self.prop_manager)
-        self.write_lock.release()
-        self.tlog_connection.create_account(user_id, card_holder, pass_salt, pass_hash, starting_amount, is_banker)
-        self.server_update_signal.set()
-        print('Event trigger from new account')
-        self.tlog_connection.log_account_created(user_id, starting_amount)
+        check_amount(starting_amount)
+        pass_salt, pass_hash = self.hasher.hash_new(password)
+        # Another process sharing the database may be creating the same ID
+        with self.shared_write():
+            with self.write_lock:
+                if self.exists(user_id):
+                    # f'ID "{user_id}" already associated with an account!'
+                    return False
+                is_banker = len(self.accounts_storage) == 0
+                with self.tlog_connection.group() as receipt:
+                    self.tlog_connection.create_account(user_id, card_holder, pass_salt, pass_hash, starting_amount, is_banker)
+                    self.tlog_connection.log_account_created(user_id, starting_amount)
+                receipt.wait()
+                self.accounts_storage[user_id] = Account(user_id, card_holder, pass_salt, pass_hash, starting_amount, set(), is_banker, self, self.balances)
+                self.index.add(self.accounts_storage[user_id])
+                self.leaderboard.add(self.accounts_storage[user_id], self.prop_manager.worth_of(user_id))
+        self.broker.publish(ACCOUNTS_LIST_TOPIC, account=user_id, change='new', cash=starting_amount)
+        logger.debug('new account=%s cash=%d', user_id, starting_amount)
         # f'Created new account for {card_holder}.'
         return True
 
-    def delete(self, user_id):
-        self.write_lock.acquire()
-        self.accounts_storage.pop(user_id)
-        self.write_lock.release()
-        self.tlog_connection.delete_account(user_id)
-        self.server_update_signal.set()
-        print('Event trigger from delete account')
-        self.tlog_connection.log_account_deleted(user_id)
+    def delete(self, user_id) -> bool:
+        """
+        Delete an account, its properties go back to the bank.
+        Returns False, writing nothing, if the account doesn't exist.
+        """
+        # Wait for money already moving in or out of the account
+        with self.write_lock, self.lock_accounts((user_id,)):
+            if not self.exists(user_id):
+                return False
+            with self.tlog_connection.group() as receipt:
+                self.tlog_connection.delete_account(user_id)
+                self.tlog_connection.log_account_deleted(user_id)
+            receipt.wait()
+            self.index.remove(self.accounts_storage.pop(user_id))
+            self.leaderboard.remove(user_id)
+            released = self.prop_manager.release(user_id)
+        self.broker.publish(account_topic(user_id), account=user_id, change='delete')
+        self.broker.publish(ACCOUNTS_LIST_TOPIC, account=user_id, change='delete')
+        for prop in released:
+            self.broker.publish(PROPERTIES_TOPIC, change='owner', property=prop.name, owner=None)
+        logger.debug('delete account=%s', user_id)
+        return True
+
+    def authenticate(self, user_id, password):
+        """
+        Check a login off the request thread.
+        Returns the account if the password matches, otherwise None.
+        Raises HasherBusy when too many logins are already being checked.
+        """
+        account = self.query(user_id)
+        if account == 'Account does not exist.':
+            return None
+        if not self.hasher.verify(account.pw_salt, account.pw_hash, password):
+            return None
+        if self.hasher.needs_upgrade(account.pw_hash):
+            pass_salt, pass_hash = self.hasher.hash_new(password)
+            account.write_lock.acquire()
+            account.pw_salt, account.pw_hash = pass_salt, pass_hash
+            self.tlog_connection.set_account_password(user_id, pass_salt, pass_hash)
+            account.write_lock.release()
+        return account
 
     def exists(self, user_id):
         return user_id in self.accounts_storage
@@ -210,47 +524,315 @@ class AccountManager:
             return self.accounts_storage[user_id]
         return 'Account does not exist.'
 
+    @property
+    def sorted_accounts(self):
+        """
+        Every account in name order.
+        """
+        return self.index.ordered()
+
     def search(self, query):
         """
         Do a fuzzy search for an account based on Real Name and ID information.
+        Matching accounts are returned in name order.
         """
-
-        def match_in_query(acc):
-            name_match = query.lower() in acc.name.lower()
-            id_match = query.lower() in acc.ident.lower()
-            return name_match or id_match
-
         if query.lower() in ('all', ''):
-            return self.accounts_storage
-        return { u:a for u, a in self.accounts_storage.items() if match_in_query(a)}
+            return {acc.ident: acc for acc in self.index.ordered()}
+        return {acc.ident: acc for acc in self.index.search(query)}
 
     def transfer(self, payer, payee, amount: int):
-        self.write_lock.acquire()
-        paying_account = self.query(payer)
-        if paying_account == 'Account does not exist.':
-            self.write_lock.release()
-            return f'Account for payer ID {payer} does not exist.'
-        if paying_account.cash < amount:
-            self.write_lock.release()
-            return f'{paying_account.name} does not have enough funds to complete the transaction.'
-        payee_account = self.query(payee)
-        if payee_account == 'Account does not exist.':
-            self.write_lock.release()
-            return f'Account for payer ID {payee_account} does not exist.'
-        paying_account.withdraw(amount, log=False)
-        payee_account.deposit(amount, log=False)
-        info = f'{paying_account.name} (${paying_account.cash}) paid {payee_account.name} (${payee_account.cash}) ${amount}.'
-        self.write_lock.release()
-        self.tlog_connection.update_account(payer, paying_account.cash)
-        self.tlog_connection.update_account(payee, payee_account.cash)
-        self.server_update_signal.set()
-        print('Event trigger from transfer')
-        self.tlog_connection.log_account_transfer(payer, payee, info)
+        try:
+            check_amount(amount)
+        except ValueError as invalid:
+            return str(invalid)
+        # Only the two accounts are locked, transfers between other accounts carry on
+        with self.lock_accounts((payer, payee)):
+            paying_account = self.query(payer)
+            if paying_account == 'Account does not exist.':
+                return f'Account for payer ID {payer} does not exist.'
+            if paying_account.cash < amount:
+                return f'{paying_account.name} does not have enough funds to complete the transaction.'
+            payee_account = self.query(payee)
+            if payee_account == 'Account does not exist.':
+                return f'Account for payee ID {payee} does not exist.'
+            try:
+                check_room(payee_account, payee_account.cash, amount)
+            except ValueError as invalid:
+                return str(invalid)
+            info = f'{paying_account.name} (${paying_account.cash - amount}) paid {payee_account.name} (${payee_account.cash + amount}) ${amount}.'
+            # Balances only change once the transfer is saved
+            self.tlog_connection.record_transfer(payer, payee, amount, info).wait()
+            paying_account.adjust_cash(-amount)
+            payee_account.adjust_cash(amount)
+        paying_account.publish_balance('transfer')
+        payee_account.publish_balance('transfer')
+        logger.debug('transfer payer=%s payee=%s amount=%d', payer, payee, amount)
         return info
 
-    def recieved_update(self):
-        self.server_update_signal.clear()
+    def buy_property(self, buyer, prop_name):
+        """
+        Sell a property from the bank to an account at its price, in one step.
+        Returns the price paid.
+        Raises ValueError when it can't be bought, nothing is changed then.
+        """
+        prop = self.prop_manager.properties.get(prop_name)
+        if prop is None:
+            raise ValueError(f'Property {prop_name} does not exist.')
+        if not isinstance(buyer, str):
+            raise ValueError(f'Account for buyer ID {buyer} does not exist.')
+        price = prop.costs['property']
+        check_amount(price)
+        with self.lock_accounts((buyer,)), self.property_lock:
+            account = self.accounts_storage.get(buyer)
+            if account is None:
+                raise ValueError(f'Account for buyer ID {buyer} does not exist.')
+            if prop.owner is not None:
+                raise ValueError(f'{prop.name} already belongs to {prop.owner}.')
+            if account.cash < price:
+                raise ValueError(f'{account.name} does not have enough funds to buy {prop.name}.')
+            # Saved before anything changes in memory so a failed save leaves the sale undone
+            with self.tlog_connection.group() as receipt:
+                self.tlog_connection.adjust_account(buyer, -price)
+                self.tlog_connection.log_account_withdraw(buyer, price)
+                self.queue_property_owner(prop, buyer)
+                self.tlog_connection.log_property_bought(buyer, prop.name)
+            receipt.wait()
+            account.adjust_cash(-price)
+            prop.owner = buyer
+            account.properties.add(prop)
+            self.prop_manager.update_color_set_rent(prop.color)
+        account.publish_balance('withdraw')
+        self.broker.publish(account_topic(buyer), account=buyer, change='property', property=prop.name)
+        self.broker.publish(PROPERTIES_TOPIC, change='owner', property=prop.name, owner=buyer)
+        logger.debug('buy account=%s property=%s amount=%d', buyer, prop.name, price)
+        return price
+
+    def queue_property_owner(self, prop, owner):
+        """
+        Queue the state of a property going to owner, with the rest of its color set
+        when that completes or breaks the set, so the saved rent indexes are never stale.
+        The caller holds property_lock and changes the property once the writes are saved.
+        """
+        rents = self.prop_manager.color_set_rents(prop, owner)
+        self.tlog_connection.set_property_state(prop.name, owner, rents.get(prop, prop.rent_rate_index), prop.mortgaged)
+        for other, rent_index in rents.items():
+            if other is not prop:
+                self.tlog_connection.set_property_state(other.name, other.owner, rent_index, other.mortgaged)
+
+    def pay_rent(self, payer, prop_name, dice=None):
+        """
+        Charge an account rent for landing on a property and pay it to the owner in one step.
+        Rent comes from the property manager's rent table, dice is the roll for utilities.
+        Returns the owner, the rent paid and the logged description.
+        Raises ValueError when no rent can be paid, nothing is changed then.
+        """
+        prop = self.prop_manager.properties.get(prop_name)
+        if prop is None:
+            raise ValueError(f'Property {prop_name} does not exist.')
+        owner = prop.owner
+        if owner is None:
+            raise ValueError(f'{prop.name} belongs to the bank, no rent is due.')
+        if owner == payer:
+            raise ValueError(f'{prop.name} belongs to the payer, no rent is due.')
+        with self.lock_accounts((payer, owner)):
+            # The property may have changed hands while waiting for the locks
+            if prop.owner != owner:
+                raise ValueError(f'{prop.name} just changed owner, try again.')
+            paying_account = self.accounts_storage.get(payer)
+            if paying_account is None:
+                raise ValueError(f'Account for payer ID {payer} does not exist.')
+            owning_account = self.accounts_storage.get(owner)
+            if owning_account is None:
+                raise ValueError(f'Account for owner ID {owner} does not exist.')
+            rent = self.prop_manager.rent_due(prop, dice)
+            if rent == 0:
+                raise ValueError(f'{prop.name} is mortgaged, no rent is due.')
+            if paying_account.cash < rent:
+                raise ValueError(f'{paying_account.name} does not have enough funds to pay ${rent} rent.')
+            check_amount(rent)
+            check_room(owning_account, owning_account.cash, rent)
+            info = f'{paying_account.name} (${paying_account.cash - rent}) paid {owning_account.name} (${owning_account.cash + rent}) ${rent} rent for {prop.name}.'
+            self.tlog_connection.record_transfer(payer, owner, rent, info).wait()
+            paying_account.adjust_cash(-rent)
+            owning_account.adjust_cash(rent)
+        paying_account.publish_balance('rent')
+        owning_account.publish_balance('rent')
+        logger.debug('rent payer=%s owner=%s property=%s amount=%d', payer, owner, prop.name, rent)
+        return owner, rent, info
+
+    def _check_operation(self, op, balances):
+        """
+        Work out the balance changes for one batch operation against the
+        balances of the operations before it.
+        Only accounts in balances can be used.
+        Returns the changes and the amount moved, or raises ValueError.
+        """
+        if not isinstance(op, dict):
+            raise ValueError('Operation must be an object.')
+        kind = op.get('op')
+        if kind not in ('deposit', 'withdraw', 'transfer'):
+            raise ValueError(f'Unknown operation {kind!r}, expected deposit, withdraw or transfer.')
+        amount = op.get('amount')
+        if type(amount) is not int or amount <= 0:
+            raise ValueError('Amount must be a positive whole number.')
+        check_amount(amount)
+        if kind in ('deposit', 'withdraw'):
+            ident = op.get('account')
+            if not isinstance(ident, str) or ident not in balances:
+                raise ValueError(f'Account for ID {ident} does not exist.')
+            if kind == 'deposit':
+                check_room(self.accounts_storage[ident], balances[ident], amount)
+                return {ident: amount}, amount
+            # Withdrawals empty the account rather than overdrawing it, like Account.withdraw
+            amount = min(amount, balances[ident])
+            return {ident: -amount}, amount
+        payer, payee = op.get('payer'), op.get('payee')
+        for ident in (payer, payee):
+            if not isinstance(ident, str) or ident not in balances:
+                raise ValueError(f'Account for ID {ident} does not exist.')
+        if payer == payee:
+            raise ValueError('Payer and payee must be different accounts.')
+        if balances[payer] < amount:
+            raise ValueError(f'{self.accounts_storage[payer].name} does not have enough funds to complete the transaction.')
+        check_room(self.accounts_storage[payee], balances[payee], amount)
+        return {payer: -amount, payee: amount}, amount
+
+    def batch(self, operations, atomic=True):
+        """
+        Run a list of deposit, withdraw and transfer operations holding the
+        locks of every account involved. They are logged as one group, so
+        they are written in one commit.
+
+        Operations are dicts like {'op': 'deposit', 'account': id, 'amount': 200}
+        or {'op': 'transfer', 'payer': id, 'payee': id, 'amount': 50}.
+        If atomic, nothing is applied unless every operation succeeds,
+        otherwise failed operations are skipped and the rest applied.
+        Returns whether everything was applied and a result per operation.
+        """
+        idents = set()
+        for op in operations:
+            if isinstance(op, dict):
+                idents.update(op.get(key) for key in ('account', 'payer', 'payee') if isinstance(op.get(key), str))
+        with self.lock_accounts(idents):
+            all_ok, results, touched = self._run_batch(operations, atomic, idents)
+        for acc in touched:
+            acc.publish_balance('batch')
+        return all_ok, results
+
+    def _run_batch(self, operations, atomic, idents):
+        accounts = {ident: self.accounts_storage[ident] for ident in idents if self.exists(ident)}
+        balances = {ident: acc.cash for ident, acc in accounts.items()}
+        results = []
+        applied = []
+        for op in operations:
+            try:
+                changes, amount = self._check_operation(op, balances)
+            except ValueError as error:
+                results.append({'ok': False, 'error': str(error)})
+                continue
+            for ident, change in changes.items():
+                balances[ident] += change
+            applied.append((op, changes, amount))
+            results.append({'ok': True, 'amount': amount})
+        all_ok = len(applied) == len(results)
+        if atomic and not all_ok:
+            for result in results:
+                if result['ok']:
+                    result.update(ok=False, error='Not applied, another operation in the batch failed.')
+            return False, results, ()
+        # Everything is saved before any balance changes, so a failed save leaves them untouched
+        balances = {ident: acc.cash for ident, acc in accounts.items()}
+        touched = dict()
+        with self.tlog_connection.group() as receipt:
+            for op, changes, amount in applied:
+                for ident, change in changes.items():
+                    touched[ident] = accounts[ident]
+                    balances[ident] += change
+                if op['op'] == 'transfer':
+                    payer, payee = touched[op['payer']], touched[op['payee']]
+                    info = f'{payer.name} (${balances[payer.ident]}) paid {payee.name} (${balances[payee.ident]}) ${amount}.'
+                    self.tlog_connection.record_transfer(payer.ident, payee.ident, amount, info)
+                else:
+                    ident = op['account']
+                    self.tlog_connection.adjust_account(ident, changes[ident])
+                    if op['op'] == 'deposit':
+                        self.tlog_connection.log_account_deposit(ident, amount)
+                    else:
+                        self.tlog_connection.log_account_withdraw(ident, amount)
+        receipt.wait()
+        for ident, acc in touched.items():
+            acc.adjust_cash(balances[ident] - acc.cash)
+        return all_ok, results, touched.values()
+
+    def bulk(self, op, amount, idents=None):
+        """
+        Change many balances the same way in one step, like paying everyone $200
+        or charging a 10% tax. The op is deposit or withdraw for an amount of
+        dollars, or percent for interest, with a negative percent for a tax.
+        Every account is changed when idents is None.
+        Withdrawals and taxes empty an account rather than overdrawing it, like Account.withdraw,
+        and percentages are rounded toward zero.
+        The new balances are worked out in one pass over the balance store and
+        checked before anything is logged, then logged as one group and written back together.
+        Returns the change made to each account, or raises ValueError.
+        """
+        if op not in BULK_OPERATIONS:
+            raise ValueError(f'Unknown operation {op!r}, expected deposit, withdraw or percent.')
+        if op == 'percent':
+            if type(amount) not in (int, float) or not math.isfinite(amount) or amount == 0 or amount < -100:
+                raise ValueError('Percent must be a number other than 0, and no less than -100.')
+        elif type(amount) is not int or amount <= 0:
+            raise ValueError('Amount must be a positive whole number.')
+        else:
+            check_amount(amount)
+        # The manager lock keeps accounts from being created or deleted part way through
+        with self.write_lock:
+            if idents is None:
+                accounts = list(self.accounts_storage.values())
+            else:
+                for ident in idents:
+                    if not isinstance(ident, str) or not self.exists(ident):
+                        raise ValueError(f'Account for ID {ident} does not exist.')
+                accounts = [self.accounts_storage[ident] for ident in dict.fromkeys(idents)]
+            with self.lock_accounts([acc.ident for acc in accounts]):
+                slots = [acc.slot for acc in accounts]
+                balances = self.balances.take(slots)
+                if op == 'deposit':
+                    changes = [amount] * len(slots)
+                elif op == 'withdraw':
+                    changes = [-min(amount, cash) for cash in balances]
+                else:
+                    # Exact, so large balances and percentages like 10.1 round the same as on paper
+                    rate = Fraction(str(amount)) / 100
+                    changes = [int(cash * rate) for cash in balances]
+                new_balances = [cash + change for cash, change in zip(balances, changes)]
+                for acc, cash in zip(accounts, new_balances):
+                    if cash > MAX_CASH:
+                        raise ValueError(f'{acc.name} can hold no more than ${MAX_CASH}.')
+                # Everything is saved before any balance changes, so a failed save leaves them untouched
+                with self.tlog_connection.group() as receipt:
+                    for acc, change in zip(accounts, changes):
+                        if change > 0:
+                            self.tlog_connection.adjust_account(acc.ident, change)
+                            self.tlog_connection.log_account_deposit(acc.ident, change)
+                        elif change < 0:
+                            self.tlog_connection.adjust_account(acc.ident, change)
+                            self.tlog_connection.log_account_withdraw(acc.ident, -change)
+                receipt.wait()
+                self.balances.put(slots, new_balances)
+                changed = {acc.ident: change for acc, change in zip(accounts, changes) if change}
+                self.leaderboard.adjust_many(changed)
+        for acc in accounts:
+            if acc.ident in changed:
+                acc.publish_balance('bulk')
+        logger.debug('bulk op=%s amount=%s accounts=%d', op, amount, len(changed))
+        return changed
 
     def cleanup(self):
         yield '\nStarting cleanup'
+        if self.owns_hasher:
+            self.hasher.close()
+        self.archiver.join()
         yield from self.tlog_connection.stop_db()
+        if self.lock_file is not None:
+            self.lock_file.close()
@@ -0,0 +1,38 @@
+from array import array
+
+
+class BalanceStore:
+    """
+    Balances of every account of a game in one array of whole dollars.
+    An account keeps its slot in the array, see Account.
+    Slots of deleted accounts aren't reused until the accounts are reloaded
+    into a new store, so an account kept past its deletion never sees another's balance.
+    """
+    def __init__(self):
+        self.balances = array('q')
+
+    def __len__(self):
+        return len(self.balances)
+
+    def add(self, cash):
+        """
+        Give a new account a slot holding its balance and return the slot.
+        """
+        self.balances.append(cash)
+        return len(self.balances) - 1
+
+    def take(self, slots):
+        """
+        The balances at the given slots, in the same order.
+        """
+        balances = self.balances
+        return [balances[slot] for slot in slots]
+
+    def put(self, slots, balances):
+        """
+        Write a new balance to each slot in one step.
+        The caller holds the locks of every account involved.
+        """
+        stored = self.balances
+        for slot, cash in zip(slots, balances):
+            stored[slot] = cash
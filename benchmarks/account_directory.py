@@ -0,0 +1,86 @@
+"""
+Accounts directory and search cost with a league-sized bank.
+
+The old directory sorted every account by name on each request and search
+lowercased and scanned every account. Both are compared against the
+AccountIndex kept by AccountManager, along with the cost of keeping the
+index up to date as accounts are created and deleted.
+
+Run from the repository root:
+    python benchmarks/account_directory.py
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_index import AccountIndex
+from account_store import Account
+
+ACCOUNTS = 10000
+REPEATS = 50
+QUERIES = ('a', 'er', 'smi', 'player12', 'jonathan', 'zzzz')
+
+
+def make_accounts():
+    rng = random.Random(0)
+    first = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Jonathan', 'Mallory', 'Oscar']
+    last = ['Smith', 'Jones', 'Baker', 'Miller', 'Garcia', 'Lee', 'Walker', 'Young']
+    accounts = dict()
+    for i in range(ACCOUNTS):
+        name = f'{rng.choice(first)} {rng.choice(last)} {"".join(rng.choices(string.ascii_lowercase, k=4))}'
+        ident = f'player{i}'
+        accounts[ident] = Account(ident, name, b'', b'', 1500, set(), False)
+    return accounts
+
+
+def old_search(storage, query):
+    def match_in_query(acc):
+        name_match = query.lower() in acc.name.lower()
+        id_match = query.lower() in acc.ident.lower()
+        return name_match or id_match
+    return sorted({u: a for u, a in storage.items() if match_in_query(a)}.values(), key=lambda a: a.name)
+
+
+def timed_ms(func):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func()
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+def run():
+    storage = make_accounts()
+    start = time.perf_counter()
+    index = AccountIndex(storage.values())
+    results = {'index build ms': (time.perf_counter() - start) * 1000}
+    results['directory sort ms'] = timed_ms(lambda: sorted(storage.values(), key=lambda a: a.name))
+    results['directory index ms'] = timed_ms(index.ordered)
+    for query in QUERIES:
+        expected = [a.ident for a in old_search(storage, query)]
+        found = [a.ident for a in index.search(query)]
+        # Ties in name are ordered by ID in the index, compare as sets
+        assert sorted(expected) == sorted(found), query
+        results[f'search {query!r} scan ms'] = timed_ms(lambda: old_search(storage, query))
+        results[f'search {query!r} index ms'] = timed_ms(lambda: index.search(query))
+    extra = list(make_accounts().values())[:1000]
+    for acc in extra:
+        acc.ident = f'extra-{acc.ident}'
+    start = time.perf_counter()
+    for acc in extra:
+        index.add(acc)
+        # The directory is rendered after each new account
+        index.ordered()
+    for acc in extra:
+        index.remove(acc)
+    results['add and remove ms each'] = (time.perf_counter() - start) / (2 * len(extra)) * 1000
+    return results
+
+
+if __name__ == '__main__':
+    print(f'Directory with {ACCOUNTS} accounts:')
+    for name, value in run().items():
+        print(f'\t{name}: {value:.3f}')
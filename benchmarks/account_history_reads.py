@@ -0,0 +1,90 @@
+"""
+Individual account page latency with many concurrent viewers.
+
+Each viewer thread loads an account's transaction history the same way
+the /accounts/<ident> page does, while a writer keeps logging deposits.
+Reads through the read-only connection pool are compared against reads
+queued on the TLog listener.
+
+Run from the repository root:
+    python benchmarks/account_history_reads.py
+"""
+import os
+import sys
+import tempfile
+import time
+from statistics import quantiles
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tlog import TransactionLog
+
+VIEWERS = 50
+VIEWS_PER_VIEWER = 20
+HISTORY_LENGTH = 500
+
+
+def percentiles(samples):
+    cuts = quantiles(samples, n=100)
+    return {'p50 ms': cuts[49] * 1000, 'p99 ms': cuts[98] * 1000}
+
+
+def measure_views(tlog, consistent):
+    latencies = []
+
+    def viewer():
+        for _ in range(VIEWS_PER_VIEWER):
+            start = time.perf_counter()
+            tlog.read(
+                "SELECT time, type, account, info FROM TLog WHERE account=? ORDER BY time, id",
+                ('viewed',),
+                consistent=consistent
+            )
+            latencies.append(time.perf_counter() - start)
+
+    threads = [Thread(target=viewer) for _ in range(VIEWERS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    result = percentiles(latencies)
+    result['views per second'] = len(latencies) / elapsed
+    return result
+
+
+def run():
+    with tempfile.TemporaryDirectory() as tmp:
+        tlog = TransactionLog(os.path.join(tmp, 'bench.db'))
+        for i in range(HISTORY_LENGTH):
+            tlog.log_account_deposit('viewed', i)
+        # Wait for the history to be written before measuring
+        tlog.read("SELECT 1", consistent=True)
+
+        stop_writing = Event()
+
+        def background_writes():
+            while not stop_writing.is_set():
+                tlog.log_account_deposit('other', 1)
+                time.sleep(0.001)
+
+        writer = Thread(target=background_writes)
+        writer.start()
+        results = {
+            'read pool': measure_views(tlog, consistent=False),
+            'listener queue': measure_views(tlog, consistent=True)
+        }
+        stop_writing.set()
+        writer.join()
+        for _ in tlog.stop_db():
+            pass
+    return results
+
+
+if __name__ == '__main__':
+    for mode, stats in run().items():
+        print(f'{mode} ({VIEWERS} viewers):')
+        for name, value in stats.items():
+            print(f'\t{name}: {value:.2f}')
@@ -0,0 +1,75 @@
+"""
+Fan-out latency from one published change to many subscribers.
+
+500 subscriber threads each wait on their own subscription, the way /bruh
+streams do. Every subscriber listens to the accounts list, and one in ten
+also follows a single account page, so account-only changes reach just
+the subscribers that asked for them.
+
+Run from the repository root:
+    python benchmarks/broker_fanout.py
+"""
+import os
+import sys
+import time
+from statistics import quantiles
+from threading import Barrier, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import ACCOUNTS_LIST_TOPIC, UpdateBroker, account_topic
+
+SUBSCRIBERS = 500
+MESSAGES = 50
+
+
+def percentiles(samples):
+    cuts = quantiles(samples, n=100)
+    return {'p50 ms': cuts[49] * 1000, 'p99 ms': cuts[98] * 1000, 'deliveries': len(samples)}
+
+
+def measure(topic):
+    broker = UpdateBroker()
+    latencies = {ACCOUNTS_LIST_TOPIC: [], account_topic('watched'): []}
+    ready = Barrier(SUBSCRIBERS + 1)
+
+    def subscriber(topics):
+        with broker.subscribe(topics) as subscription:
+            ready.wait()
+            while True:
+                message = subscription.get()
+                if message.get('change') == 'stop':
+                    return
+                latencies[message['topic']].append(time.perf_counter() - message['sent'])
+
+    threads = []
+    for i in range(SUBSCRIBERS):
+        topics = [ACCOUNTS_LIST_TOPIC]
+        if i % 10 == 0:
+            topics.append(account_topic('watched'))
+        threads.append(Thread(target=subscriber, args=(topics,)))
+    for t in threads:
+        t.start()
+    ready.wait()
+    for _ in range(MESSAGES):
+        broker.publish(topic, change='deposit', sent=time.perf_counter())
+        # Let subscribers drain so each message is measured on its own
+        time.sleep(0.01)
+    broker.broadcast(change='stop')
+    for t in threads:
+        t.join()
+    return percentiles(latencies[topic])
+
+
+def run():
+    return {
+        'accounts-list topic': measure(ACCOUNTS_LIST_TOPIC),
+        'single account topic': measure(account_topic('watched'))
+    }
+
+
+if __name__ == '__main__':
+    for topic, stats in run().items():
+        print(f'{topic} ({SUBSCRIBERS} subscribers):')
+        for name, value in stats.items():
+            print(f'\t{name}: {value:.2f}')
@@ -0,0 +1,72 @@
+"""
+AccountManager startup and reload time against a long-running game.
+
+A database with 100k logged transactions is built once, then accounts are
+loaded from the Accounts and Properties tables, which don't grow with the TLog.
+The loaded balances must match the ones in memory before the reload.
+
+Run from the repository root:
+    python benchmarks/cold_start.py
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import AccountManager
+from property_manger import PropertyManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAYERS = 8
+TRANSACTIONS = 100000
+
+
+def build_game(prop_manager):
+    accounts = AccountManager(prop_manager)
+    players = [f'player{i}' for i in range(PLAYERS)]
+    for ident in players:
+        accounts.new(ident, ident, 'password', 1500)
+    random.seed(0)
+    for _ in range(TRANSACTIONS // 2):
+        accounts.query(random.choice(players)).deposit(random.randint(1, 200))
+        accounts.transfer(*random.sample(players, 2), 1)
+    return accounts
+
+
+def timed_load(accounts):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        accounts.load_saved()
+    return (time.perf_counter() - start) * 1000
+
+
+def run():
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            prop_manager = PropertyManager(os.path.join(REPO_DIR, 'property_set.json'))
+            # Silence the per-transaction prints while filling the log
+            with contextlib.redirect_stdout(io.StringIO()):
+                accounts = build_game(prop_manager)
+            expected = {ident: acc.cash for ident, acc in accounts.accounts_storage.items()}
+            results['accounts table ms'] = timed_load(accounts)
+            results['balances match'] = {ident: acc.cash for ident, acc in accounts.accounts_storage.items()} == expected
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in accounts.cleanup():
+                    pass
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+if __name__ == '__main__':
+    print(f'Loading {PLAYERS} accounts with {TRANSACTIONS} transactions:')
+    for name, value in run().items():
+        print(f'\t{name}: {value:.2f}' if isinstance(value, float) else f'\t{name}: {value}')
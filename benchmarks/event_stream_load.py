@@ -0,0 +1,87 @@
+"""
+Hold thousands of idle event streams open on EventStreamServer.
+
+Opens 2,000 concurrent /bruh streams, publishes one change and measures
+how long it takes to reach every stream. Also checks that connections over
+the cap are refused and that closed clients are reaped, all while the
+server runs on a single thread.
+
+Run from the repository root:
+    python benchmarks/event_stream_load.py
+"""
+import asyncio
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import UpdateBroker, account_topic
+from event_stream import EventStreamServer
+
+STREAMS = 2000
+
+
+async def open_stream(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET /bruh?topics={account_topic("player")} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    status = await reader.readline()
+    await reader.readuntil(b'\r\n\r\n')
+    return status, reader, writer
+
+
+async def wait_for_message(reader):
+    while True:
+        line = await reader.readline()
+        if line.startswith(b'data:'):
+            return time.perf_counter()
+
+
+async def load_test(server, broker):
+    results = {}
+    start = time.perf_counter()
+    streams = await asyncio.gather(*(open_stream(server.port) for _ in range(STREAMS)))
+    results['connect all s'] = time.perf_counter() - start
+    results['open streams'] = server.active_connections
+    results['server threads'] = threading.active_count() - 1
+
+    status, reader, writer = await open_stream(server.port)
+    results['over cap status'] = status.decode().split(' ', 1)[1].strip()
+    writer.close()
+
+    waiting = [asyncio.ensure_future(wait_for_message(r)) for _, r, _ in streams]
+    await asyncio.sleep(0.1)
+    sent = time.perf_counter()
+    broker.publish(account_topic('player'), change='deposit', cash=1)
+    received = await asyncio.gather(*waiting)
+    results['fan-out to all ms'] = (max(received) - sent) * 1000
+
+    for _, _, w in streams[:STREAMS // 2]:
+        w.close()
+    await asyncio.sleep(0.5)
+    results['open after half closed'] = server.active_connections
+    for _, _, w in streams[STREAMS // 2:]:
+        w.close()
+    return results
+
+
+def run():
+    # Each stream needs a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, STREAMS * 2 + 100)), hard))
+    broker = UpdateBroker()
+    server = EventStreamServer(broker, port=0, max_connections=STREAMS)
+    server.start()
+    try:
+        return asyncio.run(load_test(server, broker))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(f'{STREAMS} concurrent event streams:')
+    for name, value in run().items():
+        print(f'\t{name}: {value:.2f}' if isinstance(value, float) else f'\t{name}: {value}')
@@ -0,0 +1,115 @@
+"""
+Login throughput and latency of other requests during a login storm.
+
+100 clients log in at once while a few others keep making transfers and
+loading account history. Hashing on the request threads is compared
+against the PasswordHasher process pool, along with how many logins the
+bounded queue turned away.
+
+Run from the repository root:
+    python benchmarks/login_load.py
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from statistics import quantiles
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import AccountManager
+from passwords import HasherBusy, PasswordHasher
+from property_manger import PropertyManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGINS = 100
+OTHER_CLIENTS = 4
+PLAYERS = 8
+
+
+def percentile_ms(samples, p):
+    if len(samples) < 2:
+        return samples[0] * 1000 if samples else 0.0
+    return quantiles(samples, n=100)[p - 1] * 1000
+
+
+def measure(hasher):
+    prop_manager = PropertyManager(os.path.join(REPO_DIR, 'property_set.json'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        accounts = AccountManager(prop_manager, hasher)
+        accounts.nuke_accounts()
+        players = [f'player{i}' for i in range(PLAYERS)]
+        for ident in players:
+            accounts.new(ident, ident, 'password', 1500)
+
+    login_times = []
+    other_times = []
+    busy = []
+    storm_over = Event()
+
+    def login(n):
+        start = time.perf_counter()
+        try:
+            accounts.authenticate(players[n % PLAYERS], 'password')
+        except HasherBusy:
+            busy.append(n)
+            return
+        login_times.append(time.perf_counter() - start)
+
+    def other_requests(n):
+        payer, payee = players[n], players[n + 1]
+        while not storm_over.is_set():
+            start = time.perf_counter()
+            accounts.transfer(payer, payee, 1)
+            accounts.transfer(payee, payer, 1)
+            accounts.query(payer).get_transaction_page()
+            other_times.append(time.perf_counter() - start)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        others = [Thread(target=other_requests, args=(n,)) for n in range(OTHER_CLIENTS)]
+        for t in others:
+            t.start()
+        logins = [Thread(target=login, args=(n,)) for n in range(LOGINS)]
+        start = time.perf_counter()
+        for t in logins:
+            t.start()
+        for t in logins:
+            t.join()
+        elapsed = time.perf_counter() - start
+        storm_over.set()
+        for t in others:
+            t.join()
+        for _ in accounts.cleanup():
+            pass
+    return {
+        'logins per second': len(login_times) / elapsed,
+        'login p99 ms': percentile_ms(login_times, 99),
+        'logins turned away': len(busy),
+        'other requests': len(other_times),
+        'other p50 ms': percentile_ms(other_times, 50),
+        'other p99 ms': percentile_ms(other_times, 99),
+    }
+
+
+def run():
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            results['request threads'] = measure(PasswordHasher(workers=0, max_pending=LOGINS))
+            results['process pool'] = measure(PasswordHasher())
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+if __name__ == '__main__':
+    print(f'{LOGINS} concurrent logins with {OTHER_CLIENTS} other clients:')
+    for mode, stats in run().items():
+        print(f'{mode}:')
+        for name, value in stats.items():
+            print(f'\t{name}: {value:.2f}' if isinstance(value, float) else f'\t{name}: {value}')
@@ -0,0 +1,362 @@
+"""
+Benchmark suite for the bank's hot paths, runs offline against temporary databases.
+
+Covers raw TransactionLog write and read throughput, AccountManager.transfer
+under concurrent threads, login through PBKDF2, rendering /accounts/ and
+/accounts/<ident> as the TLog grows, and SSE fan-out latency from a deposit
+to many subscribers. Each benchmark is run a few times and the median of
+every metric is kept. Tail latencies are left out, with threads sharing
+a CPU they vary too much between runs to catch regressions.
+
+Results are printed and can be written as JSON. They are compared against
+benchmarks/baseline.json, and the exit status is 1 when a metric is worse
+than the baseline by more than the tolerance. Metrics ending in "per s" are
+better higher, every other metric is better lower. Baselines are only
+comparable on the machine they were recorded on, against another machine
+regressions are reported but only fail the run with --strict.
+
+Run from the repository root:
+    python benchmarks/run.py
+    python benchmarks/run.py --only tlog transfer --output results.json
+    python benchmarks/run.py --update-baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from statistics import median, quantiles
+from threading import Barrier, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import AccountManager
+from broker import account_topic
+from passwords import PasswordHasher
+from property_manger import PropertyManager
+from tlog import TransactionLog
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROPERTY_SET = os.path.join(REPO_DIR, 'property_set.json')
+BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+REPEATS = 5
+# Fraction a metric may be worse than the baseline before it counts as a regression,
+# loose enough for a laptop that is doing other things
+TOLERANCE = 0.5
+
+TLOG_WRITES = 20000
+TLOG_READS = 2000
+TRANSFER_THREADS = 8
+TRANSFERS_PER_THREAD = 1000
+TRANSFER_ACCOUNTS = 16
+LOGINS = 8
+RENDER_HISTORY = (100, 10000)
+RENDER_ACCOUNTS = 50
+RENDERS = 200
+FANOUT_SUBSCRIBERS = 200
+FANOUT_DEPOSITS = 50
+
+
+def percentile_ms(samples, p):
+    return quantiles(samples, n=100)[p - 1] * 1000
+
+
+def fast_hasher():
+    """
+    Hashing that costs next to nothing, for benchmarks that only need accounts to exist.
+    """
+    return PasswordHasher(workers=0, iterations=1)
+
+
+@contextlib.contextmanager
+def account_manager(hasher=None, broker=None):
+    """
+    An AccountManager on an empty database, with its start up chatter silenced.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        accounts = AccountManager(PropertyManager(PROPERTY_SET), hasher or fast_hasher(), broker=broker)
+        accounts.nuke_accounts()
+    try:
+        yield accounts
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in accounts.cleanup():
+                pass
+
+
+def bench_tlog():
+    tlog = TransactionLog('tlog.db')
+    try:
+        start = time.perf_counter()
+        for i in range(TLOG_WRITES):
+            tlog.log_account_deposit(f'player{i % 10}', 5)
+        # A consistent read waits for every queued write to commit
+        tlog.read('SELECT COUNT(*) FROM TLog', consistent=True)
+        write_time = time.perf_counter() - start
+
+        read_times = []
+        for i in range(TLOG_READS):
+            start = time.perf_counter()
+            tlog.log_page_by_id(f'player{i % 10}')
+            read_times.append(time.perf_counter() - start)
+    finally:
+        tlog.stop_db()
+    return {
+        'writes per s': TLOG_WRITES / write_time,
+        'history reads per s': TLOG_READS / sum(read_times)
+    }
+
+
+def bench_transfer():
+    with account_manager() as accounts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(TRANSFER_ACCOUNTS):
+                accounts.new(f'player{i}', 'Player', 'password', 100000)
+            latencies = []
+
+            def worker(n):
+                for i in range(TRANSFERS_PER_THREAD):
+                    payer = f'player{(n + i) % TRANSFER_ACCOUNTS}'
+                    payee = f'player{(n * 3 + i + 1) % TRANSFER_ACCOUNTS}'
+                    start = time.perf_counter()
+                    accounts.transfer(payer, payee, 1)
+                    latencies.append(time.perf_counter() - start)
+
+            threads = [Thread(target=worker, args=(n,)) for n in range(TRANSFER_THREADS)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+        assert sum(acc.cash for acc in accounts.accounts_storage.values()) == TRANSFER_ACCOUNTS * 100000
+    return {
+        'transfers per s': len(latencies) / elapsed,
+        'transfer p50 ms': percentile_ms(latencies, 50)
+    }
+
+
+def bench_login():
+    results = {}
+    for label, hasher in (('inline', PasswordHasher(workers=0)), ('pool', PasswordHasher())):
+        with account_manager(hasher) as accounts:
+            with contextlib.redirect_stdout(io.StringIO()):
+                accounts.new('player', 'Player', 'password')
+            # The first pool login also starts a worker process
+            accounts.authenticate('player', 'password')
+            times = []
+            for _ in range(LOGINS):
+                start = time.perf_counter()
+                assert accounts.authenticate('player', 'password') is not None
+                times.append(time.perf_counter() - start)
+            hasher.close()
+        results[f'{label} login ms'] = median(times) * 1000
+    return results
+
+
+def render_app(user):
+    """
+    A bare Flask app that can render the server's templates outside a running server,
+    with every request logged in as the user.
+    """
+    from flask import Flask
+    from flask_login import LoginManager
+
+    app = Flask('server', root_path=REPO_DIR)
+    app.secret_key = 'benchmark'
+    login_manager = LoginManager()
+    login_manager.init_app(app)
+    login_manager.request_loader(lambda request: user)
+    # The account page links to its history API
+    app.add_url_rule('/accounts/<ident>/transactions', 'account_transactions_api', lambda ident: '')
+    return app
+
+
+def bench_render():
+    from server import render_generic, urlify
+
+    results = {}
+    for history in RENDER_HISTORY:
+        with account_manager() as accounts:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(RENDER_ACCOUNTS):
+                    accounts.new(f'player{i}', f'Player {i}', 'password', 1500)
+                # The first account is the banker, who sees the most on each page
+                player = accounts.query('player0')
+                app = render_app(player)
+                tlog = accounts.tlog_connection
+                for i in range(history):
+                    tlog.log_account_deposit('player0' if i % 2 else f'player{i % RENDER_ACCOUNTS}', 1)
+            tlog.read('SELECT COUNT(*) FROM TLog', consistent=True)
+
+            with app.test_request_context('/accounts/'):
+                start = time.perf_counter()
+                for _ in range(RENDERS):
+                    render_generic('accounts.html.jinja', make_url=urlify, num_accs=accounts.num_accounts, lookup=accounts.sorted_accounts)
+                results[f'accounts page at {history} rows ms'] = (time.perf_counter() - start) / RENDERS * 1000
+
+            with app.test_request_context('/accounts/player0'):
+                start = time.perf_counter()
+                for _ in range(RENDERS):
+                    # The page reads the newest history on every render
+                    account_log, older_cursor = player.get_transaction_page()
+                    render_generic('individual_account.html.jinja', acc=player, account_log=account_log, older_cursor=older_cursor, make_url=urlify)
+                results[f'account page at {history} rows ms'] = (time.perf_counter() - start) / RENDERS * 1000
+    return results
+
+
+def bench_fanout():
+    with account_manager() as accounts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            accounts.new('player', 'Player', 'password', 1500)
+        player = accounts.query('player')
+        broker = accounts.broker
+        ready = Barrier(FANOUT_SUBSCRIBERS + 1)
+        received = [[] for _ in range(FANOUT_DEPOSITS)]
+
+        def subscriber():
+            with broker.subscribe([account_topic('player')]) as subscription:
+                ready.wait()
+                for n in range(FANOUT_DEPOSITS):
+                    subscription.get()
+                    received[n].append(time.perf_counter())
+
+        threads = [Thread(target=subscriber) for _ in range(FANOUT_SUBSCRIBERS)]
+        for t in threads:
+            t.start()
+        ready.wait()
+        latencies = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for n in range(FANOUT_DEPOSITS):
+                sent = time.perf_counter()
+                player.deposit(1)
+                # Wait for everyone, so each deposit is measured on its own
+                while len(received[n]) < FANOUT_SUBSCRIBERS:
+                    time.sleep(0.001)
+                latencies.append(max(received[n]) - sent)
+        for t in threads:
+            t.join()
+    return {
+        'deposit to all p50 ms': percentile_ms(latencies, 50),
+        'deposit to all mean ms': sum(latencies) / len(latencies) * 1000
+    }
+
+
+BENCHMARKS = {
+    'tlog': bench_tlog,
+    'transfer': bench_transfer,
+    'login': bench_login,
+    'render': bench_render,
+    'fanout': bench_fanout
+}
+
+
+def run(names=None, repeats=REPEATS):
+    """
+    Run each benchmark in a fresh scratch directory and keep the median of each metric.
+    """
+    results = {}
+    cwd = os.getcwd()
+    try:
+        for name in names or BENCHMARKS:
+            runs = []
+            for _ in range(repeats):
+                with tempfile.TemporaryDirectory() as workdir:
+                    os.chdir(workdir)
+                    runs.append(BENCHMARKS[name]())
+                    os.chdir(cwd)
+            results[name] = {metric: median(r[metric] for r in runs) for metric in runs[0]}
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def machine():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith('per s')
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Metrics worse than the baseline by more than the tolerance,
+    as (benchmark, metric, baseline value, new value).
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if old is None:
+                continue
+            if higher_is_better(metric):
+                worse = value < old / (1 + tolerance)
+            else:
+                worse = value > old * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bank\'s hot paths.')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help='benchmarks to run, all by default')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--update-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--strict', action='store_true', help='fail on regressions against a baseline from another machine too')
+    args = parser.parse_args()
+
+    results = run(args.only, args.repeats)
+    report = {'machine': machine(), 'results': results}
+    for name, metrics in results.items():
+        print(f'{name}:')
+        for metric, value in metrics.items():
+            print(f'\t{metric}: {value:.3f}')
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+    if args.update_baseline:
+        baseline = {'machine': machine(), 'results': dict()}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as saved:
+                baseline = json.load(saved)
+        # Benchmarks left out with --only keep their old baseline
+        baseline['machine'] = machine()
+        baseline['results'].update(results)
+        with open(args.baseline, 'w') as out:
+            json.dump(baseline, out, indent=2)
+            out.write('\n')
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against, save one with --update-baseline')
+        return 0
+
+    with open(args.baseline) as saved:
+        baseline = json.load(saved)
+    same_machine = baseline.get('machine') == machine()
+    if not same_machine:
+        print('Baseline was recorded on a different machine, differences may not be regressions')
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for name, metric, old, new in regressions:
+        print(f'REGRESSION {name} {metric}: {old:.3f} -> {new:.3f}')
+    if not regressions:
+        print(f'No regressions against {args.baseline}')
+    return 1 if regressions and (same_machine or args.strict) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+Headless game simulations, for load and scaling tests without Flask.
+
+Each game gets its own temporary database, AccountManager and
+PropertyManager, and a thread per player making random purchases, rent
+payments, transfers and passes of Go at the same time. Purchases race each
+other and often try properties already sold, which must be refused.
+Every few rounds the players stop and the game is checked:
+    money is only created by passing Go and only destroyed by buying from the bank,
+    no balance is negative,
+    every property has at most one owner and its owner's account lists it,
+    the leaderboard matches net worth counted from scratch,
+    the database agrees with memory, and a reload changes nothing.
+Games run in parallel across a process pool. Throughput, latency of the
+operations, time spent waiting on locks and TLog commit sizes are reported
+for the whole sweep, along with any broken invariants and the seed of their game.
+The exit status is 1 if any invariant was broken.
+
+Run from the repository root:
+    python benchmarks/simulate.py
+    python benchmarks/simulate.py --games 1000 --processes 8
+    python benchmarks/simulate.py --games 1 --seed 1234 --rounds 50
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from statistics import quantiles
+from threading import Barrier, Lock, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import AccountManager
+from passwords import PasswordHasher
+from property_manger import PropertyManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROPERTY_SET = os.path.join(REPO_DIR, 'property_set.json')
+GAMES = 1000
+PLAYERS = 4
+# Checks happen between rounds, each player makes ACTIONS_PER_ROUND moves a round
+ROUNDS = 10
+ACTIONS_PER_ROUND = 10
+STARTING_CASH = 1500
+PASS_GO = 200
+# Chance a check is followed by reloading every account from the database
+RELOAD_CHANCE = 0.3
+OPERATIONS = ('transfer', 'buy_property', 'pay_rent', 'deposit')
+
+
+class SimulatedGame:
+    """
+    One game on its own database, with the money the bank has put in and taken out.
+    """
+    def __init__(self, seed, db_filename, players=PLAYERS):
+        self.seed = seed
+        self.prop_manager = PropertyManager(PROPERTY_SET)
+        self.accounts = AccountManager(self.prop_manager, PasswordHasher(workers=0, iterations=1), db_filename=db_filename)
+        self.players = [f'player{i}' for i in range(players)]
+        for ident in self.players:
+            self.accounts.new(ident, ident.title(), 'password', STARTING_CASH)
+        self.money_supply = STARTING_CASH * players
+        # Only guards the money_supply count, purchases and deposits aren't serialised by it
+        self.bank_lock = Lock()
+        self.refused_purchases = 0
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.violations = []
+
+    def timed(self, op, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.latencies[op].append(time.perf_counter() - start)
+        return result
+
+    def play(self, ident, rng, actions):
+        for _ in range(actions):
+            roll = rng.randint(1, 6) + rng.randint(1, 6)
+            choice = rng.random()
+            if choice < 0.1:
+                with self.bank_lock:
+                    self.money_supply += self.timed('deposit', self.accounts.query(ident).deposit, PASS_GO)
+            elif choice < 0.35:
+                self.buy(ident, rng)
+            elif choice < 0.7:
+                owned = self.prop_manager.owned
+                if owned:
+                    with contextlib.suppress(ValueError):
+                        self.timed('pay_rent', self.accounts.pay_rent, ident, rng.choice(owned).name, roll)
+            else:
+                payee = rng.choice(self.players)
+                if payee != ident:
+                    self.timed('transfer', self.accounts.transfer, ident, payee, rng.randint(1, 100))
+
+    def buy(self, ident, rng):
+        # Any property, so players race for the same ones and try to buy sold ones
+        prop = rng.choice(self.prop_manager.all_properties)
+        try:
+            price = self.timed('buy_property', self.accounts.buy_property, ident, prop.name)
+        except ValueError:
+            with self.bank_lock:
+                self.refused_purchases += 1
+            return
+        with self.bank_lock:
+            self.money_supply -= price
+
+    def state(self):
+        return (
+            {ident: acc.cash for ident, acc in self.accounts.accounts_storage.items()},
+            {prop.name: prop.owner for prop in self.prop_manager.all_properties}
+        )
+
+    def check(self, label):
+        """
+        Record every broken invariant, only called while no player is moving.
+        """
+        def fail(message):
+            self.violations.append(f'game {self.seed} {label}: {message}')
+
+        stored = self.accounts.accounts_storage
+        balances, owners = self.state()
+        if sum(balances.values()) != self.money_supply:
+            fail(f'money supply is {sum(balances.values())}, expected {self.money_supply}')
+        for ident, cash in balances.items():
+            if cash < 0:
+                fail(f'{ident} has ${cash}')
+        for name, owner in owners.items():
+            holders = [ident for ident, acc in stored.items() if any(p.name == name for p in acc.properties)]
+            if owner is not None and owner not in stored:
+                fail(f'{name} is owned by missing account {owner}')
+            if holders != ([owner] if owner is not None else []):
+                fail(f'{name} is owned by {owner} but listed by {holders}')
+        net_worth = {ident: cash + sum(p.worth for p in self.prop_manager.all_properties if p.owner == ident) for ident, cash in balances.items()}
+        if dict(self.accounts.leaderboard.net_worth) != net_worth:
+            fail(f'leaderboard {self.accounts.leaderboard.net_worth} does not match net worth {net_worth}')
+        tlog = self.accounts.tlog_connection
+        saved_balances = dict(tlog.read("SELECT id, cash FROM Accounts", consistent=True))
+        if saved_balances != balances:
+            fail(f'database balances {saved_balances} do not match {balances}')
+        saved_owners = {name: owner for name, owner, _, _ in tlog.get_property_states()}
+        if {name: owner for name, owner in owners.items() if owner is not None} != {name: owner for name, owner in saved_owners.items() if owner is not None}:
+            fail('database property owners do not match memory')
+
+    def reload(self):
+        before = self.state()
+        self.accounts.load_saved()
+        if self.state() != before:
+            self.violations.append(f'game {self.seed} reload: state changed from {before} to {self.state()}')
+
+    def summary(self, elapsed):
+        lock_wait = {name: wait.snapshot()[1] for name, (wait, _) in self.accounts.lock_times.items()}
+        tlog = self.accounts.tlog_connection
+        return {
+            'seed': self.seed,
+            'elapsed': elapsed,
+            'latencies': self.latencies,
+            'lock wait': lock_wait,
+            'commits': tlog.commits.value,
+            'statements': tlog.committed_statements.value,
+            'refused purchases': self.refused_purchases,
+            'violations': self.violations
+        }
+
+    def cleanup(self):
+        for _ in self.accounts.cleanup():
+            pass
+
+
+def simulate_game(seed, players=PLAYERS, rounds=ROUNDS, actions=ACTIONS_PER_ROUND):
+    """
+    Play one game in a scratch directory and return its summary.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        game = SimulatedGame(seed, os.path.join(workdir, 'game.db'), players)
+        rng = random.Random(seed)
+        reloads = [rng.random() < RELOAD_CHANCE for _ in range(rounds)]
+        checked = iter(range(rounds))
+
+        def between_rounds():
+            # Runs in one player thread once every player has finished the round
+            n = next(checked)
+            game.check(f'round {n}')
+            if reloads[n]:
+                game.reload()
+
+        barrier = Barrier(players, action=between_rounds)
+
+        def player(n):
+            player_rng = random.Random(seed * 1000 + n)
+            for _ in range(rounds):
+                game.play(game.players[n], player_rng, actions)
+                barrier.wait()
+
+        threads = [Thread(target=player, args=(n,)) for n in range(players)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        try:
+            return game.summary(elapsed)
+        finally:
+            game.cleanup()
+
+
+def percentile_ms(samples, p):
+    if len(samples) < 2:
+        return sum(samples) * 1000
+    return quantiles(samples, n=100)[p - 1] * 1000
+
+
+def run(games=GAMES, processes=None, seed=0, players=PLAYERS, rounds=ROUNDS, actions=ACTIONS_PER_ROUND):
+    """
+    Simulate games across a process pool and combine their numbers.
+    """
+    seeds = range(seed, seed + games)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as pool:
+        summaries = list(pool.map(partial(simulate_game, players=players, rounds=rounds, actions=actions), seeds))
+    elapsed = time.perf_counter() - start
+    results = {
+        'games': games,
+        'games per s': games / elapsed,
+        'mean game s': sum(s['elapsed'] for s in summaries) / games
+    }
+    for op in OPERATIONS:
+        latencies = [t for s in summaries for t in s['latencies'][op]]
+        results[f'{op} count'] = len(latencies)
+        if latencies:
+            results[f'{op} per s'] = len(latencies) / elapsed
+            results[f'{op} p50 ms'] = percentile_ms(latencies, 50)
+            results[f'{op} p99 ms'] = percentile_ms(latencies, 99)
+    for name in summaries[0]['lock wait']:
+        results[f'{name} lock wait s'] = sum(s['lock wait'][name] for s in summaries)
+    commits = sum(s['commits'] for s in summaries)
+    results['statements per commit'] = sum(s['statements'] for s in summaries) / max(1, commits)
+    results['refused purchases'] = sum(s['refused purchases'] for s in summaries)
+    results['violations'] = [v for s in summaries for v in s['violations']]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate many games offline and check their invariants.')
+    parser.add_argument('--games', type=int, default=GAMES)
+    parser.add_argument('--processes', type=int, help='worker processes, one per CPU by default')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, the others follow it')
+    parser.add_argument('--players', type=int, default=PLAYERS)
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--actions', type=int, default=ACTIONS_PER_ROUND, help='moves per player per round')
+    args = parser.parse_args()
+
+    results = run(args.games, args.processes, args.seed, args.players, args.rounds, args.actions)
+    violations = results.pop('violations')
+    for metric, value in results.items():
+        print(f'{metric}: {value:.3f}' if isinstance(value, float) else f'{metric}: {value}')
+    for violation in violations:
+        print(f'VIOLATION {violation}')
+    if not violations:
+        print('No invariant violations')
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Transfer throughput with striped account locks against one global lock,
+and a stress check that money is conserved.
+
+Disjoint: each thread moves money back and forth between its own pair.
+Contended: every thread picks random payers and payees from a small
+table, in both directions, and mixes in batches, so lock ordering matters.
+One lock stripe behaves like the old global AccountManager lock.
+After each run the total balance in memory, in the Accounts table and
+after reloading the accounts must equal what the accounts started with,
+and no balance may be negative. The exit status is 1 if either check fails.
+
+Run from the repository root:
+    python benchmarks/transfer_contention.py
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import ACCOUNT_LOCK_STRIPES, AccountManager
+from passwords import PasswordHasher
+from property_manger import PropertyManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THREADS = 8
+TRANSFERS_PER_THREAD = 2000
+CONTENDED_ACCOUNTS = 4
+STARTING_CASH = 1000
+
+
+def disjoint_worker(accounts, n):
+    payer, payee = f'pair{n}a', f'pair{n}b'
+    for _ in range(TRANSFERS_PER_THREAD // 2):
+        accounts.transfer(payer, payee, 7)
+        accounts.transfer(payee, payer, 7)
+
+
+def contended_worker(accounts, n):
+    rng = random.Random(n)
+    players = [f'shared{i}' for i in range(CONTENDED_ACCOUNTS)]
+    for i in range(TRANSFERS_PER_THREAD):
+        payer, payee = rng.sample(players, 2)
+        if i % 50 == 0:
+            # Batches lock several accounts at once
+            accounts.batch([
+                {'op': 'transfer', 'payer': payer, 'payee': payee, 'amount': rng.randint(1, 300)},
+                {'op': 'transfer', 'payer': payee, 'payee': rng.choice(players), 'amount': rng.randint(1, 300)}
+            ], atomic=False)
+        else:
+            # Failed transfers from empty accounts are fine, they must not lose money
+            accounts.transfer(payer, payee, rng.randint(1, 300))
+
+
+def measure(lock_stripes, worker):
+    prop_manager = PropertyManager(os.path.join(REPO_DIR, 'property_set.json'))
+    accounts = AccountManager(prop_manager, PasswordHasher(workers=0, iterations=1), lock_stripes)
+    accounts.nuke_accounts()
+    for n in range(THREADS):
+        accounts.new(f'pair{n}a', 'a', 'password', STARTING_CASH)
+        accounts.new(f'pair{n}b', 'b', 'password', STARTING_CASH)
+    for i in range(CONTENDED_ACCOUNTS):
+        accounts.new(f'shared{i}', 'shared', 'password', STARTING_CASH)
+    expected = STARTING_CASH * accounts.num_accounts
+
+    threads = [Thread(target=worker, args=(accounts, n)) for n in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    in_memory = sum(acc.cash for acc in accounts.accounts_storage.values())
+    in_table = accounts.tlog_connection.read("SELECT SUM(cash) FROM Accounts", consistent=True)[0][0]
+    accounts.load_saved()
+    reloaded = sum(acc.cash for acc in accounts.accounts_storage.values())
+    for _ in accounts.cleanup():
+        pass
+    return {
+        'transfers per second': THREADS * TRANSFERS_PER_THREAD / elapsed,
+        'money conserved': in_memory == in_table == reloaded == expected,
+        'no negative balances': min(acc.cash for acc in accounts.accounts_storage.values()) >= 0,
+    }
+
+
+def run():
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            for name, worker in (('disjoint', disjoint_worker), ('contended', contended_worker)):
+                results[f'{name}, global lock'] = measure(1, worker)
+                results[f'{name}, {ACCOUNT_LOCK_STRIPES} stripes'] = measure(ACCOUNT_LOCK_STRIPES, worker)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def main():
+    print(f'{THREADS} threads making {TRANSFERS_PER_THREAD} transfers each:')
+    failed = False
+    for mode, stats in run().items():
+        print(f'{mode}:')
+        for name, value in stats.items():
+            print(f'\t{name}: {value:.2f}' if isinstance(value, float) else f'\t{name}: {value}')
+        failed = failed or not (stats['money conserved'] and stats['no negative balances'])
+    if failed:
+        print('FAILED: money was not conserved or a balance went negative')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
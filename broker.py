@@ -0,0 +1,134 @@
+import secrets
+from queue import Empty, Full, Queue
+from threading import Lock
+
+# Messages a subscriber can fall behind by before its oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Topics published by the account and property managers
+ACCOUNTS_LIST_TOPIC = 'accounts-list'
+PROPERTIES_TOPIC = 'properties'
+LEADERBOARD_TOPIC = 'leaderboard'
+
+
+def account_topic(ident):
+    return f'account:{ident}'
+
+
+class Subscription:
+    """
+    A subscriber's queue of messages for the topics it asked for.
+    """
+    def __init__(self, broker, topics, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self.messages = Queue(maxsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def deliver(self, message):
+        """
+        Queue a message without blocking the publisher.
+        A subscriber that isn't keeping up loses its oldest message.
+        """
+        while True:
+            try:
+                self.messages.put_nowait(message)
+                return
+            except Full:
+                try:
+                    self.messages.get_nowait()
+                except Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Wait for the next message.
+        Raises queue.Empty if the timeout runs out first.
+        """
+        return self.messages.get(timeout=timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class UpdateBroker:
+    """
+    In-process publish/subscribe for change notifications.
+    Subscribers only receive messages for the topics they subscribed to.
+    """
+    def __init__(self):
+        self.subscribers = dict()
+        self.lock = Lock()
+        # Every message bumps the version, and each topic remembers the version
+        # of its last change. The token tells versions from another run apart.
+        self.version = 0
+        self.topic_versions = dict()
+        self.broadcast_version = 0
+        self.token = secrets.token_hex(4)
+
+    def subscribe(self, topics):
+        return self.register(Subscription(self, topics))
+
+    def register(self, subscription):
+        """
+        Start delivering to a subscription, for subscribers with their own delivery.
+        """
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                topic_subscribers = self.subscribers.get(topic)
+                if topic_subscribers is None:
+                    continue
+                topic_subscribers.discard(subscription)
+                if not topic_subscribers:
+                    del self.subscribers[topic]
+
+    def publish(self, topic, **payload):
+        """
+        Send a message describing a change to everyone subscribed to the topic.
+        """
+        with self.lock:
+            self.version += 1
+            self.topic_versions[topic] = self.version
+            subscribers = tuple(self.subscribers.get(topic, ()))
+        if not subscribers:
+            return
+        message = {'sync': True, 'topic': topic, **payload}
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+    def broadcast(self, **payload):
+        """
+        Send one message to every subscriber, whatever its topics.
+        Used when everything may have changed, like reloading all accounts.
+        """
+        with self.lock:
+            self.version += 1
+            self.broadcast_version = self.version
+            subscribers = set().union(*self.subscribers.values())
+        message = {'sync': True, 'topic': None, **payload}
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+    def version_of(self, topics):
+        """
+        Version of the newest change to any of the topics.
+        It only moves when something published on them, or to everyone, changed.
+        """
+        with self.lock:
+            return max([self.broadcast_version] + [self.topic_versions.get(topic, 0) for topic in topics])
+
+    @property
+    def subscriber_count(self):
+        with self.lock:
+            return len(set().union(*self.subscribers.values()))
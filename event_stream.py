@@ -0,0 +1,204 @@
+import asyncio
+import json
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+
+from broker import ACCOUNTS_LIST_TOPIC, PROPERTIES_TOPIC, SUBSCRIBER_QUEUE_SIZE, Subscription
+
+# Seconds between comment lines sent to keep idle streams open through proxies
+HEARTBEAT_INTERVAL = 15
+# Streams without any real message for this many seconds are closed,
+# browsers reconnect after the retry delay.
+IDLE_TIMEOUT = 600
+RETRY_DELAY_MS = 3000
+# A client that can't take a write within this many seconds is dropped
+WRITE_TIMEOUT = 10
+MAX_CONNECTIONS = 5000
+# Time allowed for a client to send its request line and headers
+REQUEST_TIMEOUT = 10
+
+
+class AsyncSubscription(Subscription):
+    """
+    Subscription that hands messages to an asyncio queue on the stream's event loop.
+    """
+    def __init__(self, broker, topics, loop):
+        super().__init__(broker, topics)
+        self.loop = loop
+        self.messages = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def deliver(self, message):
+        # Called from request threads, so the queue is only touched on the loop
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The event loop has already stopped
+            pass
+
+    def _put(self, message):
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(message)
+
+
+class EventStreamServer:
+    """
+    Serves the /bruh event stream from a single asyncio thread.
+    Idle subscribers cost a socket and a queue instead of a server thread.
+    With find_broker, /games/<game_id>/bruh streams the broker it returns
+    for that game, or 404s when it returns None.
+    """
+    def __init__(self, broker, host='127.0.0.1', port=5001, max_connections=MAX_CONNECTIONS,
+                 heartbeat=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT, write_timeout=WRITE_TIMEOUT, find_broker=None):
+        self.broker = broker
+        self.find_broker = find_broker
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.connections = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.reaped = 0
+        self.rejected = 0
+
+    @property
+    def active_connections(self):
+        return len(self.connections)
+
+    def start(self):
+        """
+        Start serving on a background thread and wait until it is listening.
+        """
+        self.loop = asyncio.new_event_loop()
+        started = self.loop.create_future()
+        self.thread = Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._wait_started(started), self.loop).result()
+
+    async def _wait_started(self, started):
+        await started
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._listen(started))
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _listen(self, started):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 picks a free port, report the real one
+        self.port = self.server.sockets[0].getsockname()[1]
+        started.set_result(True)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def _shutdown(self):
+        self.server.close()
+        for task in tuple(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _respond(self, writer, status, body=''):
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+            f'Connection: close\r\nAccess-Control-Allow-Origin: *\r\n\r\n{body}'.encode()
+        )
+        try:
+            await asyncio.wait_for(writer.drain(), self.write_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        try:
+            method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+        except ValueError:
+            await self._respond(writer, '400 Bad Request')
+            return
+        url = urlsplit(target)
+        broker = self._broker_for(url.path) if method == 'GET' else None
+        if broker is None:
+            await self._respond(writer, '404 Not Found')
+            return
+        if len(self.connections) >= self.max_connections:
+            self.rejected += 1
+            await self._respond(writer, '503 Service Unavailable', 'Too many event streams')
+            return
+        topics = [t for t in ','.join(parse_qs(url.query).get('topics', [])).split(',') if t]
+        if not topics:
+            topics = [ACCOUNTS_LIST_TOPIC, PROPERTIES_TOPIC]
+        task = asyncio.current_task()
+        self.connections.add(task)
+        subscription = broker.register(AsyncSubscription(broker, topics, self.loop))
+        try:
+            await self._stream(reader, writer, subscription)
+        except (asyncio.TimeoutError, ConnectionError):
+            # The client stopped reading or went away
+            self.reaped += 1
+        except asyncio.CancelledError:
+            pass
+        finally:
+            subscription.close()
+            self.connections.discard(task)
+            writer.close()
+
+    def _broker_for(self, path):
+        if path == '/bruh':
+            return self.broker
+        parts = path.split('/')
+        # ['', 'games', game_id, 'bruh']
+        if self.find_broker is not None and len(parts) == 4 and parts[1] == 'games' and parts[3] == 'bruh':
+            return self.find_broker(parts[2])
+        return None
+
+    async def _send(self, writer, data):
+        writer.write(data.encode())
+        await asyncio.wait_for(writer.drain(), self.write_timeout)
+
+    async def _stream(self, reader, writer, subscription):
+        await self._send(
+            writer,
+            'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+            f'Connection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n\r\nretry: {RETRY_DELAY_MS}\n\n'
+        )
+        # Clients never send anything after the request, so the read only
+        # finishes when the connection is closed.
+        closed = asyncio.ensure_future(reader.read(1))
+        next_message = None
+        loop = asyncio.get_running_loop()
+        last_message = loop.time()
+        try:
+            while True:
+                next_message = asyncio.ensure_future(subscription.messages.get())
+                done, _ = await asyncio.wait((next_message, closed), timeout=self.heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                if closed in done:
+                    self.reaped += 1
+                    return
+                if next_message in done:
+                    await self._send(writer, f'data: {json.dumps(next_message.result())}\n\n')
+                    last_message = loop.time()
+                    continue
+                next_message.cancel()
+                if loop.time() - last_message >= self.idle_timeout:
+                    self.reaped += 1
+                    return
+                await self._send(writer, ': heartbeat\n\n')
+        finally:
+            closed.cancel()
+            if next_message is not None:
+                next_message.cancel()
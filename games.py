@@ -0,0 +1,239 @@
+import logging
+import os
+import re
+import time
+from threading import Event, Lock, Thread
+
+from account_store import AccountManager
+from broker import UpdateBroker
+from passwords import PasswordHasher
+from property_manger import PropertyManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GAME = 'default'
+# The default game keeps the database single-game installs already have
+DEFAULT_GAME_DB = 'tlog.db'
+GAMES_DIR = 'games'
+GAME_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Seconds without a request before a game is unloaded
+GAME_IDLE_TIMEOUT = 15 * 60
+# Past this many loaded games the least recently used idle ones are unloaded
+MAX_LOADED_GAMES = 16
+# Seconds between checks for games to unload
+EVICTION_INTERVAL = 30
+# Seconds between checks for changes made by other processes sharing the databases
+SYNC_INTERVAL = 1
+
+
+class Game:
+    """
+    One table's accounts, properties and database, loaded together.
+    """
+    def __init__(self, game_id, db_filename, property_set, hasher, broker, shared=False):
+        self.game_id = game_id
+        self.prop_manager = PropertyManager(property_set)
+        self.accounts = AccountManager(self.prop_manager, hasher, db_filename=db_filename, broker=broker, game_id=game_id, shared=shared)
+        self.last_used = time.monotonic()
+        # Requests currently using the game, it is only unloaded at zero
+        self.in_use = 0
+
+    def cleanup(self):
+        yield f'Unloading game {self.game_id}'
+        yield from self.accounts.cleanup()
+
+
+class GameRegistry:
+    """
+    Loads games by ID on demand and unloads them once idle.
+    Each game has its own database file and TLog writer.
+    Shared registries expect other processes, like WSGI workers, to use the same databases.
+    """
+    def __init__(self, property_set='property_set.json', games_dir=GAMES_DIR, idle_timeout=GAME_IDLE_TIMEOUT,
+                 max_loaded=MAX_LOADED_GAMES, hasher=None, eviction_interval=EVICTION_INTERVAL, shared=False,
+                 sync_interval=SYNC_INTERVAL):
+        self.property_set = property_set
+        self.games_dir = games_dir
+        self.idle_timeout = idle_timeout
+        self.max_loaded = max_loaded
+        # Password hashing workers are shared by every game
+        self.hasher = PasswordHasher() if hasher is None else hasher
+        self.games = dict()
+        # Brokers outlive unloading so open event streams keep getting updates after a reload
+        self.brokers = dict()
+        # Held while a game loads or unloads, so a game is never open twice
+        self.load_locks = dict()
+        self.lock = Lock()
+        self.stopping = Event()
+        self.shared = shared
+        self.evictor = Thread(target=self._evict_loop, args=(eviction_interval,), daemon=True)
+        self.evictor.start()
+        # Changes from other processes reach event streams even when nobody here makes a request
+        self.syncer = None
+        if shared:
+            self.syncer = Thread(target=self._sync_loop, args=(sync_interval,), daemon=True)
+            self.syncer.start()
+
+    @staticmethod
+    def valid_id(game_id):
+        return GAME_ID.fullmatch(game_id) is not None
+
+    def db_filename(self, game_id):
+        if game_id == DEFAULT_GAME:
+            return DEFAULT_GAME_DB
+        return os.path.join(self.games_dir, f'{game_id}.db')
+
+    def exists(self, game_id):
+        return game_id in self.games or os.path.exists(self.db_filename(game_id))
+
+    def broker(self, game_id):
+        """
+        The update broker for a game, or None if there is no such game.
+        """
+        if not self.valid_id(game_id):
+            return None
+        with self.lock:
+            broker = self.brokers.get(game_id)
+            if broker is not None:
+                return broker
+        if game_id != DEFAULT_GAME and not self.exists(game_id):
+            return None
+        with self.lock:
+            return self.brokers.setdefault(game_id, UpdateBroker())
+
+    def acquire(self, game_id, create=False):
+        """
+        Get a game for a request, loading it if needed.
+        Only the default game is made on first use, others must be created first, see create.
+        Every acquire must be matched by a release.
+        Raises KeyError for IDs that don't name a game.
+        """
+        if not self.valid_id(game_id):
+            raise KeyError(game_id)
+        with self.lock:
+            game = self._use(game_id)
+            if game is not None:
+                return game
+            load_lock = self.load_locks.setdefault(game_id, Lock())
+        with load_lock:
+            with self.lock:
+                # Another request may have loaded it while we waited
+                game = self._use(game_id)
+                if game is not None:
+                    return game
+            # Unknown IDs must not leave a database or writer behind
+            if not create and game_id != DEFAULT_GAME and not self.exists(game_id):
+                raise KeyError(game_id)
+            with self.lock:
+                broker = self.brokers.setdefault(game_id, UpdateBroker())
+            os.makedirs(os.path.dirname(self.db_filename(game_id)) or '.', exist_ok=True)
+            game = Game(game_id, self.db_filename(game_id), self.property_set, self.hasher, broker, self.shared)
+            with self.lock:
+                self.games[game_id] = game
+                game.in_use += 1
+        return game
+
+    def create(self, game_id):
+        """
+        Make a new game and its database.
+        Returns False if the game already exists, raises KeyError for IDs that can't name a game.
+        """
+        if not self.valid_id(game_id):
+            raise KeyError(game_id)
+        if self.exists(game_id):
+            return False
+        self.release(self.acquire(game_id, create=True))
+        logger.info('created game=%s', game_id)
+        return True
+
+    def _use(self, game_id):
+        game = self.games.get(game_id)
+        if game is not None:
+            game.in_use += 1
+            game.last_used = time.monotonic()
+        return game
+
+    def release(self, game):
+        with self.lock:
+            game.in_use -= 1
+            game.last_used = time.monotonic()
+
+    @property
+    def loaded(self):
+        with self.lock:
+            return tuple(self.games)
+
+    @property
+    def loaded_games(self):
+        with self.lock:
+            return tuple(self.games.values())
+
+    @property
+    def known_brokers(self):
+        """
+        Brokers by game ID, including games that are unloaded but still have event streams.
+        """
+        with self.lock:
+            return dict(self.brokers)
+
+    def evict(self, idle_timeout=None):
+        """
+        Unload games idle for longer than the timeout, then the least
+        recently used idle games while more than max_loaded are open.
+        Returns the IDs of the unloaded games.
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        unloading = []
+        with self.lock:
+            idle = sorted((g for g in self.games.values() if g.in_use == 0), key=lambda g: g.last_used)
+            excess = len(self.games) - self.max_loaded
+            for game in idle:
+                if now - game.last_used < idle_timeout and excess <= 0:
+                    break
+                load_lock = self.load_locks[game.game_id]
+                # A game being loaded right now isn't idle
+                if not load_lock.acquire(blocking=False):
+                    continue
+                del self.games[game.game_id]
+                unloading.append((game, load_lock))
+                excess -= 1
+        for game, load_lock in unloading:
+            try:
+                for _ in game.cleanup():
+                    pass
+            finally:
+                load_lock.release()
+        return [game.game_id for game, _ in unloading]
+
+    def _evict_loop(self, interval):
+        while not self.stopping.wait(interval):
+            self.evict()
+
+    def _sync_loop(self, interval):
+        while not self.stopping.wait(interval):
+            with self.lock:
+                games = list(self.games.values())
+                # Held like a request would, without counting as use
+                for game in games:
+                    game.in_use += 1
+            for game in games:
+                try:
+                    game.accounts.sync()
+                except Exception:
+                    logger.exception('sync failed game=%s', game.game_id)
+                finally:
+                    with self.lock:
+                        game.in_use -= 1
+
+    def cleanup(self):
+        self.stopping.set()
+        self.evictor.join()
+        if self.syncer is not None:
+            self.syncer.join()
+        with self.lock:
+            games = list(self.games.values())
+            self.games = dict()
+        for game in games:
+            yield from game.cleanup()
+        self.hasher.close()
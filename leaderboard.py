@@ -0,0 +1,105 @@
+from bisect import bisect_left, insort
+from threading import Lock
+
+from broker import LEADERBOARD_TOPIC
+
+# Default and largest number of accounts in one leaderboard response
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX = 100
+
+
+class Leaderboard:
+    """
+    Net worth of every account, kept in rank order as it changes.
+    Net worth is cash plus the worth of owned properties, see Property.worth.
+    Changes arrive as differences, so no update walks the accounts or properties.
+    """
+    def __init__(self, broker=None):
+        self.broker = broker
+        self.accounts = dict()
+        self.net_worth = dict()
+        # (-net worth, ID) of every account, richest first
+        self.ranking = []
+        self.lock = Lock()
+
+    def reset(self, accounts, prop_manager):
+        """
+        Rebuild from scratch, after loading every account.
+        """
+        accounts = {acc.ident: acc for acc in accounts}
+        net_worth = {ident: acc.cash + prop_manager.worth_of(ident) for ident, acc in accounts.items()}
+        with self.lock:
+            self.accounts = accounts
+            self.net_worth = net_worth
+            self.ranking = sorted((-worth, ident) for ident, worth in net_worth.items())
+        self._publish(None, 'reload')
+
+    def add(self, account, property_worth=0):
+        with self.lock:
+            if account.ident in self.net_worth:
+                self._unrank(account.ident)
+            self.accounts[account.ident] = account
+            self.net_worth[account.ident] = account.cash + property_worth
+            insort(self.ranking, (-self.net_worth[account.ident], account.ident))
+        self._publish(account.ident, 'new')
+
+    def remove(self, ident):
+        with self.lock:
+            if ident not in self.net_worth:
+                return
+            self._unrank(ident)
+            del self.accounts[ident]
+            del self.net_worth[ident]
+        self._publish(ident, 'delete')
+
+    def adjust(self, ident, change):
+        """
+        Add to an account's net worth, ignored for IDs without an account.
+        """
+        with self.lock:
+            if ident not in self.net_worth:
+                return
+            self._unrank(ident)
+            self.net_worth[ident] += change
+            insort(self.ranking, (-self.net_worth[ident], ident))
+        self._publish(ident, 'net worth')
+
+    def adjust_many(self, changes):
+        """
+        Add to the net worth of many accounts at once, from a dict of ID to change.
+        The ranking is sorted once and one change is published for all of them.
+        """
+        with self.lock:
+            for ident, change in changes.items():
+                if ident in self.net_worth:
+                    self.net_worth[ident] += change
+            self.ranking = sorted((-worth, ident) for ident, worth in self.net_worth.items())
+        self._publish(None, 'net worth')
+
+    def _unrank(self, ident):
+        del self.ranking[bisect_left(self.ranking, (-self.net_worth[ident], ident))]
+
+    def _publish(self, ident, change):
+        if self.broker is not None:
+            self.broker.publish(LEADERBOARD_TOPIC, account=ident, change=change)
+
+    def top(self, limit=LEADERBOARD_SIZE):
+        """
+        The richest accounts, as dicts with their rank, name and net worth.
+        """
+        limit = max(1, min(limit, LEADERBOARD_MAX))
+        with self.lock:
+            leaders = [(-negative_worth, self.accounts[ident]) for negative_worth, ident in self.ranking[:limit]]
+        return [
+            {'rank': rank, 'account': acc.ident, 'name': acc.name, 'net worth': worth}
+            for rank, (worth, acc) in enumerate(leaders, 1)
+        ]
+
+    def rank_of(self, ident):
+        """
+        An account's place on the leaderboard, starting at 1, or None without an account.
+        """
+        with self.lock:
+            if ident not in self.net_worth:
+                return None
+            return bisect_left(self.ranking, (-self.net_worth[ident], ident)) + 1
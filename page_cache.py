@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Rendered pages kept at once, the least recently used are dropped first
+PAGE_CACHE_SIZE = 256
+
+
+class PageCache:
+    """
+    Rendered pages keyed by what they were rendered for, including the
+    state version, so a change makes new keys instead of invalidating old ones.
+    """
+    def __init__(self, max_pages=PAGE_CACHE_SIZE):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
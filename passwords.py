@@ -0,0 +1,121 @@
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threading import BoundedSemaphore
+
+# Hashes stored before the cost was configurable are a bare PBKDF2 digest with these settings
+LEGACY_ALGORITHM = 'sha256'
+LEGACY_ITERATIONS = 100000
+
+# Settings for new hashes, MONOPOLY_HASH_ALGORITHM and MONOPOLY_HASH_ITERATIONS override them.
+# With MONOPOLY_HASH_UPGRADE=1 passwords stored with other settings are rehashed when their owner logs in.
+HASH_ALGORITHM = os.environ.get('MONOPOLY_HASH_ALGORITHM', 'sha256')
+HASH_ITERATIONS = int(os.environ.get('MONOPOLY_HASH_ITERATIONS', 100000))
+HASH_UPGRADE = os.environ.get('MONOPOLY_HASH_UPGRADE', '0').lower() in ('1', 'true', 'yes')
+# Processes doing PBKDF2, None uses one per CPU
+HASH_WORKERS = None
+# Hashes allowed to be running or waiting for a worker at once
+HASH_QUEUE_SIZE = 32
+# Seconds a request waits for a place in the queue before giving up
+HASH_WAIT = 5
+
+HASH_PREFIX = b'pbkdf2_'
+
+
+def encode_hash(algorithm, iterations, digest):
+    return HASH_PREFIX + f'{algorithm}${iterations}$'.encode() + digest
+
+
+def hash_params(pw_hash: bytes):
+    """
+    The algorithm and iteration count a stored hash was made with,
+    and the bare digest.
+    """
+    if pw_hash.startswith(HASH_PREFIX):
+        algorithm, iterations, digest = pw_hash[len(HASH_PREFIX):].split(b'$', 2)
+        return algorithm.decode(), int(iterations), digest
+    return LEGACY_ALGORITHM, LEGACY_ITERATIONS, pw_hash
+
+
+def hash_new_password(password: str, algorithm=HASH_ALGORITHM, iterations=HASH_ITERATIONS):
+    """
+    Hash the provided password with a randomly-generated salt and return the
+    salt and hash to store in the database.
+    """
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac(algorithm, password.encode(), salt, iterations)
+    return salt, encode_hash(algorithm, iterations, digest)
+
+
+def verify_password(salt: bytes, pw_hash: bytes, password: str):
+    """
+    Given a previously-stored salt and hash, and a password provided by a user
+    trying to log in, check whether the password is correct.
+    """
+    algorithm, iterations, digest = hash_params(pw_hash)
+    return hmac.compare_digest(
+        digest,
+        hashlib.pbkdf2_hmac(algorithm, password.encode(), salt, iterations)
+    )
+
+
+class HasherBusy(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs PBKDF2 in worker processes so request threads aren't stuck on the CPU.
+    Only max_pending hashes can be running or waiting at once, later ones
+    wait up to admission_timeout seconds for a place and then raise HasherBusy.
+    With workers=0 hashes run on the calling thread.
+    """
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_QUEUE_SIZE, admission_timeout=HASH_WAIT,
+                 algorithm=HASH_ALGORITHM, iterations=HASH_ITERATIONS, upgrade=HASH_UPGRADE):
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f'Unknown hash algorithm {algorithm!r}.')
+        if iterations < 1:
+            raise ValueError('Hash iterations must be at least 1.')
+        self.algorithm = algorithm
+        self.iterations = iterations
+        # Rehash passwords stored with other settings when their owner logs in
+        self.upgrade = upgrade
+        self.admission_timeout = admission_timeout
+        self.admission = BoundedSemaphore(max_pending)
+        self.rejected = 0
+        self.pool = None
+        if workers != 0:
+            # Spawned workers don't inherit the server's threads, sockets or database
+            self.pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+
+    def _run(self, func, *args):
+        if not self.admission.acquire(timeout=self.admission_timeout):
+            self.rejected += 1
+            raise HasherBusy('Too many logins at once, try again shortly.')
+        try:
+            if self.pool is None:
+                return func(*args)
+            return self.pool.submit(func, *args).result()
+        finally:
+            self.admission.release()
+
+    def hash_new(self, password):
+        return self._run(hash_new_password, password, self.algorithm, self.iterations)
+
+    def verify(self, salt, pw_hash, password):
+        return self._run(verify_password, salt, pw_hash, password)
+
+    def needs_upgrade(self, pw_hash):
+        """
+        Whether a stored hash was made with different settings than new ones would be.
+        """
+        algorithm, iterations, _ = hash_params(pw_hash)
+        return self.upgrade and (algorithm, iterations) != (self.algorithm, self.iterations)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
@@ -1,5 +1,10 @@
 import json
 from functools import cached_property
+from threading import Lock
+
+# Houses on a property at each rent index, a hotel stands for four houses and the hotel
+BUILDINGS = {'1 House': 1, '2 Houses': 2, '3 Houses': 3, '4 Houses': 4, 'Hotel': 4}
+
 
 class Property:
     """
@@ -13,9 +18,65 @@ class Property:
         self.rent_rates = rent_rates
         self.costs = costs
         # Current attributes in play
-        self.owner = None
-        self.rent_rate_index = "Base"
-        self.mortgaged = False
+        self._owner = None
+        self._rent_rate_index = "Base"
+        self._mortgaged = False
+        # PropertyManager told about changes of owner, buildings and mortgage
+        self.manager = None
+
+    @property
+    def owner(self):
+        return self._owner
+
+    @owner.setter
+    def owner(self, new_owner):
+        old_owner = self._owner
+        self._owner = new_owner
+        if self.manager is not None and new_owner != old_owner:
+            self.manager.owner_changed(self, old_owner, new_owner)
+
+    @property
+    def rent_rate_index(self):
+        return self._rent_rate_index
+
+    @rent_rate_index.setter
+    def rent_rate_index(self, index):
+        old_worth = self.worth
+        self._rent_rate_index = index
+        if self.manager is not None:
+            self.manager.state_changed(self, old_worth)
+
+    @property
+    def mortgaged(self):
+        return self._mortgaged
+
+    @mortgaged.setter
+    def mortgaged(self, mortgaged):
+        old_worth = self.worth
+        self._mortgaged = mortgaged
+        if self.manager is not None:
+            self.manager.state_changed(self, old_worth)
+
+    @property
+    def worth(self):
+        """
+        What the property adds to its owner's net worth: the price paid for it and its buildings.
+        A mortgaged property is worth its price less the mortgage, which is half the price.
+        """
+        price = self.costs['property']
+        if self.mortgaged:
+            return price - price // 2
+        worth = price + BUILDINGS.get(self.rent_rate_index, 0) * self.costs.get('houses', 0)
+        if self.rent_rate_index == 'Hotel':
+            worth += self.costs.get('hotels', 0)
+        return worth
+
+    @property
+    def group(self):
+        """
+        Color for buildable properties, otherwise the type, like railroad.
+        """
+        return self.color if self.color is not None else self.prop_type
 
     @property
     def rent(self):
@@ -67,6 +128,20 @@ class PropertyManager:
     def __init__(self, property_set):
         self.properties = {}
         self.complete_sets = {}
+        # Ownership indexes, kept up to date by owner_changed
+        self.by_owner = {}
+        self.group_counts = {}
+        self.owner_worth = {}
+        self.unowned_set = set()
+        # Sorted listings from the indexes, dropped whenever a property changes hands
+        self.listings = {}
+        self.index_lock = Lock()
+        # Called with an owner and the change in their property worth, like Leaderboard.adjust
+        self.on_worth_change = None
+        # Rent of each property as things stand, or the dice multiplier for utilities.
+        # Only rebuilt when ownership, buildings or mortgages change, see rent_due.
+        self.rent_table = {}
+        self.groups = {}
 
         with open(property_set, 'r') as prop_file:
             loaded_properties = json.load(prop_file)
@@ -82,29 +157,183 @@ class PropertyManager:
             else:
                 new_prop = Property(name, attributes['rent'], attributes['cost'], attributes['type'])
                 self.properties[name] = new_prop
+            new_prop.manager = self
+            self.unowned_set.add(new_prop)
+        # Board order, for listing properties from the indexes
+        self.board_position = {prop: i for i, prop in enumerate(self.properties.values())}
+        for prop in self.properties.values():
+            self.groups.setdefault(prop.group, set()).add(prop)
+            self.rent_table[prop.name] = 0
+
+    def owner_changed(self, prop, old_owner, new_owner):
+        """
+        Move a property between owners in the indexes.
+        Called by Property when its owner is set.
+        """
+        worth = prop.worth
+        with self.index_lock:
+            self.listings.clear()
+            if old_owner is None:
+                self.unowned_set.discard(prop)
+            else:
+                self.by_owner[old_owner].discard(prop)
+                if not self.by_owner[old_owner]:
+                    del self.by_owner[old_owner]
+                counts = self.group_counts[old_owner]
+                counts[prop.group] -= 1
+                if not counts[prop.group]:
+                    del counts[prop.group]
+                if not counts:
+                    del self.group_counts[old_owner]
+                self.owner_worth[old_owner] -= worth
+                if not self.by_owner.get(old_owner):
+                    del self.owner_worth[old_owner]
+            if new_owner is None:
+                self.unowned_set.add(prop)
+            else:
+                self.by_owner.setdefault(new_owner, set()).add(prop)
+                counts = self.group_counts.setdefault(new_owner, {})
+                counts[prop.group] = counts.get(prop.group, 0) + 1
+                self.owner_worth[new_owner] = self.owner_worth.get(new_owner, 0) + worth
+        # Railroad and utility rent depends on how many of them the owners have
+        self._rebuild_rent(prop.group)
+        if self.on_worth_change is not None:
+            if old_owner is not None:
+                self.on_worth_change(old_owner, -worth)
+            if new_owner is not None:
+                self.on_worth_change(new_owner, worth)
+
+    def state_changed(self, prop, old_worth):
+        """
+        Update the rent table and the owner's property worth after buildings or a mortgage changed.
+        Called by Property.
+        """
+        self.rent_table[prop.name] = self._rent_for(prop)
+        change = prop.worth - old_worth
+        owner = prop.owner
+        if owner is None or not change:
+            return
+        with self.index_lock:
+            self.owner_worth[owner] += change
+        if self.on_worth_change is not None:
+            self.on_worth_change(owner, change)
+
+    def _rent_for(self, prop):
+        if prop.owner is None or prop.mortgaged:
+            return 0
+        if prop.prop_type == 'buildable':
+            return prop.rent
+        # Railroad and utility rents are listed by how many of the type are owned
+        rates = tuple(prop.rent_rates.values())
+        return rates[min(self.owned_count(prop.owner, prop.group), len(rates)) - 1]
+
+    def _rebuild_rent(self, group):
+        for prop in self.groups[group]:
+            self.rent_table[prop.name] = self._rent_for(prop)
+
+    def rent_due(self, prop, dice=None):
+        """
+        Rent for landing on a property, from the rent table.
+        Utilities charge the dice roll times their multiplier, so they need the roll.
+        Raises ValueError for a missing or impossible roll.
+        """
+        rent = self.rent_table[prop.name]
+        if prop.prop_type != 'utility':
+            return rent
+        if type(dice) is not int or not 2 <= dice <= 12:
+            raise ValueError('Utility rent needs the dice roll, a whole number from 2 to 12.')
+        return rent * dice
+
+    def worth_of(self, owner):
+        """
+        Total worth of the properties an account owns.
+        """
+        return self.owner_worth.get(owner, 0)
+
+    def reset(self):
+        """
+        Return every property to the bank, before loading saved ownership.
+        """
+        for prop in self.all_properties:
+            prop.owner = None
+            prop.rent_rate_index = 'Base'
+            prop.mortgaged = False
+
+    def release(self, owner):
+        """
+        Return an account's properties to the bank, like when it is deleted.
+        Returns the properties that were released.
+        """
+        released = self.owned_by(owner)
+        for prop in released:
+            prop.owner = None
+            prop.rent_rate_index = 'Base'
+            prop.mortgaged = False
+            self.update_color_set_rent(prop.color)
+        return released
+
+    def owned_by(self, owner):
+        """
+        Properties belonging to an account, in board order.
+        """
+        return self._listing(('owner', owner), lambda: self.by_owner.get(owner, ()))
+
+    def _listing(self, key, members):
+        """
+        Properties from an index in board order, sorted only once between changes of owner.
+        members is called with index_lock held.
+        """
+        with self.index_lock:
+            listing = self.listings.get(key)
+            if listing is None:
+                listing = tuple(sorted(members(), key=self.board_position.get))
+                self.listings[key] = listing
+        return listing
+
+    def owned_count(self, owner, group):
+        """
+        How many properties of a color, or of a type like railroad, an account owns.
+        """
+        return self.group_counts.get(owner, {}).get(group, 0)
 
     def check_full_set(self, color):
-        last_owner = None
-        for prop in self.complete_sets[color]:
-            if prop.owner is None:
-                return False
-            if prop.owner == last_owner or last_owner is None:
-                last_owner = prop.owner
-        return True
+        owner = next(iter(self.complete_sets[color])).owner
+        if owner is None:
+            return False
+        return self.owned_count(owner, color) == len(self.complete_sets[color])
 
     def update_color_set_rent(self, color):
         """
         Updates rent index if a color set is completed or broken.
         If a color set is broken, the rent rate will be reset back to base rent.
+        Houses and hotels on a complete set are kept.
         """
+        # Railroads and utilities don't have color sets
+        if color not in self.complete_sets:
+            return
         is_full_set = self.check_full_set(color)
-        print('Color set is complete!') if is_full_set else print('Color set seperated.')
         for prop in self.complete_sets[color]:
-            print(prop.name)
-            if is_full_set:
-                prop.rent_rate_index = 'Color set'
-            else:
-                prop.rent_rate_index = 'Base'
+            prop.rent_rate_index = self._set_rent_index(prop, is_full_set)
+        self._rebuild_rent(color)
+
+    def color_set_rents(self, prop, new_owner):
+        """
+        Rent indexes that change in a property's color set if it goes to new_owner,
+        as a dict of property to rent index, so they can be saved with the sale.
+        """
+        if prop.color not in self.complete_sets:
+            return {}
+        color_set = self.complete_sets[prop.color]
+        is_full_set = new_owner is not None and all(other.owner == new_owner for other in color_set if other is not prop)
+        rents = {other: self._set_rent_index(other, is_full_set) for other in color_set}
+        return {other: index for other, index in rents.items() if index != other.rent_rate_index}
+
+    @staticmethod
+    def _set_rent_index(prop, is_full_set):
+        if not is_full_set:
+            return 'Base'
+        # Buildings can only stand on a complete set, they set the rent themselves
+        return 'Color set' if prop.rent_rate_index == 'Base' else prop.rent_rate_index
 
     @cached_property
     def all_properties(self):
@@ -112,9 +341,9 @@ class PropertyManager:
 
     @property
     def unowned(self):
-        return tuple(filter(lambda p: True if p.owner is None else False, self.all_properties))
+        return self._listing(('unowned',), lambda: self.unowned_set)
 
     @property
     def owned(self):
-        return tuple(filter(lambda p: False if p.owner is None else True, self.all_properties))
+        return self._listing(('owned',), lambda: (p for owned_props in self.by_owner.values() for p in owned_props))
 
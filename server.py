@@ -1,19 +1,41 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
 import secrets
+import time
+from contextlib import ExitStack
+from functools import wraps
 from urllib.parse import urljoin, urlparse
 
-from flask import (Flask, Response, redirect, render_template, request,
-                   stream_with_context, flash, get_flashed_messages, abort, url_for)
+from flask import (Blueprint, Flask, Response, redirect, render_template, request,
+                   stream_with_context, flash, get_flashed_messages, abort, url_for, current_app, g,
+                   make_response, session)
 from flask_login import (LoginManager, login_required, login_user,
                          logout_user, current_user)
 from markupsafe import escape
 
-from account_store import AccountManager
+from account_store import check_amount
+from broker import ACCOUNTS_LIST_TOPIC, PROPERTIES_TOPIC
+from event_stream import EventStreamServer
+from games import DEFAULT_GAME, GameRegistry
+from leaderboard import LEADERBOARD_SIZE
+from page_cache import PageCache
+from passwords import HasherBusy
+from telemetry import Exposition, Histogram, configure_logging
+from tlog import EXPORT_FIELDS, HISTORY_PAGE_SIZE, TLogError, from_epoch_ms, parse_cursor
 
-from property_manger import PropertyManager
+logger = logging.getLogger('server')
 
 # TODO: Remove this
 TEMP_PASSWORD = 'temp'
 
+# Port for the asyncio event stream server.
+# Set to None to stream events from a Flask thread per client instead.
+EVENT_STREAM_PORT = 5001
+
 def urlify(ident, reverse=False):
     """
     Allow for a reversible "URLification" of characters.
@@ -70,7 +92,36 @@ def login_redirect(username, next_url):
     # See http://flask.pocoo.org/snippets/62/ for an example.
     if not is_safe_url(next_url):
         return abort(400)
-    return redirect(next_url or '/')
+    return redirect(next_url or f'{game_root()}/')
+
+def form_amount(form, field):
+    """
+    Dollar amount posted in a form field.
+    Aborts with a 400 unless it's a whole number the database can store.
+    """
+    try:
+        amount = int(form[field])
+        check_amount(amount)
+    except ValueError:
+        abort(400)
+    return amount
+
+def game_root():
+    """
+    Path the current game's pages are under, empty for the default game.
+    """
+    game_id = g.get('game_id', DEFAULT_GAME)
+    return '' if game_id == DEFAULT_GAME else f'/games/{game_id}'
+
+def event_stream_url():
+    """
+    URL pages should open their event stream on.
+    """
+    port = current_app.config.get('EVENT_STREAM_PORT')
+    if port is None:
+        return f'{game_root()}/bruh'
+    return f'{request.scheme}://{urlparse(request.host_url).hostname}:{port}{game_root()}/bruh'
+
 
 def render_generic(template_path, **kwargs):
     """
@@ -79,31 +130,182 @@ def render_generic(template_path, **kwargs):
     user_realname = current_user.name if not current_user.is_anonymous else 'Log in'
     user_id = current_user.ident if not current_user.is_anonymous else ''
     is_banker = current_user.banker if not current_user.is_anonymous else False
-    return render_template(template_path, logged_in=(not current_user.is_anonymous), user_id=user_id, user_realname=user_realname, is_banker=is_banker, **kwargs)
+    return render_template(template_path, logged_in=(not current_user.is_anonymous), user_id=user_id, user_realname=user_realname, is_banker=is_banker, event_stream_url=event_stream_url(), game_root=game_root(), **kwargs)
 
 
-if __name__ == '__main__':
+def ndjson_chunks(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def csv_chunks(chunks):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, EXPORT_FIELDS)
+    writer.writeheader()
+    for rows in chunks:
+        writer.writerows(rows)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    # An empty export is still a valid file with a header
+    if out.tell():
+        yield out.getvalue()
+
+
+# Export formats by file extension, as (MIME type, formatter of row chunks)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+    'csv': ('text/csv', csv_chunks)
+}
+
+
+def export_response(chunks, fmt, filename):
+    """
+    Stream TLog rows as a download, one chunk of rows at a time.
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    mimetype, formatter = EXPORT_FORMATS[fmt]
+    response = Response(stream_with_context(formatter(chunks)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
+
+
+def create_app(shared=False, event_stream_port=EVENT_STREAM_PORT, secret_key=None):
+    """
+    Build the Flask app and load games on demand.
+
+    Shared apps run as one of several processes, like WSGI workers, using the same
+    databases. The databases are then the source of truth: each process syncs its
+    accounts when another one commits, and requests that change a game take turns.
+    Stop the app's games and event stream with shutdown.
+    """
     app = Flask(__name__)
 
-    # Invalidate sessions when server restarts
-    # This avoids permanent key storage
-    app.secret_key = secrets.token_hex()
+    # Sessions are signed with MONOPOLY_SECRET_KEY when set, every worker needs the same key.
+    # Otherwise sessions are invalidated when the server restarts, which avoids permanent key storage.
+    secret_key = secret_key or os.environ.get('MONOPOLY_SECRET_KEY')
+    if secret_key is None and shared:
+        raise RuntimeError('Set MONOPOLY_SECRET_KEY so every worker signs sessions with the same key.')
+    app.secret_key = secret_key or secrets.token_hex()
 
     login_manager = LoginManager()
     login_manager.init_app(app)
-    login_manager.login_view = 'login'
-
-    managed_props = PropertyManager('property_set.json')
-
-    managed_accs = AccountManager(managed_props)
+    login_manager.login_view = 'game.login'
+    login_manager.blueprint_login_views = {'game': 'game.login', 'games': 'games.login'}
+
+    # Every game has its own accounts, properties and database.
+    # The default game is served at the root, others under /games/<game_id>.
+    games = GameRegistry('property_set.json', shared=shared)
+    game_routes = Blueprint('game', __name__)
+    page_cache = PageCache()
+
+    # Event streams are served by asyncio so open tabs don't hold Flask threads
+    app.config['EVENT_STREAM_PORT'] = event_stream_port
+    event_stream = None
+    if event_stream_port is not None:
+        event_stream = EventStreamServer(games.broker(DEFAULT_GAME), port=event_stream_port, find_broker=games.broker)
+        event_stream.start()
+    app.extensions['games'] = games
+    app.extensions['event_stream'] = event_stream
+
+
+    @game_routes.url_value_preprocessor
+    def pull_game_id(endpoint, values):
+        g.game_id = values.pop('game_id', DEFAULT_GAME) if values else DEFAULT_GAME
+
+    @game_routes.url_defaults
+    def add_game_id(endpoint, values):
+        if 'game_id' in g and app.url_map.is_endpoint_expecting(endpoint, 'game_id'):
+            values.setdefault('game_id', g.game_id)
+
+    @game_routes.before_request
+    def load_game():
+        """
+        Load the requested game, it stays loaded until the request finishes.
+        """
+        try:
+            g.game = games.acquire(g.game_id)
+        except KeyError:
+            abort(404)
+        if games.shared:
+            g.game.accounts.sync()
+            # Changes run one request at a time across every process.
+            # Logins hash passwords outside the turn, new accounts take their own.
+            if request.method != 'GET' and request.endpoint.rpartition('.')[2] != 'login':
+                g.game_turn = ExitStack()
+                g.game_turn.enter_context(g.game.accounts.shared_write())
+
+    @app.teardown_request
+    def release_game(exc):
+        turn = g.pop('game_turn', None)
+        game = g.pop('game', None)
+        try:
+            if turn is not None:
+                turn.close()
+        except TLogError as e:
+            # The response is already decided, so the failure can only be logged
+            logger.error('ending shared turn failed game=%s error=%s', g.game_id, e)
+        finally:
+            if game is not None:
+                games.release(game)
+
+    # Latency histograms by endpoint and method
+    route_times = dict()
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_route_time(response):
+        # Streamed responses are timed until their headers are ready
+        key = (request.endpoint or 'unmatched', request.method)
+        histogram = route_times.get(key)
+        if histogram is None:
+            histogram = route_times.setdefault(key, Histogram())
+        histogram.observe(time.perf_counter() - g.request_start)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        """
+        Server metrics in the Prometheus text format.
+        """
+        out = Exposition()
+        for game in games.loaded_games:
+            accounts = game.accounts
+            tlog = accounts.tlog_connection
+            out.gauge('tlog_exec_queue_depth', 'Commands waiting for the TLog writer.', tlog.queue_depth(), game=game.game_id)
+            out.histogram('tlog_commit_seconds', 'Time the TLog writer takes to apply and commit a batch.', tlog.commit_seconds, game=game.game_id)
+            out.histogram('tlog_commit_statements', 'Statements in each TLog commit.', tlog.commit_sizes, game=game.game_id)
+            for lock, (wait, hold) in accounts.lock_times.items():
+                out.histogram('lock_wait_seconds', 'Time spent waiting for a write lock.', wait, game=game.game_id, lock=lock)
+                out.histogram('lock_hold_seconds', 'Time a write lock was held.', hold, game=game.game_id, lock=lock)
+            out.gauge('accounts', 'Accounts in the game.', accounts.num_accounts, game=game.game_id)
+        for game_id, broker in games.known_brokers.items():
+            out.gauge('sse_subscribers', 'Open event stream subscriptions.', broker.subscriber_count, game=game_id)
+        if event_stream is not None:
+            out.gauge('event_stream_connections', 'Connections open on the event stream server.', event_stream.active_connections)
+        out.gauge('games_loaded', 'Games loaded in memory.', len(games.loaded))
+        out.counter('logins_rejected_total', 'Logins turned away because the password hasher was busy.', games.hasher.rejected)
+        out.counter('page_cache_hits_total', 'Pages served from the render cache.', page_cache.hits)
+        out.counter('page_cache_misses_total', 'Pages rendered because they were not cached.', page_cache.misses)
+        for (endpoint, method), histogram in list(route_times.items()):
+            out.histogram('request_seconds', 'Time to handle a request.', histogram, endpoint=endpoint, method=method)
+        return Response(out.render(), mimetype='text/plain; version=0.0.4')
 
 
     @login_manager.user_loader
     def load_user(ident):
         """
         This is required for Flask-Login.
+        Session IDs look like "<game_id>:<account ID>", a login only counts in its own game.
         """
-        user = managed_accs.query(ident)
+        game_id, _, ident = ident.partition(':')
+        if 'game' not in g or game_id != g.game_id:
+            return None
+        user = g.game.accounts.query(ident)
         if user == 'Account does not exist.':
             return None
         return user
@@ -117,48 +319,91 @@ if __name__ == '__main__':
         if 'transfer-amount' in args:
             account1 = args['account-1-id']
             account2 = args['account-2-id']
-            amount = args['transfer-amount']
+            amount = form_amount(args, 'transfer-amount')
             direction = args['transfer-direction']
             if direction == 'primary':
-                info = managed_accs.transfer(account1, account2, int(amount))
+                info = g.game.accounts.transfer(account1, account2, amount)
             else:
-                info = managed_accs.transfer(account2, account1, int(amount))
+                info = g.game.accounts.transfer(account2, account1, amount)
         return info
 
 
+    def cached_page(*topics):
+        """
+        Serve a GET page from the cache until something is published on its topics.
+        Pages are kept per game and per user, since the sidebar shows who is logged in.
+        The ETag lets browsers revalidate a page and get a 304 when nothing changed.
+        """
+        def decorator(view):
+            @wraps(view)
+            def cached_view(*args, **kwargs):
+                # Posts change state, and pages showing flashed messages are one-offs
+                if request.method != 'GET' or session.get('_flashes'):
+                    return view(*args, **kwargs)
+                broker = g.game.accounts.broker
+                user_key = '' if current_user.is_anonymous else current_user.get_id()
+                key = (g.game_id, request.full_path, broker.version_of(topics), user_key)
+                etag = hashlib.sha256(repr((broker.token, key)).encode()).hexdigest()[:32]
+                if request.if_none_match.contains_weak(etag):
+                    response = Response(status=304)
+                else:
+                    page = page_cache.get(key)
+                    if page is None:
+                        page = view(*args, **kwargs)
+                        # Redirects and error pages aren't cached
+                        if not isinstance(page, str):
+                            return page
+                        page_cache.put(key, page)
+                    response = make_response(page)
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            return cached_view
+        return decorator
+
+
     # BEGIN TARGET PAGE ROUTES
     # All functions below tie to specific site routes
 
 
-    @app.route('/')
+    @game_routes.route('/')
     def home_page():
         if not current_user.is_anonymous:
             flash(current_user)
         return render_generic('home.html.jinja')
 
 
-    @app.route('/login', methods=['GET', 'POST'])
+    @game_routes.route('/login', methods=['GET', 'POST'])
     def login():
         failed_login = False
         if 'login-username' in request.form:
-            user = managed_accs.query(request.form['login-username'])
-            print(f"{request.form['login-username']}: {request.form['login-password']}")
+            user = g.game.accounts.query(request.form['login-username'])
             if user == 'Account does not exist.':
                 flash(user)
-            elif user.is_authenticated(request.form['login-password']):
-                # Login and validate the user.
-                # user should be an instance of your `User` class
-                return login_redirect(user, request.args.get('next'))
-
             else:
+                try:
+                    user = g.game.accounts.authenticate(request.form['login-username'], request.form['login-password'])
+                except HasherBusy as busy:
+                    flash(str(busy))
+                    return render_generic('login.html.jinja'), 503
+                logger.info('login game=%s user=%s ok=%s', g.game_id, request.form['login-username'], user is not None)
+                if user is not None:
+                    # Login and validate the user.
+                    # user should be an instance of your `User` class
+                    return login_redirect(user, request.args.get('next'))
                 flash('Incorrect password')
 
         elif 'signup-username' in request.form:
             new_username = request.form['signup-username']
             new_realname = request.form['signup-realname']
             new_password = request.form['signup-password']
-            if managed_accs.new(new_username, new_realname, new_password):
-                user = managed_accs.query(new_username)
+            try:
+                created = g.game.accounts.new(new_username, new_realname, new_password)
+            except HasherBusy as busy:
+                flash(str(busy))
+                return render_generic('login.html.jinja'), 503
+            if created:
+                user = g.game.accounts.query(new_username)
                 return login_redirect(user, request.args.get('next'))
             else:
                 flash('Username for account already exists.')
@@ -166,63 +411,70 @@ if __name__ == '__main__':
         return render_generic('login.html.jinja')
 
 
-    @app.route('/logout', methods=['GET', 'POST'])
+    @game_routes.route('/logout', methods=['GET', 'POST'])
     @login_required
     def logout():
         logout_user()
         flash('Succesfully logged out')
-        return redirect('/')
+        return redirect(url_for('.home_page'))
 
 
-    @app.route('/accounts/', methods=['GET', 'POST'])
+    @game_routes.route('/accounts/', methods=['GET', 'POST'])
+    @cached_page(ACCOUNTS_LIST_TOPIC)
     def accounts_main_page():
-        managed_accs.recieved_update()
         # Show all accounts by default
-        lookup = sorted(managed_accs.accounts_storage.values(), key=lambda a: a.name)
+        lookup = g.game.accounts.sorted_accounts
         query = ''
         # Check if new account was created
         if 'new-acc-name' in request.form:
             if current_user.is_anonymous or not current_user.banker:
                 flash('Operation only allowed for banker.')
-                return redirect(url_for('accounts_main_page'))
+                return redirect(url_for('.accounts_main_page'))
             new_id, new_name, new_cash = (
                 request.form['new-acc-id'],
                 request.form['new-acc-name'].title(),
-                int(request.form['new-acc-cash'])
+                form_amount(request.form, 'new-acc-cash')
             )
-            if managed_accs.new(new_id, new_name, TEMP_PASSWORD, new_cash):
+            try:
+                created = g.game.accounts.new(new_id, new_name, TEMP_PASSWORD, new_cash)
+            except HasherBusy as busy:
+                flash(str(busy))
+                return render_generic('accounts.html.jinja', make_url=urlify, num_accs=len(g.game.accounts.accounts_storage), lookup=lookup), 503
+            if created:
                 flash('Created new account.')
                 flash(f'Temporary password for new user {new_id}: "{TEMP_PASSWORD}"')
             else:
                 flash('Could not create account. Does an ID for that account already exist?')
             if 'account-redirect' in request.form:
-                return redirect(url_for('individual_account_page', ident=request.form["account-redirect"]))
-            lookup = sorted(managed_accs.accounts_storage.values(), key=lambda a: a.name)
+                return redirect(url_for('.individual_account_page', ident=request.form["account-redirect"]))
+            lookup = g.game.accounts.sorted_accounts
         # Check if account was deleted
         elif 'del-acc-id' in request.form:
             if current_user.is_anonymous or not current_user.banker:
                 flash('Operation only allowed for banker.')
-                return redirect(url_for('accounts_main_page'))
-            managed_accs.delete(request.form['del-acc-id'])
-            flash(f'Deleted account for ID {request.form["del-acc-id"]}.')
+                return redirect(url_for('.accounts_main_page'))
+            if g.game.accounts.delete(request.form['del-acc-id']):
+                flash(f'Deleted account for ID {request.form["del-acc-id"]}.')
+            else:
+                flash(f'Could not delete account. Does an account with ID {request.form["del-acc-id"]} exist?')
             # This is required so the deleted account doesn't show on the page
-            lookup = sorted(managed_accs.accounts_storage.values(), key=lambda a: a.name)
+            lookup = g.game.accounts.sorted_accounts
         # Do account query as applicable
         elif 'account-lookup-query' in request.form:
             query = request.form['account-lookup-query']
-            lookup = sorted(managed_accs.search(query).values(), key=lambda a: a.name)
+            lookup = tuple(g.game.accounts.search(query).values())
             flash(f'{len(lookup)} result{"s" if len(lookup) > 1 else ""} for search "{query}".')
 
-        return render_generic('accounts.html.jinja', make_url=urlify, num_accs=len(managed_accs.accounts_storage), lookup=lookup)
+        return render_generic('accounts.html.jinja', make_url=urlify, num_accs=len(g.game.accounts.accounts_storage), lookup=lookup)
 
-    @app.route('/accounts/<ident>', methods=['GET', 'POST'])
+    @game_routes.route('/accounts/<ident>', methods=['GET', 'POST'])
     def individual_account_page(ident):
-        managed_accs.recieved_update()
         ident = urlify(ident, reverse=True)
-        target_account = managed_accs.query(ident)
+        target_account = g.game.accounts.query(ident)
         if target_account == 'Account does not exist.':
             return render_generic('no_existing_account.html.jinja', id=ident) if not current_user.is_anonymous and current_user.banker else abort(404)
-        account_log = target_account.get_transactions()
+        # Only the newest page of history is rendered, older pages are fetched on demand
+        account_log, older_cursor = target_account.get_transaction_page()
         # Check for money transferring
         if 'transfer-amount' in request.form:
             if current_user.is_anonymous or not current_user.banker:
@@ -231,26 +483,182 @@ if __name__ == '__main__':
         elif 'withdraw-amount' in request.form:
             if current_user.is_anonymous or not current_user.banker:
                 abort(403)
-            amount = target_account.withdraw(int(request.form['withdraw-amount']))
+            amount = target_account.withdraw(form_amount(request.form, 'withdraw-amount'))
             flash(f'Withdrew ${amount} from account.')
         elif 'deposit-amount' in request.form:
             if current_user.is_anonymous or not current_user.banker:
                 abort(403)
-            amount = target_account.deposit(int(request.form['deposit-amount']))
+            try:
+                amount = target_account.deposit(form_amount(request.form, 'deposit-amount'))
+            except ValueError as refused:
+                # The balance would go past what the database can store
+                flash(str(refused))
+                return render_generic('individual_account.html.jinja', acc=target_account, account_log=account_log, older_cursor=older_cursor, make_url=urlify), 400
             flash(f'Deposited ${amount} into account.')
 
-        return render_generic('individual_account.html.jinja', acc=target_account, account_log=account_log)
+        return render_generic('individual_account.html.jinja', acc=target_account, account_log=account_log, older_cursor=older_cursor, make_url=urlify)
+
+    @game_routes.route('/accounts/<ident>/transactions')
+    def account_transactions_api(ident):
+        """
+        Keyset-paginated transaction history, newest first.
+        Use the returned "next" cursor as ?before= to get older rows.
+        """
+        target_account = g.game.accounts.query(urlify(ident, reverse=True))
+        if target_account == 'Account does not exist.':
+            abort(404)
+        before = request.args.get('before')
+        try:
+            before = parse_cursor(before) if before else None
+            limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+        except ValueError:
+            abort(400)
+        rows, older_cursor = target_account.get_transaction_page(before, limit)
+        return {
+            'transactions': [
+                {'time': str(timestamp), 'type': trans_type, 'info': trans_info}
+                for timestamp, trans_type, trans_acc, trans_info in rows
+            ],
+            'next': older_cursor
+        }
+
+    @game_routes.route('/accounts/<ident>/export.<fmt>')
+    def account_export(ident, fmt):
+        """
+        An account's whole history, archived sessions included, oldest first.
+        """
+        target_account = g.game.accounts.query(urlify(ident, reverse=True))
+        if target_account == 'Account does not exist.':
+            abort(404)
+        return export_response(g.game.accounts.tlog_connection.export_chunks(target_account.ident), fmt, f'{g.game_id}-{ident}')
+
+    @game_routes.route('/export/tlog.<fmt>')
+    def tlog_export(fmt):
+        """
+        Every TLog row of the game, archived sessions included, oldest first.
+        """
+        if current_user.is_anonymous or not current_user.banker:
+            abort(403)
+        return export_response(g.game.accounts.tlog_connection.export_chunks(), fmt, f'{g.game_id}-tlog')
 
-    @app.route('/change-cash', methods=['GET', 'POST'])
+    @game_routes.route('/export/snapshot.json')
+    def snapshot_export():
+        """
+        Every balance and owned property as of the newest snapshot.
+        """
+        if current_user.is_anonymous or not current_user.banker:
+            abort(403)
+        snapshot = g.game.accounts.tlog_connection.get_latest_snapshot()
+        if snapshot is None:
+            abort(404)
+        stamp, last_log_id, state = snapshot
+        return {
+            'time': from_epoch_ms(stamp).isoformat(timespec='milliseconds'),
+            'last log id': last_log_id,
+            'accounts': dict(state['accounts']),
+            'properties': [
+                {'name': name, 'owner': owner, 'rent index': rent_index, 'mortgaged': bool(mortgaged)}
+                for name, owner, rent_index, mortgaged in state['properties']
+            ]
+        }
+
+    @game_routes.route('/api/v1/games', methods=['POST'])
+    def create_game_api():
+        """
+        Create a new game, served under /games/<game_id>/.
+        The body is {"game": game_id}. Only the banker of the default game can create games.
+        """
+        if g.game_id != DEFAULT_GAME or current_user.is_anonymous or not current_user.banker:
+            return {'error': 'Only the banker of the default game can create games.'}, 403
+        body = request.get_json(silent=True)
+        game_id = body.get('game') if isinstance(body, dict) else None
+        if not isinstance(game_id, str) or not games.valid_id(game_id):
+            return {'error': 'Expected a JSON object with a game ID of up to 64 letters, digits, dashes or underscores.'}, 400
+        if not games.create(game_id):
+            return {'error': f'Game {game_id} already exists.'}, 409
+        return {'game': game_id, 'url': f'/games/{game_id}/'}, 201
+
+    @game_routes.route('/api/v1/leaderboard')
+    def leaderboard_api():
+        """
+        The richest accounts by net worth, ?limit= sets how many.
+        Subscribe to the leaderboard topic to hear when it changes.
+        """
+        try:
+            limit = int(request.args.get('limit', LEADERBOARD_SIZE))
+        except ValueError:
+            abort(400)
+        leaderboard = g.game.accounts.leaderboard
+        response = {'leaderboard': leaderboard.top(limit)}
+        if not current_user.is_anonymous:
+            response['rank'] = leaderboard.rank_of(current_user.ident)
+        return response
+
+    @game_routes.route('/api/v1/rent', methods=['POST'])
+    def rent_api():
+        """
+        Pay rent for landing on a property.
+        The body is {"payer": id, "property": name, "dice": roll}, the roll only for utilities.
+        The banker can charge anyone, other players only pay their own rent.
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('payer'), str) or not isinstance(body.get('property'), str):
+            return {'error': 'Expected a JSON object with a payer and a property.'}, 400
+        if current_user.is_anonymous or not (current_user.banker or current_user.ident == body['payer']):
+            return {'error': 'Only the banker or the payer can pay rent.'}, 403
+        try:
+            owner, rent, info = g.game.accounts.pay_rent(body['payer'], body['property'], body.get('dice'))
+        except ValueError as error:
+            return {'error': str(error)}, 409
+        return {'owner': owner, 'rent': rent, 'info': info}
+
+    @game_routes.route('/api/v1/batch', methods=['POST'])
+    def batch_api():
+        """
+        Run a list of deposits, withdrawals and transfers in one request.
+        The body is {"operations": [...], "atomic": true}, see AccountManager.batch.
+        Atomic batches are all applied or none are, otherwise each
+        operation succeeds or fails on its own.
+        """
+        if current_user.is_anonymous or not current_user.banker:
+            return {'error': 'Operation only allowed for banker.'}, 403
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('operations'), list):
+            return {'error': 'Expected a JSON object with a list of operations.'}, 400
+        atomic = bool(body.get('atomic', True))
+        applied, results = g.game.accounts.batch(body['operations'], atomic)
+        # A rejected atomic batch changed nothing
+        return {'applied': applied, 'results': results}, 409 if atomic and not applied else 200
+
+    @game_routes.route('/api/v1/bulk', methods=['POST'])
+    def bulk_api():
+        """
+        Change many balances the same way in one request, like paying everyone $200.
+        The body is {"op": "deposit", "amount": 200}, with "accounts": [...] to
+        change only some accounts, see AccountManager.bulk.
+        """
+        if current_user.is_anonymous or not current_user.banker:
+            return {'error': 'Operation only allowed for banker.'}, 403
+        body = request.get_json(silent=True)
+        accounts = body.get('accounts') if isinstance(body, dict) else None
+        if not isinstance(body, dict) or not (accounts is None or isinstance(accounts, list) and all(isinstance(ident, str) for ident in accounts)):
+            return {'error': 'Expected a JSON object with an op, an amount and optionally a list of accounts.'}, 400
+        try:
+            changes = g.game.accounts.bulk(body.get('op'), body.get('amount'), accounts)
+        except ValueError as error:
+            return {'error': str(error)}, 400
+        return {'changes': changes}
+
+    @game_routes.route('/change-cash', methods=['GET', 'POST'])
     @login_required
     def change_cash():
         if not current_user.banker:
             abort(403)
         if 'id-card' in request.form:
-            return redirect(url_for('individual_account_page', ident=request.form["id-card"]))
+            return redirect(url_for('.individual_account_page', ident=request.form["id-card"]))
         return render_generic('change_cash.html.jinja')
 
-    @app.route('/transfer', methods=['GET', 'POST'])
+    @game_routes.route('/transfer', methods=['GET', 'POST'])
     @login_required
     def transfer():
         if not current_user.banker:
@@ -259,41 +667,45 @@ if __name__ == '__main__':
         return render_generic('transfer.html.jinja')
 
 
-    @app.route('/properties/')
+    @game_routes.route('/properties/')
+    @cached_page(PROPERTIES_TOPIC)
     def properties_page():
-        return render_generic('properties.html.jinja', property_list=managed_props.all_properties)
+        return render_generic('properties.html.jinja', property_list=g.game.prop_manager.all_properties)
 
 
-    @app.route('/properties/<prop_name>')
+    @game_routes.route('/properties/<prop_name>')
+    @cached_page(PROPERTIES_TOPIC)
     def individual_property_page(prop_name):
-        return render_generic('individual_property.html.jinja', prop=managed_props.properties[prop_name])
+        return render_generic('individual_property.html.jinja', prop=g.game.prop_manager.properties[prop_name])
 
 
-    @app.route('/properties/<prop_name>/api', methods=['POST'])
+    @game_routes.route('/properties/<prop_name>/api', methods=['POST'])
     def individual_property_api(prop_name):
-        prop_obj = managed_props.properties[prop_name]
+        if prop_name not in g.game.prop_manager.properties:
+            abort(404)
         if not current_user.is_anonymous:
             # Banker operations
             if current_user.banker and 'new owner' in request.json:
-                acc_obj = managed_accs.query(request.json['new owner'])
-                acc_obj.withdraw(prop_obj.costs['property'])
-                acc_obj.add_property(prop_obj)
+                try:
+                    g.game.accounts.buy_property(request.json['new owner'], prop_name)
+                except ValueError as error:
+                    return {'error': str(error)}, 409
                 return {'response': f'Made {request.json["new owner"]} new owner of {prop_name}'}
             # Property owner operations
-            if current_user.ident == managed_props.properties[prop_name].owner:
+            if current_user.ident == g.game.prop_manager.properties[prop_name].owner:
                 # TODO: add property owner operations
                 pass
             else:
                 return {'response': 'No valid request made by non-anonymous user'}
 
         user_name = str(current_user.ident if not current_user.is_anonymous else '')
-        return {'property': managed_props.properties[prop_name].json, 'request': request.json, 'user': user_name}
+        return {'property': g.game.prop_manager.properties[prop_name].json, 'request': request.json, 'user': user_name}
 
 
     # TODO: Finish pages
-    @app.route('/investments')
-    @app.route('/auctions')
-    @app.route('/help')
+    @game_routes.route('/investments')
+    @game_routes.route('/auctions')
+    @game_routes.route('/help')
     def placeholder_page():
         return render_generic('sidebar.html.jinja')
 
@@ -307,29 +719,60 @@ if __name__ == '__main__':
     def unauthorized_page(e):
         return render_generic('unauthorized_access.html.jinja'), 403
 
-
-    # Event stream that triggers on any change
-    # TODO: Make this trigger with more specific changes
-    @app.route('/bruh')
+    @app.errorhandler(TLogError)
+    def unsaved_change(e):
+        # Changes are only made in memory once saved, so nothing has changed when saving fails
+        logger.warning('change not saved game=%s error=%s', g.get('game_id'), e)
+        if request.is_json:
+            return {'error': str(e)}, 503
+        flash(str(e))
+        return render_generic('sidebar.html.jinja'), 503
+
+
+    # Event stream of changes to the topics given in ?topics=
+    # Topics are comma separated, like "account:<id>,accounts-list,leaderboard"
+    # This holds a thread per client, EventStreamServer serves the same
+    # stream without that when EVENT_STREAM_PORT is set.
+    @game_routes.route('/bruh')
     def bruh():
+        topics = [t for t in request.args.get('topics', '').split(',') if t]
+        if not topics:
+            topics = [ACCOUNTS_LIST_TOPIC, PROPERTIES_TOPIC]
+
+        broker = g.game.accounts.broker
+
         @stream_with_context
         def signal_updates():
-            while True:
-                managed_accs.server_update_signal.wait()
-                print("Sending update...")
-                yield 'data: {"sync": true}\n\n'
-                managed_accs.recieved_update()
+            with broker.subscribe(topics) as subscription:
+                while True:
+                    message = subscription.get()
+                    logger.debug('sending update topic=%s', message.get('topic'))
+                    yield f'data: {json.dumps(message)}\n\n'
         return Response(signal_updates(), mimetype='text/event-stream')
 
 
+    app.register_blueprint(game_routes)
+    app.register_blueprint(game_routes, url_prefix='/games/<game_id>', name='games')
+    return app
+
+
+def shutdown(app):
+    """
+    Stop the event stream and close every game's TLog.
+    """
+    event_stream = app.extensions['event_stream']
+    if event_stream is not None:
+        event_stream.stop()
+    for m in app.extensions['games'].cleanup():
+        logger.info(m.strip())
+
+
+if __name__ == '__main__':
+    configure_logging()
+    app = create_app()
     # Run the application until stopped or encountering an error
     try:
         app.run()
-    # Clean up the application and close the TLog
+    # Clean up the application and close every game's TLog
     finally:
-        for m in managed_accs.cleanup():
-            print(m)
-
-
-if __name__ == 'wsgi':
-    print('Avoid running with flask run as it doesn\'t allow the db to close.')
+        shutdown(app)
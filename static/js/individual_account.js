@@ -29,3 +29,29 @@ if (do_transfer_button != null) {
         deposit_form.classList.add('hidden');
     });
 }
+
+const load_older_button = document.querySelector('#load-older');
+const audit_log_rows = document.querySelector('#audit-log-rows');
+
+// Fetch the next older page of the audit log and append it to the table.
+if (load_older_button != null) {
+    load_older_button.addEventListener('click', () => {
+        const params = new URLSearchParams({'before': load_older_button.dataset.cursor});
+        fetch(`${load_older_button.dataset.url}?${params}`)
+            .then(res => res.json())
+            .then(page => {
+                page['transactions'].forEach(trans => {
+                    const row = audit_log_rows.insertRow();
+                    for (const key of ['time', 'type', 'info']) {
+                        row.insertCell().textContent = trans[key] ?? 'None';
+                    }
+                });
+                if (page['next'] == null) {
+                    load_older_button.remove();
+                } else {
+                    load_older_button.dataset.cursor = page['next'];
+                }
+            })
+            .catch(err => console.error('Failed to load older transactions.', err));
+    });
+}
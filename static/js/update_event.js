@@ -1,5 +1,15 @@
 // Forms or other elements that are sensitive to refreshes when unhidden.
-const update_sensitive = [document.querySelector('#make-new-acc'), document.querySelector('#transfer-form')];
+const update_sensitive = [
+    document.querySelector('#make-new-acc'),
+    document.querySelector('#transfer-form'),
+    document.querySelector('#withdraw-form'),
+    document.querySelector('#deposit-form')
+];
+
+// Topics this page listens to are set on the script tag, like data-topics="accounts-list"
+const update_topics = document.currentScript.dataset.topics ?? '';
+// The event stream may be served on its own port
+const update_url = document.currentScript.dataset.url ?? '/bruh';
 
 // Don't force refresh if accounts change.
 // If the intention is to create or modify an account,
@@ -19,7 +29,7 @@ function keepFormsAlive() {
     });
 }
 
-const update_event = new EventSource("/bruh");
+const update_event = new EventSource(`${update_url}?${new URLSearchParams({'topics': update_topics})}`);
 
 window.addEventListener('load', () => {
     update_event.onmessage = function(req) {
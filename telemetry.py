@@ -0,0 +1,169 @@
+import logging
+import os
+import random
+import time
+from bisect import bisect_left
+from multiprocessing import Array
+from multiprocessing import Lock as ProcessLock
+from threading import Lock
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds of the statements per commit buckets
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Log level and the fraction of debug and info records kept, from the environment.
+# Warnings and errors are never sampled away.
+LOG_LEVEL = os.environ.get('MONOPOLY_LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATE = float(os.environ.get('MONOPOLY_LOG_SAMPLE', '1'))
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, with their running total.
+    A shared histogram lives in shared memory so another process can observe into it.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS, shared=False):
+        self.buckets = tuple(buckets)
+        if shared:
+            self.counts = Array('Q', len(self.buckets) + 1, lock=False)
+            self.total = Array('d', 1, lock=False)
+            self.lock = ProcessLock()
+        else:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.total = [0.0]
+            self.lock = Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.add(value)
+
+    def add(self, value):
+        """
+        Observe without taking the histogram's lock, for callers that already serialise.
+        """
+        # The last count is for values over every bucket
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total[0] += value
+
+    def snapshot(self):
+        """
+        Counts per bucket and the total, read together.
+        """
+        with self.lock:
+            return list(self.counts), self.total[0]
+
+    @classmethod
+    def merged(cls, histograms):
+        """
+        One histogram holding the observations of all the given ones.
+        """
+        histograms = list(histograms)
+        merged = cls(histograms[0].buckets)
+        for histogram in histograms:
+            counts, total = histogram.snapshot()
+            merged.counts = [a + b for a, b in zip(merged.counts, counts)]
+            merged.total[0] += total
+        return merged
+
+
+class TimedLock:
+    """
+    A lock that records how long callers waited for it and how long they held it.
+    Times are recorded while the lock is held, so its histograms need no lock of their own.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.acquired_at = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait.add(self.acquired_at - start)
+        return True
+
+    def release(self):
+        self.hold.add(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Exposition:
+    """
+    Metrics collected for one scrape, rendered in the Prometheus text format.
+    """
+    def __init__(self, prefix='monopoly_'):
+        self.prefix = prefix
+        self.families = dict()
+
+    def _family(self, name, kind, help_text):
+        name = self.prefix + name
+        if name not in self.families:
+            self.families[name] = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        return name, self.families[name]
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+        return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+    def gauge(self, name, help_text, value, **labels):
+        name, lines = self._family(name, 'gauge', help_text)
+        lines.append(f'{name}{self._labels(labels)} {value}')
+
+    def counter(self, name, help_text, value, **labels):
+        name, lines = self._family(name, 'counter', help_text)
+        lines.append(f'{name}{self._labels(labels)} {value}')
+
+    def histogram(self, name, help_text, histogram, **labels):
+        name, lines = self._family(name, 'histogram', help_text)
+        counts, total = histogram.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{self._labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{name}_sum{self._labels(labels)} {total}')
+        lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+
+    def render(self):
+        return '\n'.join(line for lines in self.families.values() for line in lines) + '\n'
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep only a fraction of debug and info records, so busy games can log without flooding.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def configure_logging(level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE):
+    """
+    Log to stderr at the given level.
+    Hot paths log at debug with lazy arguments, below the level they cost a level check.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if sample_rate < 1:
+        handler.addFilter(SampleFilter(sample_rate))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+
+import pytest
+
+from account_store import MAX_CASH, AccountManager
+from passwords import PasswordHasher
+from property_manger import PropertyManager
+from tlog import TLogError
+
+PROPERTY_SET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'property_set.json')
+
+
+@pytest.fixture
+def accounts(tmp_path):
+    manager = AccountManager(PropertyManager(PROPERTY_SET), PasswordHasher(workers=0, iterations=1), db_filename=str(tmp_path / 'tlog.db'))
+    manager.new('bk', 'bank', 'password', 1000)
+    manager.new('p1', 'one', 'password', 500)
+    manager.new('p2', 'two', 'password', 300)
+    yield manager
+    for _ in manager.cleanup():
+        pass
+
+
+def saved_balances(accounts):
+    return dict(accounts.tlog_connection.read("SELECT id, cash FROM Accounts", consistent=True))
+
+
+def balances(accounts):
+    return {ident: acc.cash for ident, acc in accounts.accounts_storage.items()}
+
+
+def test_atomic_batch_applies_nothing_when_one_operation_fails(accounts):
+    all_ok, results = accounts.batch([
+        {'op': 'deposit', 'account': 'p1', 'amount': 50},
+        {'op': 'transfer', 'payer': 'p2', 'payee': 'p1', 'amount': 301},
+    ])
+    assert not all_ok
+    assert [result['ok'] for result in results] == [False, False]
+    assert 'enough funds' in results[1]['error']
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': 500, 'p2': 300}
+
+
+def test_batch_checks_each_operation_against_the_ones_before_it(accounts):
+    all_ok, results = accounts.batch([
+        {'op': 'transfer', 'payer': 'p2', 'payee': 'p1', 'amount': 300},
+        {'op': 'transfer', 'payer': 'p2', 'payee': 'p1', 'amount': 1},
+        {'op': 'withdraw', 'account': 'p1', 'amount': 10000},
+    ], atomic=False)
+    assert not all_ok
+    assert [result['ok'] for result in results] == [True, False, True]
+    # Withdrawals empty the account rather than overdrawing it
+    assert results[2]['amount'] == 800
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': 0, 'p2': 0}
+
+
+@pytest.mark.parametrize('op', [
+    'deposit',
+    {'op': 'steal', 'account': 'p1', 'amount': 5},
+    {'op': 'deposit', 'account': 'p1', 'amount': 0},
+    {'op': 'deposit', 'account': 'p1', 'amount': 1.5},
+    {'op': 'deposit', 'account': 'p1', 'amount': True},
+    {'op': 'deposit', 'account': ['p1'], 'amount': 5},
+    {'op': 'deposit', 'account': 'nobody', 'amount': 5},
+    {'op': 'deposit', 'account': 'p1', 'amount': MAX_CASH + 1},
+    {'op': 'deposit', 'account': 'p1', 'amount': MAX_CASH},
+    {'op': 'transfer', 'payer': 'p1', 'payee': 'p1', 'amount': 5},
+])
+def test_batch_refuses_invalid_operations(accounts, op):
+    all_ok, results = accounts.batch([op])
+    assert not all_ok
+    assert not results[0]['ok']
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': 500, 'p2': 300}
+
+
+def test_bulk_changes_every_account(accounts):
+    assert accounts.bulk('deposit', 200) == {'bk': 200, 'p1': 200, 'p2': 200}
+    # Taxes are rounded toward zero
+    assert accounts.bulk('percent', -10, ['p1', 'p2']) == {'p1': -70, 'p2': -50}
+    assert accounts.bulk('withdraw', 600) == {'bk': -600, 'p1': -600, 'p2': -450}
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 600, 'p1': 30, 'p2': 0}
+
+
+@pytest.mark.parametrize('op, amount, idents', [
+    ('steal', 5, None),
+    ('deposit', 0, None),
+    ('deposit', -5, None),
+    ('deposit', 2.5, None),
+    ('deposit', MAX_CASH + 1, None),
+    ('deposit', MAX_CASH - 600, None),
+    ('percent', 0, None),
+    ('percent', -101, None),
+    ('percent', float('nan'), None),
+    ('deposit', 5, ['p1', 'nobody']),
+])
+def test_bulk_refuses_invalid_changes(accounts, op, amount, idents):
+    with pytest.raises(ValueError):
+        accounts.bulk(op, amount, idents)
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': 500, 'p2': 300}
+
+
+def test_deposit_past_max_cash_is_refused(accounts):
+    p1 = accounts.query('p1')
+    p1.deposit(MAX_CASH - 600)
+    with pytest.raises(ValueError):
+        p1.deposit(101)
+    assert accounts.transfer('bk', 'p1', 101).endswith(f'can hold no more than ${MAX_CASH}.')
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': MAX_CASH - 100, 'p2': 300}
+
+
+def test_failed_commit_leaves_memory_as_saved(accounts, tmp_path):
+    db = sqlite3.connect(str(tmp_path / 'tlog.db'))
+    db.execute("CREATE TRIGGER refuse_p2 BEFORE UPDATE ON Accounts WHEN NEW.id='p2' BEGIN SELECT RAISE(ABORT, 'refused'); END")
+    db.commit()
+    db.close()
+    with pytest.raises(TLogError):
+        accounts.query('p2').deposit(5)
+    with pytest.raises(TLogError):
+        accounts.transfer('p1', 'p2', 5)
+    with pytest.raises(TLogError):
+        accounts.bulk('deposit', 5)
+    assert balances(accounts) == saved_balances(accounts) == {'bk': 1000, 'p1': 500, 'p2': 300}
+
+
+def test_reload_keeps_buildings(accounts, tmp_path):
+    accounts.bulk('deposit', 1000, ['p1'])
+    accounts.buy_property('p1', 'Mediterranean Avenue')
+    accounts.buy_property('p1', 'Baltic Avenue')
+    db = sqlite3.connect(str(tmp_path / 'tlog.db'))
+    db.execute("UPDATE Properties SET rent_index='2 Houses' WHERE name='Baltic Avenue'")
+    db.commit()
+    db.close()
+    accounts.load_saved()
+    properties = accounts.prop_manager.properties
+    assert properties['Mediterranean Avenue'].rent_rate_index == 'Color set'
+    assert properties['Baltic Avenue'].rent_rate_index == '2 Houses'
+    assert {prop.name for prop in accounts.query('p1').properties} == {'Mediterranean Avenue', 'Baltic Avenue'}
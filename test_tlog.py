@@ -0,0 +1,136 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+from tlog import ACKNOWLEDGED, ASYNC, FSYNC, SCHEMA_VERSION, TLogError, TransactionLog
+
+
+@pytest.fixture
+def stop():
+    """
+    Stop every log a test opens, even when it fails.
+    """
+    logs = []
+    yield logs.append
+    for tlog in logs:
+        for _ in tlog.stop_db():
+            pass
+
+
+def make_v1_database(path):
+    """
+    A database as the first release wrote it: TEXT times, one Transfer row
+    per side and properties as JSON on the accounts.
+    """
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE TLog(time TEXT, type TEXT, account TEXT, info TEXT)")
+    db.execute("CREATE TABLE Accounts(id TEXT PRIMARY KEY, name TEXT, salt BLOB, password_hash BLOB, cash INTEGER, properties TEXT, is_banker BOOL)")
+    owned = [{'name': 'Baltic Avenue', 'owner': 'p1', 'rent_rate': '2 Houses', 'mortgaged': False}]
+    db.executemany("INSERT INTO Accounts VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        ('p1', 'one', b'', b'', 1500, json.dumps(owned), True),
+        ('p2', 'two', b'', b'', 1300, '[]', False),
+    ])
+    db.executemany("INSERT INTO TLog VALUES (?, ?, ?, ?)", [
+        ('2023-01-01 10:00:00.000000', 'Create', 'p1', 'Started with $1500'),
+        ('2023-01-01 10:00:01.000000', 'Create', 'p2', 'Started with $1500'),
+        ('2023-01-01 10:00:02.000000', 'Withdraw', 'p2', '$100'),
+        ('2023-01-01 10:00:03.000000', 'Transfer', 'p2', 'Two ($1300) paid One ($1600) $100.'),
+        ('2023-01-01 10:00:03.000000', 'Transfer', 'p1', 'Two ($1300) paid One ($1600) $100.'),
+        ('2023-01-01 10:00:04.000000', 'Deposit', 'p1', '$100'),
+    ])
+    db.commit()
+    db.close()
+
+
+def wait_for_migration(tlog):
+    deadline = time.monotonic() + 10
+    while tlog.read("SELECT 1 FROM sqlite_master WHERE name='TLogV1'", consistent=True):
+        assert time.monotonic() < deadline, 'TLog migration did not finish'
+        time.sleep(0.01)
+
+
+def test_v1_database_migrates_to_current_layout(tmp_path, stop):
+    path = str(tmp_path / 'tlog.db')
+    make_v1_database(path)
+    tlog = TransactionLog(path)
+    stop(tlog)
+    wait_for_migration(tlog)
+
+    (version,), = tlog.read('PRAGMA user_version', consistent=True)
+    assert version == SCHEMA_VERSION
+    rows = tlog.read("SELECT type, account, amount, counterparty FROM TLog ORDER BY id", consistent=True)
+    # The payee's copy of the transfer is merged into the payer's row
+    assert rows == [
+        ('Create', 'p1', 1500, None),
+        ('Create', 'p2', 1500, None),
+        ('Withdraw', 'p2', -100, None),
+        ('Transfer', 'p2', -100, 'p1'),
+        ('Deposit', 'p1', 100, None),
+    ]
+    (first_time,), = tlog.read("SELECT MIN(time) FROM TLog", consistent=True)
+    assert isinstance(first_time, int)
+    assert tlog.get_property_states() == [('Baltic Avenue', 'p1', '2 Houses', 0)]
+
+
+def test_snapshot_matches_tables(tmp_path, stop):
+    tlog = TransactionLog(str(tmp_path / 'tlog.db'))
+    stop(tlog)
+    tlog.create_account('p1', 'one', b'', b'', 500, False)
+    tlog.log_account_created('p1', 500)
+    tlog.adjust_account('p1', 25)
+    tlog.set_property_state('Baltic Avenue', 'p1', 'Base', False)
+    tlog.save_snapshot()
+    tlog.flush()
+
+    stamp, last_log_id, state = tlog.get_latest_snapshot()
+    (newest,), = tlog.read("SELECT MAX(id) FROM TLog", consistent=True)
+    assert last_log_id == newest
+    assert dict(state['accounts']) == {'p1': 525}
+    assert state['properties'] == [['Baltic Avenue', 'p1', 'Base', 0]]
+
+
+def test_unknown_durability_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        TransactionLog(str(tmp_path / 'tlog.db'), durability='eventually')
+
+
+def test_async_receipt_does_not_wait(tmp_path, stop):
+    tlog = TransactionLog(str(tmp_path / 'tlog.db'), durability=ASYNC)
+    stop(tlog)
+    receipt = tlog.create_account('p1', 'one', b'', b'', 500, False)
+    assert receipt.future is None
+    receipt.wait()
+    tlog.flush()
+    assert tlog.read("SELECT cash FROM Accounts WHERE id='p1'", consistent=True) == [(500,)]
+
+
+@pytest.mark.parametrize('durability', [ACKNOWLEDGED, FSYNC])
+def test_waited_receipt_is_committed(tmp_path, stop, durability):
+    path = str(tmp_path / 'tlog.db')
+    tlog = TransactionLog(path, durability=durability)
+    stop(tlog)
+    tlog.create_account('p1', 'one', b'', b'', 500, False).wait()
+    # Another connection sees the row without going through the listener
+    db = sqlite3.connect(path)
+    try:
+        assert db.execute("SELECT cash FROM Accounts WHERE id='p1'").fetchall() == [(500,)]
+    finally:
+        db.close()
+
+
+def test_failed_write_raises_from_wait_and_keeps_the_writer(tmp_path, stop):
+    tlog = TransactionLog(str(tmp_path / 'tlog.db'), durability=ACKNOWLEDGED)
+    stop(tlog)
+    with pytest.raises(TLogError):
+        tlog._execute("INSERT INTO Missing VALUES (?)", (1,)).wait()
+    with pytest.raises(TLogError):
+        with tlog.group() as receipt:
+            tlog.create_account('p1', 'one', b'', b'', 500, False)
+            tlog._execute("INSERT INTO Missing VALUES (?)", (1,))
+        receipt.wait()
+    # The failed group is rolled back as a whole
+    assert tlog.read("SELECT id FROM Accounts", consistent=True) == []
+    tlog.create_account('p2', 'two', b'', b'', 300, False).wait()
+    assert tlog.read("SELECT id, cash FROM Accounts", consistent=True) == [('p2', 300)]
@@ -1,34 +1,373 @@
 # from threading import Event, Semaphore, Lock, Thread
-from multiprocessing import Process, Queue
-# from queue import Queue
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from itertools import count
+from multiprocessing import Event, Process, Queue, Value
+from pathlib import Path
+from queue import Empty, Full
+from threading import Lock, Thread, local
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
 import sqlite3
+import time
+import zlib
 from datetime import datetime
 
+from telemetry import BATCH_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
 SIG_STOP = 'done'
+# Command markers for grouped writes and snapshot requests
+SIG_GROUP = 'group'
+SIG_SNAPSHOT = 'snapshot'
+
+# Commands that can wait for the writer, and replies waiting to be picked up
+EXEC_QUEUE_SIZE = 200
+REPLY_QUEUE_SIZE = 100
+# Seconds to wait for room in a full queue before giving up with TLogBusy
+PUT_TIMEOUT = 5
+# Seconds between checks that the listener is still alive while waiting on it
+LISTENER_CHECK_INTERVAL = 1
+
+# How sure a write is once it has been queued.
+# Async writes are queued and forgotten, acknowledged writes are waited on until they commit,
+# and fsync writes are also synced to disk with synchronous=FULL so they survive a power cut.
+ASYNC = 'async'
+ACKNOWLEDGED = 'acknowledged'
+FSYNC = 'fsync'
+DURABILITY_LEVELS = (ASYNC, ACKNOWLEDGED, FSYNC)
+# Level of writes that change game state, from the environment.
+# Informational rows like server starts are always async.
+DURABILITY = os.environ.get('MONOPOLY_DURABILITY', ACKNOWLEDGED)
+
+# Group commit defaults.
+# A batch is committed once it holds BATCH_SIZE statements or once
+# BATCH_LINGER seconds have passed since its first statement arrived.
+BATCH_SIZE = 64
+BATCH_LINGER = 0.005
+
+# Number of read-only connections that may run queries at the same time
+READ_CONNECTIONS = 4
+
+# Version of the database layout, stored in PRAGMA user_version.
+# Version 1 is the original TLog with TEXT timestamps and no indexes.
+# Version 3 adds game state snapshots.
+# Version 4 logs each transfer as one row, from the payer to the counterparty.
+# Version 5 keeps property state in a Properties table instead of a JSON column on Accounts.
+SCHEMA_VERSION = 5
+# Old TLog rows copied into the current table per migration step
+MIGRATION_CHUNK = 500
+
+# A snapshot of the game state is taken after this many new TLog rows
+SNAPSHOT_INTERVAL = 1000
+# Older snapshots beyond this count are deleted
+SNAPSHOTS_KEPT = 2
+
+# Default and largest number of rows in one page of account history
+HISTORY_PAGE_SIZE = 25
+HISTORY_PAGE_MAX = 200
+
+# Rows read per query while exporting or archiving the TLog
+EXPORT_CHUNK = 1000
+# Columns of exported and archived TLog rows, in order
+EXPORT_FIELDS = ('id', 'time', 'type', 'account', 'amount', 'counterparty', 'info')
+# Finished sessions are only archived once they hold this many TLog rows
+ARCHIVE_MIN_ROWS = 10000
+# Errors a single statement can raise, from SQLite or from binding its arguments,
+# like a number too large for an SQLite INTEGER. They fail that command, not the listener.
+STATEMENT_ERRORS = (sqlite3.Error, OverflowError, TypeError, ValueError)
+
+# Deletes the payee half of transfers that were logged as two rows
+MERGE_TRANSFER_ROWS = """DELETE FROM TLog WHERE type='Transfer' AND amount > 0 AND id >= ? AND EXISTS (
+    SELECT 1 FROM TLog AS payer_row WHERE payer_row.account=TLog.counterparty
+        AND payer_row.counterparty=TLog.account AND payer_row.type='Transfer'
+        AND payer_row.amount=-TLog.amount AND payer_row.info=TLog.info)
+"""
+
+TRANSFER_INFO = re.compile(r'^(.*) \(\$-?\d+\) paid (.*) \(\$-?\d+\) \$(\d+)\.$')
+
+
+class TLogError(Exception):
+    """
+    Writes could not be queued or committed.
+    """
+
+
+class TLogBusy(TLogError):
+    """
+    The listener is too far behind to queue more commands.
+    """
+
+
+class ListenerStopped(TLogError):
+    """
+    The listener process exited, nothing more will be written.
+    """
+
+
+class WriteReceipt:
+    """
+    Returned for queued writes. wait() returns once they are committed at the
+    level they were queued with, or raises TLogError. Async writes don't wait.
+    """
+    def __init__(self, tlog, future=None):
+        self.tlog = tlog
+        self.future = future
+
+    def wait(self):
+        if self.future is None:
+            return
+        try:
+            self.tlog._wait(self.future)
+        except STATEMENT_ERRORS as e:
+            raise TLogError(f'Change could not be saved: {e}') from e
+
+
+def epoch_ms(timestamp=None):
+    """
+    Integer epoch timestamp in milliseconds, as stored in the TLog.
+    """
+    if timestamp is None:
+        return time.time_ns() // 1000000
+    return int(timestamp.timestamp() * 1000)
+
+
+def from_epoch_ms(stamp):
+    return datetime.fromtimestamp(stamp / 1000)
+
+
+def export_row(row):
+    """
+    A TLog row as a dict of EXPORT_FIELDS, with its time in ISO format.
+    """
+    row_id, stamp, *rest = row
+    return dict(zip(EXPORT_FIELDS, (row_id, from_epoch_ms(stamp).isoformat(timespec='milliseconds'), *rest)))
+
+
+def archive_range(path):
+    """
+    First and last TLog row IDs in an archive file, from its name.
+    """
+    first_id, last_id = Path(path).name.split('.')[0].split('-')[-2:]
+    return int(first_id), int(last_id)
+
+
+def archived_stamp(row):
+    """
+    TLog time of an archived row, from its ISO format back to epoch milliseconds.
+    """
+    return round(datetime.fromisoformat(row['time']).timestamp() * 1000)
+
+
+def make_cursor(stamp, row_id):
+    """
+    Encode the position of a TLog row for keyset pagination.
+    """
+    return f'{stamp}-{row_id}'
+
+
+def parse_cursor(cursor):
+    """
+    Decode a history cursor into its (time, id) position.
+    Raises ValueError if the cursor is malformed.
+    """
+    stamp, row_id = cursor.split('-')
+    return int(stamp), int(row_id)
+
+
+def convert_v1_row(row, names):
+    """
+    Turn a version 1 TLog row into the typed version 2 layout.
+    Amounts and transfer counterparties are recovered from the info text.
+    names maps account IDs to display names.
+    """
+    old_time, trans_type, account, info = row
+    amount = None
+    counterparty = None
+    if info is not None:
+        if trans_type == 'Create' and info.startswith('Started with $'):
+            amount = int(info[len('Started with $'):])
+        elif trans_type in ('Deposit', 'Withdraw') and info.startswith('$'):
+            amount = int(info[1:])
+            if trans_type == 'Withdraw':
+                amount = -amount
+        elif trans_type == 'Transfer':
+            match = TRANSFER_INFO.match(info)
+            if match is not None:
+                payer_name, payee_name, paid = match.groups()
+                if names.get(account) == payer_name:
+                    amount, other_name = -int(paid), payee_name
+                elif names.get(account) == payee_name:
+                    amount, other_name = int(paid), payer_name
+                else:
+                    other_name = None
+                # Only name the counterparty when the name is unambiguous
+                matching_ids = [i for i, n in names.items() if n == other_name]
+                if len(matching_ids) == 1:
+                    counterparty = matching_ids[0]
+    return (epoch_ms(datetime.fromisoformat(old_time)), trans_type, account, amount, counterparty, info)
 
 
 class TransactionLog:
 
-    def __init__(self, filename, exec_queue=Queue(200), recv_queue=Queue(100)):
+    def __init__(self, filename, exec_queue=None, recv_queue=None, batch_size=BATCH_SIZE, batch_linger=BATCH_LINGER, report_commits=False, read_connections=READ_CONNECTIONS, snapshot_interval=SNAPSHOT_INTERVAL, durability=DURABILITY, put_timeout=PUT_TIMEOUT):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f'Unknown durability {durability!r}, expected one of {", ".join(DURABILITY_LEVELS)}.')
         self.filename = filename
-        self.exec_queue = exec_queue
-        self.receive_data = recv_queue
+        # Archived TLog rows are kept next to the database, games/a.db archives to games/a-archive/
+        self.archive_dir = Path(filename).with_name(f'{Path(filename).stem}-archive')
+        # Accounts named in each archive file, so history pages skip files without them
+        self.archive_accounts = dict()
+        self.durability = durability
+        self.put_timeout = put_timeout
+        # Each log gets its own queues unless they are given, so two logs never share a writer
+        self.exec_queue = Queue(EXEC_QUEUE_SIZE) if exec_queue is None else exec_queue
+        self.receive_data = Queue(REPLY_QUEUE_SIZE) if recv_queue is None else recv_queue
+        # Group commit settings, a batch size of 1 commits every statement.
+        self.batch_size = max(1, batch_size)
+        self.batch_linger = batch_linger
+        self.report_commits = report_commits
+        self.snapshot_interval = snapshot_interval
+        # Writes made inside group() are collected per thread
+        self.grouped = local()
+        # Commit statistics shared with the listener process
+        self.commits = Value('L', 0)
+        self.committed_statements = Value('L', 0)
+        self.last_batch_size = Value('L', 0)
+        self.commit_seconds = Histogram(shared=True)
+        self.commit_sizes = Histogram(BATCH_BUCKETS, shared=True)
+        # Set by the listener once the tables exist and WAL is enabled
+        self.db_ready = Event()
+        # Read-only connections handed out to request threads.
+        # Idle ones are reused oldest first, so every connection in the pool stays in use.
+        self.read_connections = max(1, read_connections)
+        self.idle_readers = deque()
+        self.reader_waiters = deque()
+        self.open_readers = 0
+        self.read_pool_lock = Lock()
+        # Connection that notices commits made by other connections, see data_version
+        self.version_db = None
+        self.version_lock = Lock()
+        # Replies from the listener are matched to requests by ID
+        self.pending_replies = dict()
+        self.pending_lock = Lock()
+        self.request_ids = count()
         self.listener_thread = Process(target=self._queue_listener)
         self.listener_thread.daemon = True
         self.listener_thread.start()
         # listener_thread.join()
+        self.reply_thread = Thread(target=self._reply_listener, daemon=True)
+        self.reply_thread.start()
 
     def _queue_listener(self):
         db = sqlite3.connect(self.filename)
-        # Create TLog table and Accounts table if they doesn't exist
+        # WAL lets a whole batch land with a single sync on commit.
+        # Commits are only synced to disk when a batch holds an fsync write.
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema(db)
+        self.db_ready.set()
+        migrating = self._migrate_step(db)
+        self.snapshot_log_id = db.execute('SELECT IFNULL(MAX(last_log_id), 0) FROM Snapshots').fetchone()[0]
+        running = True
+        while running:
+            try:
+                # Old rows are migrated whenever no commands are waiting
+                next_command = self.exec_queue.get(block=not migrating)
+            except Empty:
+                migrating = self._migrate_step(db)
+                continue
+            except KeyboardInterrupt:
+                continue
+            # Commands in the batch as (statements, request ID to acknowledge)
+            batch = []
+            statement_count = 0
+            sync = False
+            snapshot_requested = False
+            # Group commit: gather queued writes until the batch is full,
+            # the linger time runs out, or a read or stop signal shows up.
+            deadline = time.monotonic() + self.batch_linger
+            while True:
+                if next_command == SIG_STOP:
+                    running = False
+                    break
+                update, com, args, request_id, durability = next_command
+                if not update:
+                    break
+                if com == SIG_SNAPSHOT:
+                    snapshot_requested = True
+                else:
+                    statements = args if com == SIG_GROUP else [(com, args)]
+                    batch.append((statements, request_id))
+                    statement_count += len(statements)
+                sync = sync or durability == FSYNC
+                if request_id is not None:
+                    # Someone is waiting, only take what is already queued
+                    deadline = 0
+                next_command = None
+                if statement_count >= self.batch_size:
+                    break
+                try:
+                    next_command = self.exec_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+            self._commit_batch(db, batch, sync)
+            # Snapshots wait for the old TLog to be migrated so their position is final
+            if not migrating and (snapshot_requested or self._snapshot_due(db)):
+                self._write_snapshot(db)
+            # Reads are answered after the writes queued ahead of them commit
+            if running and next_command is not None:
+                update, com, args, request_id, durability = next_command
+                try:
+                    self.receive_data.put((request_id, db.execute(com, args).fetchall(), None))
+                except STATEMENT_ERRORS as e:
+                    self.receive_data.put((request_id, None, e))
+        db.commit()
+        db.close()
+        self.receive_data.put(SIG_STOP)
+
+    def _create_schema(self, db):
+        """
+        Create the tables if they don't exist and upgrade older layouts.
+        An old TLog is set aside so its rows can be migrated in the background.
+        """
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        has_tlog = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='TLog'"
+        ).fetchone() is not None
+        if version < 2 and has_tlog:
+            db.execute('ALTER TABLE TLog RENAME TO TLogV1')
         db.execute(
             """CREATE TABLE IF NOT EXISTS TLog(
-                time TEXT,
+                id INTEGER PRIMARY KEY,
+                time INTEGER,
                 type TEXT,
                 account TEXT,
+                amount INTEGER,
+                counterparty TEXT,
                 info TEXT)
             """
         )
+        db.execute('CREATE INDEX IF NOT EXISTS TLogAccountTime ON TLog(account, time)')
+        db.execute('CREATE INDEX IF NOT EXISTS TLogCounterpartyTime ON TLog(counterparty, time)')
+        if 2 <= version < 4:
+            # Payee rows are merged into their transfers before anything reads the TLog
+            db.execute(MERGE_TRANSFER_ROWS, (0,))
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS Snapshots(
+                id INTEGER PRIMARY KEY,
+                time INTEGER,
+                last_log_id INTEGER,
+                state BLOB)
+            """
+        )
         db.execute(
             """CREATE TABLE IF NOT EXISTS Accounts(
                 id TEXT PRIMARY KEY,
@@ -40,163 +379,725 @@ class TransactionLog:
                 is_banker BOOL)
             """
         )
+        has_properties = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='Properties'"
+        ).fetchone() is not None
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS Properties(
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                rent_index TEXT,
+                mortgaged BOOL)
+            """
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS PropertiesOwner ON Properties(owner)')
+        if not has_properties:
+            # Older layouts kept each account's properties as JSON in Accounts.properties
+            for ident, saved_props in db.execute("SELECT id, properties FROM Accounts").fetchall():
+                db.executemany(
+                    "INSERT OR REPLACE INTO Properties VALUES (?, ?, ?, ?)",
+                    ((prop['name'], ident, prop['rent_rate'], prop['mortgaged']) for prop in json.loads(saved_props or '[]'))
+                )
+        db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        db.commit()
+
+    def _migrate_step(self, db):
+        """
+        Move one chunk of version 1 TLog rows into the current TLog.
+        Returns whether there are rows left to migrate.
+        """
+        has_old_tlog = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='TLogV1'"
+        ).fetchone() is not None
+        if not has_old_tlog:
+            return False
+        rows = db.execute(
+            "SELECT rowid, time, type, account, info FROM TLogV1 ORDER BY rowid LIMIT ?",
+            (MIGRATION_CHUNK,)
+        ).fetchall()
+        if not rows:
+            db.execute('DROP TABLE TLogV1')
+            db.commit()
+            return False
+        names = {ident: name.title() for ident, name in db.execute("SELECT id, name FROM Accounts")}
+        first_id = db.execute('SELECT IFNULL(MAX(id), 0) + 1 FROM TLog').fetchone()[0]
+        db.executemany(
+            "INSERT INTO TLog(time, type, account, amount, counterparty, info) VALUES (?, ?, ?, ?, ?, ?)",
+            (convert_v1_row(row[1:], names) for row in rows)
+        )
+        db.execute(MERGE_TRANSFER_ROWS, (first_id,))
+        db.execute("DELETE FROM TLogV1 WHERE rowid <= ?", (rows[-1][0],))
+        db.commit()
+        return True
+
+    def _snapshot_due(self, db):
+        last_log_id = db.execute('SELECT IFNULL(MAX(id), 0) FROM TLog').fetchone()[0]
+        return last_log_id - self.snapshot_log_id >= self.snapshot_interval
+
+    def _write_snapshot(self, db):
+        """
+        Save balances and property state as of the newest TLog row.
+        Grouped writes are never split across batches, so the Accounts
+        table always matches the TLog at this point.
+        Everything is read in one transaction, which also holds the write lock,
+        so another process sharing the database can't commit between the reads.
+        """
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            last_log_id = db.execute('SELECT IFNULL(MAX(id), 0) FROM TLog').fetchone()[0]
+            balances = db.execute("SELECT id, cash FROM Accounts").fetchall()
+            properties = db.execute(
+                "SELECT name, owner, rent_index, mortgaged FROM Properties WHERE owner IS NOT NULL"
+            ).fetchall()
+            state = zlib.compress(json.dumps({'accounts': balances, 'properties': properties}).encode())
+            db.execute(
+                "INSERT INTO Snapshots(time, last_log_id, state) VALUES (?, ?, ?)",
+                (epoch_ms(), last_log_id, state)
+            )
+            db.execute(
+                "DELETE FROM Snapshots WHERE id NOT IN (SELECT id FROM Snapshots ORDER BY id DESC LIMIT ?)",
+                (SNAPSHOTS_KEPT,)
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            # Left for the next one, a snapshot is only a shortcut
+            db.rollback()
+            logger.error('snapshot failed error=%s', e)
+            return
+        self.snapshot_log_id = last_log_id
+
+    def _reply_listener(self):
+        """
+        Hand replies from the listener process to the thread that asked.
+        """
         while True:
-            try:
-                next_command = self.exec_queue.get()
-            except KeyboardInterrupt:
-                pass
-            if next_command == SIG_STOP:
+            reply = self.receive_data.get()
+            if reply == SIG_STOP:
                 break
-            update, com, args = next_command
-            if update:
-                if args is not None:
+            request_id, result, error = reply
+            with self.pending_lock:
+                future = self.pending_replies.pop(request_id)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _commit_batch(self, db, batch, sync=False):
+        """
+        Apply a batch of write commands in a single transaction, synced to disk if asked.
+        If the batch fails, each command is retried on its own so one bad command
+        doesn't lose the others. Waiting commands are told how theirs went.
+        """
+        if not batch:
+            return
+        start = time.perf_counter()
+        if sync:
+            db.execute('PRAGMA synchronous=FULL')
+        try:
+            try:
+                for statements, _ in batch:
+                    for com, args in statements:
+                        db.execute(com, args)
+                db.commit()
+                errors = dict()
+            except STATEMENT_ERRORS:
+                db.rollback()
+                errors = self._commit_each(db, batch)
+        finally:
+            if sync:
+                db.execute('PRAGMA synchronous=NORMAL')
+        statement_count = sum(len(statements) for statements, _ in batch)
+        self.commit_seconds.observe(time.perf_counter() - start)
+        self.commit_sizes.observe(statement_count)
+        with self.commits.get_lock():
+            self.commits.value += 1
+        with self.committed_statements.get_lock():
+            self.committed_statements.value += statement_count
+        self.last_batch_size.value = statement_count
+        for position, (_, request_id) in enumerate(batch):
+            if request_id is not None:
+                self.receive_data.put((request_id, None, errors.get(position)))
+        if self.report_commits:
+            logger.info('committed statements=%d', statement_count)
+
+    def _commit_each(self, db, batch):
+        """
+        Commit every command in its own transaction.
+        Returns the errors of the commands that failed by their position in the batch.
+        """
+        errors = dict()
+        for position, (statements, _) in enumerate(batch):
+            try:
+                for com, args in statements:
                     db.execute(com, args)
-                else:
-                    db.execute(com)
                 db.commit()
+            except STATEMENT_ERRORS as e:
+                db.rollback()
+                errors[position] = e
+                logger.error('dropped write statements=%d error=%s', len(statements), e)
+        return errors
+
+    def commit_stats(self):
+        """
+        Number of commits and statements written by the listener so far.
+        """
+        commits = self.commits.value
+        statements = self.committed_statements.value
+        return {
+            'commits': commits,
+            'statements': statements,
+            'last batch size': self.last_batch_size.value,
+            'average batch size': statements / commits if commits else 0
+        }
+
+    def queue_depth(self):
+        """
+        Commands waiting for the listener.
+        """
+        return self.exec_queue.qsize()
+
+    def _put(self, command):
+        """
+        Queue a command for the listener.
+        Raises TLogBusy if the queue stays full for put_timeout seconds,
+        or ListenerStopped if the listener isn't running.
+        """
+        if not self.listener_thread.is_alive():
+            raise ListenerStopped(f'TLog listener for {self.filename} has stopped, writes are not being saved.')
+        try:
+            self.exec_queue.put(command, timeout=self.put_timeout)
+        except Full:
+            if not self.listener_thread.is_alive():
+                raise ListenerStopped(f'TLog listener for {self.filename} has stopped, writes are not being saved.')
+            raise TLogBusy(f'TLog for {self.filename} is too busy to save more changes, try again shortly.')
+
+    def _wait(self, future):
+        """
+        Wait for a reply from the listener.
+        Raises ListenerStopped if the listener exits first.
+        """
+        while True:
+            try:
+                return future.result(timeout=LISTENER_CHECK_INTERVAL)
+            except FutureTimeout:
+                if not self.listener_thread.is_alive():
+                    raise ListenerStopped(f'TLog listener for {self.filename} stopped before replying.')
+
+    def _reply_future(self):
+        future = Future()
+        with self.pending_lock:
+            request_id = next(self.request_ids)
+            self.pending_replies[request_id] = future
+        return request_id, future
+
+    def _queue_write(self, com, args, durability):
+        durability = durability or self.durability
+        if durability == ASYNC:
+            self._put((True, com, args, None, durability))
+            return WriteReceipt(self)
+        request_id, future = self._reply_future()
+        self._put((True, com, args, request_id, durability))
+        return WriteReceipt(self, future)
+
+    def _execute(self, com, args=(), durability=None):
+        """
+        Queue a write statement for the listener, at the log's durability unless given.
+        Returns a WriteReceipt to wait on, inside a group it is the group's.
+        """
+        statements = getattr(self.grouped, 'statements', None)
+        if statements is not None:
+            statements.append((com, args))
+            return self.grouped.receipt
+        return self._queue_write(com, args, durability)
+
+    @contextmanager
+    def group(self, durability=None):
+        """
+        Queue every write made inside the block as one command.
+        A group always lands in a single commit and is never split by a snapshot.
+        Yields a WriteReceipt that can be waited on after the block, for example
+        once locks held around it are released.
+        If the block raises, nothing in the group is queued.
+        """
+        if getattr(self.grouped, 'statements', None) is not None:
+            # Nested groups join the outer group at the stronger of the two levels
+            if durability is not None and DURABILITY_LEVELS.index(durability) > DURABILITY_LEVELS.index(self.grouped.durability):
+                self.grouped.durability = durability
+            mark = len(self.grouped.statements)
+            try:
+                yield self.grouped.receipt
+            except BaseException:
+                # Only the failed inner block is dropped, the outer group may carry on
+                del self.grouped.statements[mark:]
+                raise
+            return
+        self.grouped.statements = []
+        self.grouped.durability = durability or self.durability
+        self.grouped.receipt = receipt = WriteReceipt(self)
+        try:
+            yield receipt
+        finally:
+            statements = self.grouped.statements
+            self.grouped.statements = None
+        if statements:
+            receipt.future = self._queue_write(SIG_GROUP, statements, self.grouped.durability).future
+
+    def _query_listener(self, com, args=()):
+        """
+        Queue a read on the listener and return a future for its rows.
+        The read runs after every write queued before it.
+        """
+        request_id, future = self._reply_future()
+        self._put((False, com, args, request_id, None))
+        return future
+
+    def _checkout_reader(self):
+        """
+        Take a read-only connection from the pool.
+        When every connection is busy, wait in line for the next free one.
+        """
+        with self.read_pool_lock:
+            if self.idle_readers:
+                return self.idle_readers.popleft()
+            if self.open_readers >= self.read_connections:
+                waiter = Future()
+                self.reader_waiters.append(waiter)
             else:
-                if args is not None:
-                    self.receive_data.put(db.execute(com, args).fetchall())
+                waiter = None
+                self.open_readers += 1
+        if waiter is not None:
+            db = waiter.result()
+            if db is not None:
+                return db
+            # A failed connect passed its slot on, open our own connection in it
+        uri = Path(self.filename).absolute().as_uri() + '?mode=ro'
+        try:
+            return sqlite3.connect(uri, uri=True, check_same_thread=False)
+        except BaseException:
+            # Give the slot back, or a failed connect would shrink the pool for good
+            with self.read_pool_lock:
+                if self.reader_waiters:
+                    self.reader_waiters.popleft().set_result(None)
                 else:
-                    self.receive_data.put(db.execute(com).fetchall())
-        db.commit()
-        db.close()
+                    self.open_readers -= 1
+            raise
+
+    def _return_reader(self, db):
+        # Hand the connection straight to the longest waiting reader
+        with self.read_pool_lock:
+            if self.reader_waiters:
+                self.reader_waiters.popleft().set_result(db)
+            else:
+                self.idle_readers.append(db)
+
+    def read(self, com, args=(), consistent=False):
+        """
+        Run a read query and return its rows.
 
+        Reads use a pool of read-only connections so they run in parallel
+        and don't wait behind queued writes.
+        A consistent read goes through the listener instead, so it also
+        sees writes that are still queued.
+        """
+        if consistent:
+            return self._wait(self._query_listener(com, args))
+        self.db_ready.wait()
+        db = self._checkout_reader()
+        try:
+            return db.execute(com, args).fetchall()
+        finally:
+            self._return_reader(db)
 
-    def _send_transaction_to_listener(self, trans_type, account, info):
-        timestamp = datetime.now()
-        self.exec_queue.put((
-            True,
-            "INSERT INTO TLog VALUES (?, ?, ?, ?)",
+
+    def flush(self):
+        """
+        Wait until every write queued so far is committed.
+        """
+        self._wait(self._query_listener('SELECT 1'))
+
+    def data_version(self):
+        """
+        A number that changes whenever another connection commits to the database,
+        including this log's own listener and other processes' logs.
+        """
+        with self.version_lock:
+            if self.version_db is None:
+                self.db_ready.wait()
+                self.version_db = sqlite3.connect(self.filename, check_same_thread=False)
+            return self.version_db.execute('PRAGMA data_version').fetchone()[0]
+
+    def _send_transaction_to_listener(self, trans_type, account, info, amount=None, counterparty=None, durability=None):
+        timestamp = epoch_ms()
+        return self._execute(
+            "INSERT INTO TLog(time, type, account, amount, counterparty, info) VALUES (?, ?, ?, ?, ?, ?)",
             (
                 timestamp,
                 trans_type,
                 account,
+                amount,
+                counterparty,
                 info
-            )
-        ))
+            ),
+            durability
+        )
 
     def log_account_created(self, ident, cash):
         trans_type = 'Create'
         info = f'Started with ${cash}'
-        self._send_transaction_to_listener(trans_type, ident, info)
+        return self._send_transaction_to_listener(trans_type, ident, info, cash)
 
     def log_account_deleted(self, ident):
         trans_type = 'Delete'
-        self._send_transaction_to_listener(trans_type, ident, None)
+        return self._send_transaction_to_listener(trans_type, ident, None)
 
     def log_account_deposit(self, ident, amount):
         trans_type = 'Deposit'
         info = f'${amount}'
-        self._send_transaction_to_listener(trans_type, ident, info)
+        return self._send_transaction_to_listener(trans_type, ident, info, amount)
 
     def log_account_withdraw(self, ident, amount):
         trans_type = 'Withdraw'
         info = f'${amount}'
-        self._send_transaction_to_listener(trans_type, ident, info)
+        return self._send_transaction_to_listener(trans_type, ident, info, -amount)
 
-    def log_account_transfer(self, payer, payee, info):
+    def record_transfer(self, payer, payee, amount, info):
+        """
+        Ledger entry for a transfer.
+        One TLog row and both balance changes are committed together.
+        The row is logged on the payer with a negative amount and the payee as counterparty.
+        """
         trans_type = 'Transfer'
-        self._send_transaction_to_listener(trans_type, payer, info)
-        self._send_transaction_to_listener(trans_type, payee, info)
+        with self.group() as receipt:
+            self.adjust_account(payer, -amount)
+            self.adjust_account(payee, amount)
+            self._send_transaction_to_listener(trans_type, payer, info, -amount, payee)
+        return receipt
+
+    def log_property_bought(self, ident, prop_name):
+        trans_type = 'Property'
+        return self._send_transaction_to_listener(trans_type, ident, prop_name)
 
     def log_server_started(self):
         trans_type = 'Server Start'
         id_num = None
         info = 'Server has started'
-        self._send_transaction_to_listener(trans_type, id_num, info)
+        self._send_transaction_to_listener(trans_type, id_num, info, durability=ASYNC)
 
     def log_accounts_reloaded(self):
         trans_type = 'Reload'
         id_num = None
         info = 'Reloaded all accounts'
-        self._send_transaction_to_listener(trans_type, id_num, info)
+        self._send_transaction_to_listener(trans_type, id_num, info, durability=ASYNC)
 
     def log_get_by_id(self, ident):
-        self.exec_queue.put((
-            False,
-            "SELECT * FROM TLog WHERE account=? ORDER BY time",
-            (ident,)
-        ))
-        return self.receive_data.get()
+        rows = self.read(
+            "SELECT time, type, account, info FROM TLog WHERE account=? OR counterparty=? ORDER BY time, id",
+            (ident, ident)
+        )
+        return [(from_epoch_ms(stamp), *row) for stamp, *row in rows]
+
+    def log_page_by_id(self, ident, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        One page of an account's history, newest first.
+        Returns the rows and a cursor for the next older page,
+        or None when there are no older rows.
+        Once the live rows run out the page carries on into the archives.
+        """
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        before = tuple(before) if before is not None else None
+        # Rows logged on the account and rows naming it as counterparty are
+        # paged separately so both sides are index range scans, then merged.
+        position = "AND (time, id) < (?, ?)" if before is not None else ""
+        rows = self.read(
+            f"""SELECT * FROM (SELECT time, id, type, account, info FROM TLog
+                    WHERE account=? {position} ORDER BY time DESC, id DESC LIMIT ?)
+                UNION ALL
+                SELECT * FROM (SELECT time, id, type, account, info FROM TLog
+                    WHERE counterparty=? AND account!=? {position} ORDER BY time DESC, id DESC LIMIT ?)
+                ORDER BY time DESC, id DESC LIMIT ?""",
+            (ident, *(before or ()), limit + 1, ident, ident, *(before or ()), limit + 1, limit + 1)
+        )
+        if len(rows) <= limit:
+            # Archived rows are all older than the live ones
+            rows += self._archived_page(ident, before, limit + 1 - len(rows))
+        older = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            older = make_cursor(rows[-1][0], rows[-1][1])
+        return [(from_epoch_ms(stamp), *row) for stamp, _, *row in rows], older
+
+    def _archived_page(self, ident, before, count):
+        """
+        Up to count archived rows naming an account and older than the before position,
+        newest first, laid out like the live rows of log_page_by_id.
+        Files are read whole, so only pages past the live rows pay for it.
+        """
+        rows = []
+        for path in reversed(self.archive_files()):
+            if ident not in self._archive_accounts(path):
+                continue
+            found = []
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    row = json.loads(line)
+                    if ident not in (row['account'], row['counterparty']):
+                        continue
+                    stamp = archived_stamp(row)
+                    if before is None or (stamp, row['id']) < before:
+                        found.append((stamp, row['id'], row['type'], row['account'], row['info']))
+            rows += sorted(found, key=lambda row: row[:2], reverse=True)
+            if len(rows) >= count:
+                break
+        return rows[:count]
+
+    def _archive_accounts(self, path):
+        """
+        Every account an archive file names, read once per file.
+        """
+        accounts = self.archive_accounts.get(path)
+        if accounts is None:
+            accounts = set()
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    row = json.loads(line)
+                    accounts.update((row['account'], row['counterparty']))
+            self.archive_accounts[path] = accounts
+        return accounts
+
+    def export_chunks(self, ident=None, chunk_size=EXPORT_CHUNK):
+        """
+        Every TLog row, or every row naming an account, oldest first, as lists of export_row dicts.
+        Archived rows come first. Live rows are read a chunk per query from
+        the read pool, so a slow consumer never holds a connection.
+        Rows written after the export starts are left out.
+        """
+        last_archived = 0
+        for path in self.archive_files():
+            chunk = []
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    row = json.loads(line)
+                    if ident is None or ident in (row['account'], row['counterparty']):
+                        chunk.append(row)
+                        if len(chunk) >= chunk_size:
+                            yield chunk
+                            chunk = []
+            if chunk:
+                yield chunk
+            last_archived = max(last_archived, archive_range(path)[1])
+        last_id = self.read("SELECT IFNULL(MAX(id), 0) FROM TLog")[0][0]
+        where = "(account=? OR counterparty=?) AND " if ident is not None else ""
+        after = last_archived
+        while after < last_id:
+            rows = self.read(
+                f"SELECT id, time, type, account, amount, counterparty, info FROM TLog WHERE {where}id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (*((ident, ident) if ident is not None else ()), after, last_id, chunk_size)
+            )
+            if not rows:
+                break
+            yield [export_row(row) for row in rows]
+            after = rows[-1][0]
+
+    def archive_files(self):
+        """
+        Archive files of this log, oldest rows first.
+        """
+        return sorted(self.archive_dir.glob('*.ndjson.gz'), key=archive_range)
+
+    def archive_finished_sessions(self, min_rows=ARCHIVE_MIN_ROWS):
+        """
+        Move the TLog rows of finished sessions into a compressed NDJSON archive file.
+        A session ends when the next one starts, and rows are only archived once the
+        latest snapshot covers them.
+        Returns the number of rows archived, nothing is done below min_rows.
+        """
+        (session_start,), = self.read("SELECT IFNULL(MAX(id), 0) FROM TLog WHERE type='Server Start'", consistent=True)
+        (snapshot_id,), = self.read("SELECT IFNULL(MAX(last_log_id), 0) FROM Snapshots", consistent=True)
+        # The newest row always stays so row IDs are never reused
+        last_id = min(session_start - 1, snapshot_id)
+        (first_id, row_count), = self.read("SELECT MIN(id), COUNT(*) FROM TLog WHERE id <= ?", (last_id,), consistent=True)
+        if row_count < max(1, min_rows):
+            return 0
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        path = self.archive_dir / f'{Path(self.filename).stem}-{first_id}-{last_id}.ndjson.gz'
+        partial = path.with_name(path.name + '.partial')
+        after = first_id - 1
+        with open(partial, 'wb') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8') as archive:
+                while after < last_id:
+                    rows = self.read(
+                        "SELECT id, time, type, account, amount, counterparty, info FROM TLog WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                        (after, last_id, EXPORT_CHUNK)
+                    )
+                    if not rows:
+                        break
+                    archive.writelines(json.dumps(export_row(row)) + '\n' for row in rows)
+                    after = rows[-1][0]
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial, path)
+        # Rows are only deleted once their archive is safely on disk
+        self._execute("DELETE FROM TLog WHERE id BETWEEN ? AND ?", (first_id, last_id), FSYNC).wait()
+        logger.info('archived rows=%d file=%s', row_count, path)
+        return row_count
+
+    def save_snapshot(self):
+        """
+        Ask the listener for a snapshot once the writes queued so far commit.
+        """
+        self._put((True, SIG_SNAPSHOT, None, None, ASYNC))
+
+    def get_latest_snapshot(self):
+        """
+        The newest snapshot as (time, last TLog row ID, state), or None if there isn't one.
+        The state holds the balance of every account and the state of every owned property
+        as of that row, for a point-in-time export of the game.
+        """
+        rows = self.read(
+            "SELECT time, last_log_id, state FROM Snapshots ORDER BY id DESC LIMIT 1",
+            consistent=True
+        )
+        if not rows:
+            return None
+        stamp, last_log_id, state = rows[0]
+        return stamp, last_log_id, json.loads(zlib.decompress(state))
 
     def purge_logs(self):
-        self.exec_queue.put((
-            True,
-            "DELETE FROM TLog",
-            None
-        ))
+        """
+        Queue the deletion of every TLog row and snapshot.
+        Archives are left for remove_archives, once the deletion is committed.
+        """
+        with self.group() as receipt:
+            self._execute("DELETE FROM TLog")
+            self._execute("DROP TABLE IF EXISTS TLogV1")
+            self._execute("DELETE FROM Snapshots")
+        return receipt
+
+    def remove_archives(self):
+        shutil.rmtree(self.archive_dir, ignore_errors=True)
+        self.archive_accounts.clear()
 
     def create_account(self, ident, name, pw_salt, pw_hash, cash, is_banker):
-        self.exec_queue.put((
-            True,
+        return self._execute(
             "INSERT INTO Accounts VALUES (?, ?, ?, ?, ?, '{}', ?)",
             (ident, name, pw_salt, pw_hash, cash, is_banker)
-        ))
+        )
 
     def update_account(self, ident, cash):
-        self.exec_queue.put((
-            True,
+        return self._execute(
             "UPDATE Accounts SET cash=? WHERE id=?",
             (cash, ident)
-        ))
+        )
+
+    def adjust_account(self, ident, amount):
+        """
+        Add to an account's stored balance.
+        Relative updates give the same result whatever order they commit in.
+        """
+        return self._execute(
+            "UPDATE Accounts SET cash=cash+? WHERE id=?",
+            (amount, ident)
+        )
 
-    def update_properties(self, ident, properties):
-        self.exec_queue.put((
-            True,
-            "UPDATE Accounts SET properties=? WHERE id=?",
-            (properties, ident)
-        ))
+    def set_property_state(self, name, owner, rent_index, mortgaged):
+        """
+        Save one property's owner, rent index and mortgage.
+        """
+        return self._execute(
+            "INSERT OR REPLACE INTO Properties VALUES (?, ?, ?, ?)",
+            (name, owner, rent_index, mortgaged)
+        )
+
+    def get_property_states(self):
+        """
+        Name, owner, rent index and mortgage of every saved property.
+        """
+        return self.read(
+            "SELECT name, owner, rent_index, mortgaged FROM Properties",
+            consistent=True
+        )
 
     def delete_account(self, ident):
-        self.exec_queue.put((
-            True,
-            "DELETE FROM Accounts WHERE id=?",
-            (ident,)
-        ))
+        """
+        Remove an account, its properties go back to the bank.
+        """
+        with self.group() as receipt:
+            self._execute(
+                "DELETE FROM Accounts WHERE id=?",
+                (ident,)
+            )
+            self._execute(
+                "DELETE FROM Properties WHERE owner=?",
+                (ident,)
+            )
+        return receipt
+
+    def get_account_identities(self):
+        """
+        Login and balance columns of every account, without saved properties.
+        """
+        return self.read(
+            "SELECT id, name, salt, password_hash, cash, is_banker FROM Accounts",
+            consistent=True
+        )
 
     def get_all_accounts(self):
-        self.exec_queue.put((
-            False,
+        # Loading accounts must see every account created so far
+        return self.read(
             "SELECT * FROM Accounts",
-            None
-        ))
-        return self.receive_data.get()
+            consistent=True
+        )
 
     def set_account_password(self, ident, salt, hashed_pass):
-        self.exec_queue.put((
-            True,
-            "UPDATE Accounts SET salt=? password_hash=? WHERE id=?",
+        return self._execute(
+            "UPDATE Accounts SET salt=?, password_hash=? WHERE id=?",
             (salt, hashed_pass, ident)
-        ))
+        )
 
     def retrieve_hashed_password(self, ident):
-        self.exec_queue.put((
-            False,
+        return self.read(
             "SELECT salt, password_hash FROM Accounts WHERE id=?",
             (ident,)
-        ))
-        return self.receive_data.get()
+        )
 
     def nuke_tables(self):
-        self.exec_queue.put((
-            True,
-            "DELETE FROM Accounts",
-            None
-        ))
         trans_type = 'Nuke Data'
         id_num = None
         info = 'Accounts and TLog were purged'
-        self._send_transaction_to_listener(trans_type, id_num, info)
-        self.purge_logs()
+        # Archives are only removed once the purge is known to have committed
+        durability = ACKNOWLEDGED if self.durability == ASYNC else self.durability
+        with self.group(durability) as receipt:
+            self._execute("DELETE FROM Accounts")
+            self._execute("DELETE FROM Properties")
+            self._send_transaction_to_listener(trans_type, id_num, info)
+            self.purge_logs()
+        receipt.wait()
+        self.remove_archives()
+        return receipt
 
     def stop_db(self):
         trans_type = 'Server Stop'
         id_num = None
         info = 'Server has stopped'
-        self._send_transaction_to_listener(trans_type, id_num, info)
-        yield 'Logged server stop'
-        self.exec_queue.put(SIG_STOP)
-        yield 'Signaled db listener close'
+        try:
+            self._send_transaction_to_listener(trans_type, id_num, info, durability=ASYNC)
+            yield 'Logged server stop'
+            self.save_snapshot()
+            yield 'Requested final snapshot'
+            self._put(SIG_STOP)
+            yield 'Signaled db listener close'
+        except ListenerStopped:
+            # Nobody is left to tell the reply thread to stop
+            self.receive_data.put(SIG_STOP)
+            yield 'TLog listener had already stopped'
         self.listener_thread.join()
+        self.reply_thread.join()
+        with self.read_pool_lock:
+            for db in self.idle_readers:
+                db.close()
+            self.idle_readers = deque()
+        with self.version_lock:
+            if self.version_db is not None:
+                self.version_db.close()
+                self.version_db = None
         yield 'Stopped TLog'
@@ -0,0 +1,13 @@
+# Entry point for WSGI servers running several worker processes, like
+#     MONOPOLY_SECRET_KEY=<random string> gunicorn --workers 4 --threads 8 wsgi:app
+# Every worker opens the same databases and keeps its own cache of them.
+# Don't preload the app, each worker has to start its own TLog writers.
+import atexit
+
+from server import create_app, shutdown
+from telemetry import configure_logging
+
+configure_logging()
+# Event streams are served by the workers at /bruh, so keep threads free for them
+app = create_app(shared=True, event_stream_port=None)
+atexit.register(shutdown, app)